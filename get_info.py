@@ -13,8 +13,9 @@ from runner import runner_serial
 
 @runner_serial
 def info(serial):
-  with pyAPT.Controller(serial_number=serial) as con:
-    info = con.info()
+  cache = pyAPT.ControllerCache()
+  with pyAPT.open_controller(serial, cache=cache) as con:
+    info = cache.info(con)
     print('\tController info:')
     labels=['S/N','Model','Type','Firmware Ver', 'Notes', 'H/W Ver',
             'Mod State', 'Channels']
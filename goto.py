@@ -22,7 +22,7 @@ def main(args):
     position = float(args[2])
 
   try:
-    with pyAPT.MTS50(serial_number=serial) as con:
+    with pyAPT.open_controller(serial) as con:
       print('Found APT controller S/N',serial)
       print('\tMoving stage to %.2fmm...'%(position))
       st=time.time()
@@ -34,12 +34,20 @@ from __future__ import print_function
 from __future__ import division
 
 import pyAPT
+import numpy as np
 import threading
 import time
 import yaml
 import sys
 from math import *
 from runner import runner_serial
+from pyAPT.transform import StageTransform
+from pyAPT.pipeline import ScanPipeline
+from pyAPT.journal import ScanJournal
+from pyAPT.adaptive import AdaptiveScan
+from pyAPT import units
+from pyAPT import plan
+from pyAPT import contour
 from matplotlib import pyplot as plt 
 from mpl_toolkits.mplot3d import Axes3D
 
@@ -50,16 +58,45 @@ class LinearStage(object):
 	'''
 	def __init__(self):
 		config = yaml.load(open("configfile.yml")) # $ pip install pyyaml
+		self.config = config
 		
-		# Reading linear stage serial number from config file
-		self.X_AXIS_SN = config["X_AXIS_SN"]
-		self.Y_AXIS_SN = config["Y_AXIS_SN"]
-		self.Z_AXIS_SN = config["Z_AXIS_SN"]
-		
-		# Reading distance range and scaling from config file
+		# Reading distance range and scaling from config file. ENCODER_SCALE is
+		# either one value for all axes or a list with one value per axis
 		self.MAX_DIST = config["MAX_DIST"]
 		self.ENCODER_SCALE = config["ENCODER_SCALE"]
-		self.MAX_DIST_ENCODER = self.MAX_DIST * self.ENCODER_SCALE
+		self.MAX_DIST_ENCODER = self.MAX_DIST * np.asarray(self.ENCODER_SCALE)
+
+		# The axes of the stage. The config file either lists them under AXES, in
+		# any number and with any controller class, or has the historic
+		# X_AXIS_SN, Y_AXIS_SN and Z_AXIS_SN entries, see pyAPT.AxisGroup
+		self.group = pyAPT.AxisGroup.from_config(config)
+
+		# Serial numbers of the stage axes, in the order used by the transform
+		self.AXES_SN = [axis.serial_number for axis in self.group.axes]
+		if "AXES" not in config:
+			self.X_AXIS_SN, self.Y_AXIS_SN, self.Z_AXIS_SN = self.AXES_SN
+
+		# World <-> stage coordinate transform. Without a TRANSFORM entry in the
+		# config file the X and Z axes are inverted, i.e. stage = MAX_DIST - x.
+		# With AXES it is made of the SIGN, SCALE and OFFSET of each axis
+		self.transform = self.group.transform
+		if self.transform is None:
+			axes = self.group.axes
+			self.transform = StageTransform(naxes = len(axes),
+				sign = [axis.sign for axis in axes],
+				scale = [axis.scale for axis in axes],
+				offset = [axis.offset for axis in axes])
+
+		# Times the dwell at every point of the scans against absolute deadlines, and logs
+		# the requested and actual dwell of each, see pyAPT.DwellScheduler. Reset at the
+		# start of every scan, so its report covers that scan only
+		self.timing = pyAPT.DwellScheduler()
+
+		# pyAPT.ScanProfiler recording the scans, see profileScans()
+		self.profiler = None
+
+		# Index of the point runPlan is visiting, so the visit callbacks can log by point
+		self.pointIndex = None
 
 		# Moving 3D Stage Flags
 		self.RIGHT = 0
@@ -77,124 +114,156 @@ class LinearStage(object):
 		# self.ax.view_init(elev = 45, azim = 90)
 
 	def getInfoAxis(self, axis):
-		con = pyAPT.MTS50(serial_number = axis)
-		ret = con.info()
-		con.close()
-		return ret
+		cache = pyAPT.ControllerCache()
+		with self.group:
+			return cache.info(self.axisBySerial(axis).con)
 
 	'''
 	@brief Prints the serial number, model, type, firmware version and servo of all the connected stages.
 	'''
 	def getInfo(self):
 		labels = ['S/N','Model','Type','Firmware Ver', 'Notes', 'H/W Ver', 'Mod State', 'Channels']
-		xInfo = self.getInfoAxis(self.X_AXIS_SN)
-		yInfo = self.getInfoAxis(self.Y_AXIS_SN)
-		zInfo = self.getInfoAxis(self.Z_AXIS_SN)
-		print("\nInformation of the X axis:")
-		print('--------------------------')
-		for idx, ainfo in enumerate(xInfo):
-			print(("\t%12s: %s" % (labels[idx], bytes(ainfo))))
-		print("\nInformation of the Y axis:")
-		print('--------------------------')
-		for idx, ainfo in enumerate(yInfo):
-			print(("\t%12s: %s" % (labels[idx], bytes(ainfo))))
-		print("\nInformation of the Z axis:")
-		print('--------------------------')
-		for idx, ainfo in enumerate(zInfo):
-			print(("\t%12s: %s" % (labels[idx], bytes(ainfo))))
+		for axis in self.group.axes:
+			info = self.getInfoAxis(axis.serial_number)
+			print("\nInformation of the %s axis:" % (str(axis.name).upper()))
+			print('--------------------------')
+			for idx, ainfo in enumerate(info):
+				print(("\t%12s: %s" % (labels[idx], bytes(ainfo))))
 		print("\n")
 
+	'''
+	@brief Finds the axis of the stage with the given serial number.
+	@param[in] serialNumber Serial number of the controller of the axis.
+	@returns The pyAPT.group.Axis.
+	'''
+	def axisBySerial(self, serialNumber):
+		for axis in self.group.axes:
+			if str(axis.serial_number) == str(serialNumber):
+				return axis
+		raise KeyError(serialNumber)
+
 	'''
 	@brief Obtains the current position, velocity and status of a linear stage connected through USB.
 	@param[in] axis Serial number of the target linear stage.
 	@returns Status for the stage with the serial number provided.
 	'''
 	def getStatusAxis(self, axis):
-		con = pyAPT.MTS50(serial_number = axis)
-		ret = con.status()
-		con.close()
-		return ret
+		stageAxis = self.axisBySerial(axis)
+		with self.group:
+			return stageAxis.con.status(stageAxis.channel)
 
 	'''
 	@brief Prints the axis, position and velocity of the connected stages.
 	'''
 	def getStatus(self):
-		xStatus = self.getStatusAxis(self.X_AXIS_SN)
-		yStatus = self.getStatusAxis(self.Y_AXIS_SN)
-		zStatus = self.getStatusAxis(self.Z_AXIS_SN)
+		with self.group:
+			statuses = self.group.status()
+		pos = self.transform.to_world([s.position for s in statuses])
+		vel = [statuses[i].velocity for i in self.transform.axis_map.argsort()]
 		print("\nAxis:   Position [mm]:   Velocity [mm/s]:")
 		print('-----   --------------   ----------------')
-		print(("X       %6.3f          %6.3f" % (float(self.MAX_DIST) - xStatus.position, xStatus.velocity)))
-		print(("Y       %6.3f          %6.3f" % (yStatus.position, yStatus.velocity)))
-		print(("Z       %6.3f          %6.3f\n" % (float(self.MAX_DIST) - zStatus.position, zStatus.velocity)))
+		for axis, p, v in zip(self.group.axes, pos, vel):
+			print(("%-5s   %6.3f          %6.3f" % (str(axis.name).upper(), p, v)))
+		print("")
 
 	'''
-	@brief Provides the position of one or all axes.
+	@brief Provides the position of one or all axes. All the axes are queried at the same time.
 	@param[in] axis String with the name of the axis we want to retrieve.
-	@returns position[s] [X, Y, Z] of the stage.
+	@returns position[s] [X, Y, Z, ...] of the stage.
 	'''
 	def getPos(self, axis = None):
-		if (axis == 'X' or axis == 'x' or axis == None):
-			with pyAPT.MTS50(serial_number = self.X_AXIS_SN) as con:
-				status = con.status()
-				posX = float(self.MAX_DIST_ENCODER - status.position_apt) / self.ENCODER_SCALE
-			if (axis != None):
-				return posX
-		if (axis == 'Y' or axis == 'y' or axis == None):
-			with pyAPT.MTS50(serial_number = self.Y_AXIS_SN) as con:
-				status = con.status()
-				posY = float(status.position_apt) / self.ENCODER_SCALE
-			if (axis != None):
-				return posY
-		if (axis == 'Z' or axis == 'z' or axis == None):
-			with pyAPT.MTS50(serial_number = self.Z_AXIS_SN) as con:
-				status = con.status()
-				posZ = float(self.MAX_DIST_ENCODER - status.position_apt) / self.ENCODER_SCALE
-			if (axis != None):
-				return posZ
-		return [posX, posY, posZ]
-
-	'''
-	@brief Sends the 3D linear stage to the position (0, 0, 0).
-	'''
-	def goHome(self):
-		# Move to home position of the stage
-		self.moveAbsolute(self.MAX_DIST, 0, self.MAX_DIST)
-
-		# Verify X axis home position
-		con = pyAPT.MTS50(serial_number = self.X_AXIS_SN)
-		con.home()
-		con.close()
-		
-		# Verify Y axis home position
-		con = pyAPT.MTS50(serial_number = self.Y_AXIS_SN)
-		con.home()
-		con.close()
+		with self.group:
+			statuses = self.group.status()
+		stage = [float(s.position_apt) / s.position_scale for s in statuses]
+		pos = self.transform.to_world(stage).tolist()
+		if (axis != None):
+			return pos[self.worldAxis(axis)]
+		return pos
+
+	'''
+	@brief Index of a world axis.
+	@param[in] axis Index, or name of the axis: 'x', 'y' or 'z', or the NAME of an axis in the AXES
+	                entry of the config file.
+	@returns Index of the world axis.
+	'''
+	def worldAxis(self, axis):
+		if isinstance(axis, int):
+			return axis
+		names = [str(name).lower() for name in self.group.names]
+		if axis.lower() in names:
+			return names.index(axis.lower())
+		return 'xyz'.index(axis.lower())
+
+	'''
+	@brief Opens the controllers of all the axes, see pyAPT.AxisGroup.
+	@returns List of controllers in the order of self.AXES_SN. The caller must call closeAxes().
+	'''
+	def openAxes(self):
+		self.group.open()
+		return self.group.controllers
 
-		# Verify Z axis home position
-		con = pyAPT.MTS50(serial_number = self.Z_AXIS_SN)
-		con.home()
-		con.close()
+	'''
+	@brief Closes the controllers opened by openAxes().
+	'''
+	def closeAxes(self):
+		self.group.close()
+
+	'''
+	@brief Homes all the axes at the same time.
+	@param[in] force If False, axes that report they are already homed are skipped.
+	@returns List of pyAPT.group.HomingResult with whether each axis was homed and how long it took.
+	'''
+	def homeAxes(self, force = False):
+		with self.group:
+			results = self.group.home(force = force)
+		for axis, res in zip(self.group.axes, results):
+			if res.homed:
+				print('%s axis homed in %.2fs' % (str(axis.name).upper(), res.duration))
+		return results
+
+	'''
+	@brief Sends the 3D linear stage to the position (0, 0, 0), homing the axes first.
+	@param[in] force If False, axes that report they are already homed are not homed again.
+	'''
+	def goHome(self, force = True):
+		# Verify the home position of all the axes at once
+		self.homeAxes(force = force)
 
 		# Move to our reference frame home position
 		self.moveAbsolute(0, 0, 0)
 
 	'''
-	@brief This method performs a 3D raster scan.
-	@param[in] step  Increment in microns from point to point.
-	@param[in] delay Seconds of delay after each position has been reached.
-	FIXME: show points in graph at the same time that the stage is moving.
-	FIXME: rotate the 3D view so that it is equivalent to the real coordinate frame.
+	@brief Stops all the axes as quickly as possible. The stop messages are written to every
+	       controller back-to-back before waiting for any of them, see pyAPT.group.stop_all.
+	@param[in] immediate If True the motors stop abruptly instead of decelerating.
+	@param[in] cons      Controllers of the axes, e.g. from openAxes(). Passing controllers
+	                     that are already open avoids the time it takes to open them.
+	@returns List of pyAPT.group.StopResult with the time each axis took to stop.
 	'''
-	def rasterScan(self, step, delay):
-		# FIXME: reset plot if it was already opened
-		# plt.close()
+	def emergencyStop(self, immediate = True, cons = None):
+		if cons is None:
+			with self.group:
+				results = self.group.stop(immediate = immediate)
+		else:
+			results = pyAPT.stop_all(cons, immediate = immediate)
+		print('All axes stopped in %.3fs' % (max(res.elapsed for res in results)))
+		return results
 
-		# Going home to reset the encoders
-		sys.stdout.write('Homing... ')
-		sys.stdout.flush()
-		self.moveAbsolute(0, 0, 0)
-		print('OK')
+	'''
+	@brief Re-homes the axes whose controllers report that they are not homed.
+	@returns List with the serial numbers of the axes that were homed.
+	'''
+	def homeIfNeeded(self):
+		results = self.homeAxes(force = False)
+		return [res.controller.serial_number for res in results if res.homed]
+
+	'''
+	@brief Generates the points of a 3D raster scan, in the order they are visited.
+	@param[in] step Increment in mm from point to point.
+	@returns List of (x, y, z) tuples.
+	'''
+	def rasterPoints(self, step):
+		points = []
 
 		# Setting the initial direction of the X (k) and Y(j) axes
 		kDir = self.RIGHT
@@ -205,9 +274,6 @@ class LinearStage(object):
 		j = 0.0
 		k = 0.0
 
-		# Showing the window with the plot of the points
-		# plt.show()
-
 		# Looping through the workspace in a raster fashion
 		while (i <= self.MAX_DIST):
 			if j > self.MAX_DIST:
@@ -224,12 +290,7 @@ class LinearStage(object):
 					k = 0
 					kDir = self.RIGHT
 				while (k >= 0 and k <= self.MAX_DIST):
-					self.moveAbsolute(k, j, i)
-					print(('Current position: %6.3f %6.3f %6.3f' % (k, j, i)))
-					# self.ax.scatter(k, j, i, zdir = 'z', c = 'red')
-					# plt.draw()
-					time.sleep(delay)
-					print('Moving to next position ...')
+					points.append((k, j, i))
 					if kDir == self.RIGHT:
 						k += step
 					else:
@@ -239,25 +300,249 @@ class LinearStage(object):
 				else:
 					j -= step
 			i += step
+		return points
 
 	'''
-	@brief Cylindrical scan starting from the floor and going up. For each height level it
-	       performs (self.MAX_DIST / step) circles. The scanning is clockwise. The spacing
-			 between the points of each circle is maintained the same regardless the distance
-			 to the centre of the cylinder. That is, the external circles have more points
-			 than the internal ones to maintain the same spacing.
-	@param[in] stepAngle Initial angle of separation between points. It is a ratio of pi. 
-	@param[in] step      Increment of the radius of the circle for each step of scanning.
-	                     It is also used for the increment in the z axis. It is a ratio of
-								the maximum distance.
-	@param[in] delay     Delay in seconds after a position has been reached.
+	@brief Starts recording where the time of the scans goes: communication, motion and
+	       settling per axis, and the dwell and plotting of every point, see
+	       pyAPT.ScanProfiler.
+	@param[in] sample Interval between recorded points, e.g. 10 to record every tenth point
+	                  and keep the overhead low on long scans.
+	@returns The pyAPT.ScanProfiler, for its report() and export_chrome_trace().
+	'''
+	def profileScans(self, sample = 1):
+		self.profiler = pyAPT.ScanProfiler(sample = sample)
+		self.group.set_profiler(self.profiler)
+		return self.profiler
+
+	'''
+	@brief Stops recording the scans.
+	@returns The pyAPT.ScanProfiler that was recording, or None.
+	'''
+	def stopProfiling(self):
+		profiler = self.profiler
+		self.group.set_profiler(None)
+		self.profiler = None
+		return profiler
+
+	'''
+	@brief Context manager marking scan point idx for the profiler, a no-op when not profiling.
+	'''
+	def profilePoint(self, idx):
+		if self.profiler is None:
+			return pyAPT.instrument.NULL_SPAN
+		return self.profiler.point(idx)
+
+	'''
+	@brief Context manager recording the enclosed block as phase name of the current point
+	       for the profiler, a no-op when not profiling.
+	'''
+	def profilePhase(self, name):
+		if self.profiler is None:
+			return pyAPT.instrument.NULL_SPAN
+		return self.profiler.phase(name)
+
+	'''
+	@brief Visits the points of a plan in order, optionally recording progress in a journal
+	       so that an interrupted scan can be resumed.
+	@param[in] points  List of (x, y, z) points in mm.
+	@param[in] visit   Callback visit(x, y, z) called once the stage is at each point, whose
+	                   index is self.pointIndex meanwhile.
+	@param[in] journal Path of the progress journal, or None to run without one.
+	@param[in] begin   Optional callback begin(resumed) called before the first point, resumed
+	                   being True if the journal picked up an interrupted scan.
+	@returns Index of the first point visited by this run.
+	'''
+	def runPlan(self, points, visit, journal = None, begin = None):
+		# Keep the controllers open for the whole scan
+		with self.group:
+			if journal is None:
+				if begin is not None:
+					begin(False)
+				for idx, (x, y, z) in enumerate(points):
+					self.pointIndex = idx
+					with self.profilePoint(idx):
+						self.moveAbsolute(x, y, z)
+						visit(x, y, z)
+				return 0
+
+			with ScanJournal(journal, points, self.config) as jrn:
+				start = jrn.next_index
+				if jrn.resumed:
+					print('Resuming scan at point %d of %d' % (start, len(points)))
+					homed = self.homeIfNeeded()
+					if homed:
+						print('Re-homed axes: %s' % (', '.join(homed)))
+				if begin is not None:
+					begin(jrn.resumed)
+				for idx in range(start, len(points)):
+					x, y, z = points[idx]
+					self.pointIndex = idx
+					with self.profilePoint(idx):
+						self.moveAbsolute(x, y, z)
+						visit(x, y, z)
+						with self.profilePhase('journal'):
+							jrn.complete(idx)
+				jrn.remove()
+			return start
+
+	'''
+	@brief Writes a plan file for scans too large to keep in memory, see pyAPT.plan.
+	       World points are converted to stage positions chunk by chunk as they are written.
+	@param[in] path   Path of the plan file.
+	@param[in] points Array of shape (N, 3) of world positions in mm, or an iterable of such
+	                  arrays, e.g. from pyAPT.plan.raster_chunks.
+	@param[in] dwell  Seconds to wait at each point, a number or an array of N.
+	@returns Number of points written.
+	'''
+	def writePlan(self, path, points, dwell = 0.0):
+		if hasattr(points, 'shape'):
+			points = [points]
+		stage = (self.toStage(np.atleast_2d(chunk)) for chunk in points)
+		return plan.write_plan(path, stage, dwell = dwell, config = self.config)
+
+	'''
+	@brief Writes the plan file of a 3D raster scan of the whole workspace, without
+	       building the list of points in memory like rasterPoints does.
+	@param[in] path  Path of the plan file.
+	@param[in] step  Increment in mm from point to point.
+	@param[in] dwell Seconds to wait at each point.
+	@returns Number of points written.
+	'''
+	def writeRasterPlan(self, path, step, dwell = 0.0):
+		chunks = plan.raster_chunks((0, 0, 0), (self.MAX_DIST, ) * 3, step)
+		return self.writePlan(path, chunks, dwell)
+
+	'''
+	@brief Runs a plan file written by writePlan. Progress is recorded per point next to the
+	       plan, so running the same file again after an interruption resumes it.
+	@param[in] path   Path of the plan file.
+	@param[in] visit  Callback visit(x, y, z) called with the world position once the stage is
+	                  at each point, or None.
+	@param[in] window Number of points read and prepared at a time.
+	@returns Number of points visited by this run.
+	'''
+	def runPlanFile(self, path, visit = None, window = 4096):
+		scanPlan = plan.PlanFile(path)
+		self.timing.reset()
+		scanPlan.check_config(self.config)
+
+		def onPoint(index, stage):
+			x, y, z = self.toWorld(np.atleast_2d(stage))[0].tolist()
+			visit(x, y, z)
+
+		try:
+			with self.group:
+				executor = plan.PlanExecutor(scanPlan, self.group.controllers,
+					visit = onPoint if visit else None, window = window, timing = self.timing)
+				if executor.done.resumed:
+					print('Resuming plan with %d of %d points done' % (executor.done.count(), len(scanPlan)))
+				try:
+					visited = executor.run()
+				finally:
+					# keeps the completion map if interrupted, for resuming
+					executor.done.close()
+				executor.done.remove()
+		finally:
+			scanPlan.close()
+		return visited
+
+	'''
+	@brief This method performs a 3D raster scan.
+	@param[in] step    Increment in microns from point to point.
+	@param[in] delay   Seconds of delay after each position has been reached.
+	@param[in] journal Optional path of a progress journal. If the scan is interrupted, calling
+	                   rasterScan again with the same arguments resumes after the last completed point.
+	FIXME: show points in graph at the same time that the stage is moving.
 	FIXME: rotate the 3D view so that it is equivalent to the real coordinate frame.
 	'''
-	def cylindricalScan(self, stepAngle, step, delay):
-		# Checking that the parameters are ratios
-		if (stepAngle > 1 or step > 1):
-			print('The step angle and the step must be lower than one because they are ratios.')
+	def rasterScan(self, step, delay, journal = None):
+		# FIXME: reset plot if it was already opened
+		# plt.close()
+
+		points = self.rasterPoints(step)
+		self.timing.reset()
+
+		# Going home to reset the encoders, unless we are resuming
+		def begin(resumed):
+			if not resumed:
+				sys.stdout.write('Homing... ')
+				sys.stdout.flush()
+				self.moveAbsolute(0, 0, 0)
+				print('OK')
+
+		# Showing the window with the plot of the points
+		# plt.show()
+
+		def visit(k, j, i):
+			with self.profilePhase('plot'):
+				print(('Current position: %6.3f %6.3f %6.3f' % (k, j, i)))
+				# self.ax.scatter(k, j, i, zdir = 'z', c = 'red')
+				# plt.draw()
+			with self.profilePhase('dwell'):
+				self.timing.dwell(delay, self.pointIndex)
+			print('Moving to next position ...')
+
+		self.runPlan(points, visit, journal, begin)
+		print('Dwell timing: %s' % (self.timing.report()))
+
+	'''
+	@brief Adaptive scan of the whole workspace. A coarse grid is measured first, then only
+	       the cells whose corner measurements differ by more than threshold are refined,
+	       level by level, down to minStep. See pyAPT.adaptive.AdaptiveScan.
+	@param[in] measure    Callback measure(x, y, z) returning the measurement at the current
+	                      position as a number. It is called with the stage stationary.
+	@param[in] coarseStep Step of the initial grid in mm.
+	@param[in] minStep    Finest step in mm.
+	@param[in] threshold  Refinement threshold, in units of the measurement.
+	@param[in] timeBudget Optional time limit of the scan in seconds.
+	@returns Array (N, 3) of the measured points and array (N) of their measurements.
+	'''
+	def adaptiveScan(self, measure, coarseStep, minStep, threshold, timeBudget = None):
+		scan = AdaptiveScan((0, 0, 0), (self.MAX_DIST, ) * 3, coarseStep, minStep,
+			threshold, time_budget = timeBudget)
+
+		def visit(point):
+			x, y, z = point.tolist()
+			self.moveAbsolute(x, y, z)
+			return measure(x, y, z)
 
+		points, values = scan.run(visit)
+		print('Measured %d points per level: %s' % (len(points), scan.level_counts))
+		return points, values
+
+	'''
+	@brief Step scan through arbitrary points, overlapping data processing with motion.
+	       The stage moves to each point and acquire() is called with the stage stationary.
+	       The next move is prepared while acquiring, and process() runs on worker threads
+	       while the stage moves on, see pyAPT.pipeline.ScanPipeline.
+	@param[in] points  Sequence of (x, y, z) points in mm, e.g. from rasterPoints().
+	@param[in] acquire Callback acquire(index, point) returning the raw data of a point.
+	@param[in] process Optional callback process(index, point, data) returning the result of a point.
+	@param[in] workers Number of processing threads.
+	@param[in] depth   Maximum number of acquired points waiting to be processed.
+	@returns List with the result of each point, and the pipeline with its per-phase timings.
+	'''
+	def pipelinedScan(self, points, acquire, process = None, workers = 2, depth = 2):
+		def prepare(point):
+			return self.toStage(point)
+
+		def move(stagePoint):
+			self.group.move_stage([float(pos) for pos in stagePoint])
+
+		pipe = ScanPipeline(move, acquire, process = process, prepare = prepare,
+			workers = workers, depth = depth)
+		with self.group:
+			results = pipe.run(points)
+		return results, pipe
+
+	'''
+	@brief Generates the points of a cylindrical scan, in the order they are visited.
+	       See cylindricalScan() for the meaning of the parameters.
+	@returns List of (x, y, z) tuples.
+	'''
+	def cylindricalPoints(self, stepAngle, step):
+		points = []
 		IN = 0
 		OUT = 1
 		stepAngle *= pi
@@ -268,18 +553,6 @@ class LinearStage(object):
 		z = 0
 		rDir = OUT
 		epsilon = 0.001
-		
-		# FIXME: reset plot if it was already opened
-		# plt.close()
-
-		# Going home to reset the encoders
-		sys.stdout.write('Homing... ')
-		sys.stdout.flush()
-		# self.moveAbsolute(0, 0, 0)
-		print('OK')
-
-		# Showing the window with the plot of the points
-		plt.show()
 
 		# Looping around all the points of the cylinder
 		while (z <= self.MAX_DIST):
@@ -291,22 +564,12 @@ class LinearStage(object):
 				stepAngle = initialStepAngle
 				r = step
 				rDir = OUT
-				x = self.MAX_DIST / 2
-				y = self.MAX_DIST / 2
-				self.moveAbsolute(x, y, z)
-				print(('Current position: %6.3f %6.3f %6.3f' % (x, y, z)))
-				self.ax.scatter(x, y, z, zdir = 'z', c = 'red')
-				plt.draw()
-				time.sleep(delay)
+				points.append((self.MAX_DIST / 2, self.MAX_DIST / 2, z))
 			while ((r > step or abs(r - step) < epsilon) and (r < self.MAX_DIST / 2 or abs(r - self.MAX_DIST / 2) < epsilon)):
 				while (phi > -pi):
 					x = r * cos(phi) + self.MAX_DIST / 2
 					y = r * sin(phi) + self.MAX_DIST / 2
-					self.moveAbsolute(x, y, z)
-					print(('Current position: %6.3f %6.3f %6.3f' % (x, y, z)))
-					self.ax.scatter(x, y, z, zdir = 'z', c = 'red')
-					plt.draw()
-					time.sleep(delay)
+					points.append((x, y, z))
 					phi -= stepAngle
 				if (rDir == IN):
 					if (abs(r - step) > epsilon):
@@ -314,79 +577,191 @@ class LinearStage(object):
 					r -= step
 				else:
 					stepAngle = (stepAngle * r) / (r + step)
-					r += step	
+					r += step
 				phi = pi
 			if (rDir == IN):
-				x = self.MAX_DIST / 2
-				y = self.MAX_DIST / 2
-				self.moveAbsolute(x, y, z)
+				points.append((self.MAX_DIST / 2, self.MAX_DIST / 2, z))
+			z += step
+		return points
+
+	'''
+	@brief Cylindrical scan starting from the floor and going up. For each height level it
+	       performs (self.MAX_DIST / step) circles. The scanning is clockwise. The spacing
+			 between the points of each circle is maintained the same regardless the distance
+			 to the centre of the cylinder. That is, the external circles have more points
+			 than the internal ones to maintain the same spacing.
+	@param[in] stepAngle Initial angle of separation between points. It is a ratio of pi. 
+	@param[in] step      Increment of the radius of the circle for each step of scanning.
+	                     It is also used for the increment in the z axis. It is a ratio of
+								the maximum distance.
+	@param[in] delay     Delay in seconds after a position has been reached.
+	@param[in] journal   Optional path of a progress journal. If the scan is interrupted, calling
+	                     cylindricalScan again with the same arguments resumes after the last
+	                     completed point.
+	FIXME: rotate the 3D view so that it is equivalent to the real coordinate frame.
+	'''
+	def cylindricalScan(self, stepAngle, step, delay, journal = None):
+		# Checking that the parameters are ratios
+		if (stepAngle > 1 or step > 1):
+			print('The step angle and the step must be lower than one because they are ratios.')
+
+		points = self.cylindricalPoints(stepAngle, step)
+		self.timing.reset()
+
+		# FIXME: reset plot if it was already opened
+		# plt.close()
+
+		# Going home to reset the encoders
+		sys.stdout.write('Homing... ')
+		sys.stdout.flush()
+		# self.moveAbsolute(0, 0, 0)
+		print('OK')
+
+		# Showing the window with the plot of the points
+		plt.show()
+
+		def visit(x, y, z):
+			with self.profilePhase('plot'):
 				print(('Current position: %6.3f %6.3f %6.3f' % (x, y, z)))
 				self.ax.scatter(x, y, z, zdir = 'z', c = 'red')
 				plt.draw()
-				time.sleep(delay)
-			z += step
+			with self.profilePhase('dwell'):
+				self.timing.dwell(delay, self.pointIndex)
+
+		self.runPlan(points, visit, journal)
+		print('Dwell timing: %s' % (self.timing.report()))
+
+	'''
+	@brief Cylindrical scan like cylindricalScan(), but each circle is followed continuously at
+	       a constant speed instead of stopping at every point, and measurements are taken on
+	       the fly, every spacing mm along the circle. See pyAPT.contour.ContourRunner.
+	@param[in] step    Increment of the radius of the circles and of z, as a ratio of the
+	                   maximum distance.
+	@param[in] speed   Speed along the circles in mm/s.
+	@param[in] spacing Distance between measurements along a circle in mm.
+	@param[in] measure Optional callback measure(x, y, z) called with the point the stage should
+	                   be at. It is called while moving, so it should be quick.
+	@returns List of the pyAPT.contour.ContourResult of every circle.
+	'''
+	def contourCylindricalScan(self, step, speed, spacing, measure = None):
+		if (step > 1):
+			print('The step must be lower than one because it is a ratio.')
+
+		step *= self.MAX_DIST
+		centre = self.MAX_DIST / 2
+		results = []
+
+		def sample(index, point):
+			if measure is not None:
+				return measure(*point)
+
+		with self.group:
+			z = 0
+			while (z <= self.MAX_DIST):
+				r = step
+				while (r <= centre + 0.001):
+					# clockwise from phi = pi, as cylindricalScan()
+					path = contour.Circle((centre, centre, z), r, start = pi, clockwise = True)
+					runner = contour.ContourRunner(self.group, path, speed, sample = sample,
+					                               spacing = spacing)
+					result = runner.run()
+					print(('Circle r = %6.3f z = %6.3f: %s' % (r, z, result.report())))
+					results.append(result)
+					r += step
+				z += step
+		return results
+
+	'''
+	@brief Moves one stage axis to the stage position pos (mm) and waits until it stops.
+	@param[in] stageAxis Index of the stage axis in self.AXES_SN.
+	@param[in] pos       Goal position in stage coordinates (mm).
+	'''
+	def moveStageAxis(self, stageAxis, pos):
+		positions = [None] * len(self.group)
+		positions[stageAxis] = pos
+		with self.group:
+			self.group.move_stage(positions)
+
+	'''
+	@brief Moves one world axis, leaving the others where they are. With a calibration MATRIX
+	       that couples the axes, the whole point is moved, since several stage axes may
+	       have to move.
+	@param[in] axis  Axis to move, see worldAxis().
+	@param[in] value Goal position in mm.
+	'''
+	def moveAxis(self, axis, value):
+		worldAxis = self.worldAxis(axis)
+		if self.transform.coupled:
+			with self.group:
+				point = self.getPos()
+				point[worldAxis] = value
+				self.moveAbsolute(*point)
+			return
+		self.moveStageAxis(*self.transform.axis_to_stage(worldAxis, value))
 
 	'''
 	@brief Moving X axis of the stage to the position x (mm)
 	@param[in] x Goal position in mm.
 	'''
 	def moveAbsoluteX(self, x):
-		x = float(self.MAX_DIST) - x
-		con = pyAPT.MTS50(serial_number = self.X_AXIS_SN)
-		con.goto(x, wait = False)
-		stat = con.status()
-		while stat.moving:
-			time.sleep(0.01)
-			stat = con.status()
-		con.close()
+		self.moveAxis(0, x)
 
 	'''
 	@brief Moving Y axis of the stage to the position y (mm)
 	@param[in] y Goal position in mm.
 	'''
 	def moveAbsoluteY(self, y):
-		con = pyAPT.MTS50(serial_number = self.Y_AXIS_SN)
-		con.goto(y, wait = False)
-		stat = con.status()
-		while stat.moving:
-			time.sleep(0.01)
-			stat = con.status()
-		con.close()
+		self.moveAxis(1, y)
 
 	'''
 	@brief Moving Z axis of the stage to the position z (mm)
 	@param[in] z Goal position in mm.
 	'''
 	def moveAbsoluteZ(self, z):
-		z = float(self.MAX_DIST) - z
-		con = pyAPT.MTS50(serial_number = self.Z_AXIS_SN)
-		con.goto(z, wait = False)
-		stat = con.status()
-		while stat.moving:
-			time.sleep(0.01)
-			stat = con.status()
-		con.close()
-
-	'''
-	@brief Move the stage to the position x, y, z.
-	@param[in] x     Position of the x axis in mm.
-	@param[in] y     Position of the y axis in mm.
-	@param[in] z     Position of the z axis in mm.
-	@param[in] delay Delay (in seconds) after each position has been reached.
-	'''
-	def moveAbsolute(self, x, y, z):
-		#tx = threading.Thread(target = self.moveAbsoluteX(x))
-		#ty = threading.Thread(target = self.moveAbsoluteY(y))
-		#tz = threading.Thread(target = self.moveAbsoluteZ(z))
-		#tx.daemon = True
-		#ty.daemon = True
-		#tz.daemon = True
-		#tx.start()
-		#ty.start()
-		#tz.start()
-		self.moveAbsoluteX(x)
-		self.moveAbsoluteY(y)
-		self.moveAbsoluteZ(z)
+		self.moveAxis(2, z)
+
+	'''
+	@brief Move the stage to the position x, y, z, moving all the axes at the same time.
+	@param[in] point Position of every world axis in mm, i.e. x, y and z on a 3 axis stage.
+	'''
+	def moveAbsolute(self, *point):
+		stage = self.transform.to_stage(point)
+		with self.group:
+			self.group.move_stage([float(pos) for pos in stage])
+
+	'''
+	@brief Converts an array of waypoints from world coordinates to stage coordinates.
+	@param[in] points Array of shape (N, 3) in mm.
+	@param[in] counts If True, return integer encoder counts instead of mm.
+	@returns Array of shape (N, 3) of stage positions.
+	'''
+	def toStage(self, points, counts = False):
+		if counts:
+			return self.transform.to_counts(points, self.ENCODER_SCALE)
+		return self.transform.to_stage(points)
+
+	'''
+	@brief Checks a whole plan against the travel range of every axis at once, before running it.
+	       Positions are quantized to encoder counts the same way the controllers do.
+	@param[in] points Array of shape (N, 3) of world positions in mm.
+	@returns Array with the indices of the points that are out of range on any axis.
+	'''
+	def validatePlan(self, points):
+		stage = np.atleast_2d(self.toStage(points))
+		scales = np.broadcast_to(np.asarray(self.ENCODER_SCALE, dtype = float), (len(self.group), ))
+		bad = np.zeros(len(stage), dtype = bool)
+		for stageAxis, axis in enumerate(self.group.axes):
+			limits = axis.limits or (0, self.MAX_DIST)
+			bad |= units.range_mask(stage[:, stageAxis], limits, scales[stageAxis])
+		return np.flatnonzero(bad)
+
+	'''
+	@brief Converts an array of stage positions (mm) back to world coordinates.
+	@param[in] stage Array of shape (N, 3) in mm.
+	@returns Array of shape (N, 3) of world positions.
+	'''
+	def toWorld(self, stage):
+		return self.transform.to_world(stage)
 
 	'''
 	@brief TODO
@@ -1,19 +1,43 @@
 from __future__ import absolute_import
 import pylibftdi
 
-from pyAPT import message, controller, mts50, prm1
+from pyAPT import message, controller, mts50, lts300, prm1, instrument, trace, pipeline, group, cache, program, timing, profiler
 
 __version__ = "0.01"
 __author__ = "Shuning Bian"
 
-__all__ = ['Message', 'Controller', 'MTS50', 'OutOfRangeError', 'PRM1',
-           'add_PID']
+__all__ = ['Message', 'Controller', 'MTS50', 'LTS300', 'OutOfRangeError',
+           'PRM1', 'Instrumentation', 'ScanPipeline', 'home_all',
+           'stop_all', 'ControllerCache', 'open_controller', 'MotionProgram',
+           'ProgramExecutor', 'MotionError', 'MoveTimeoutError',
+           'MotionFaultError', 'MoveStoppedError', 'ReplyTimeoutError',
+           'AxisGroup', 'Axis', 'synchronized_start', 'DwellScheduler',
+           'ScanProfiler', 'add_PID']
 
 Message = message.Message
 Controller = controller.Controller
 MTS50 = mts50.MTS50
+LTS300 = lts300.LTS300
 PRM1 = prm1.PRM1
 OutOfRangeError = controller.OutOfRangeError
+MotionError = controller.MotionError
+MoveTimeoutError = controller.MoveTimeoutError
+MotionFaultError = controller.MotionFaultError
+MoveStoppedError = controller.MoveStoppedError
+ReplyTimeoutError = controller.ReplyTimeoutError
+Instrumentation = instrument.Instrumentation
+ScanPipeline = pipeline.ScanPipeline
+home_all = group.home_all
+stop_all = group.stop_all
+AxisGroup = group.AxisGroup
+Axis = group.Axis
+synchronized_start = group.synchronized_start
+ControllerCache = cache.ControllerCache
+open_controller = cache.open_controller
+MotionProgram = program.MotionProgram
+ProgramExecutor = program.ProgramExecutor
+DwellScheduler = timing.DwellScheduler
+ScanProfiler = profiler.ScanProfiler
 
 _PRODUCT_IDS = pylibftdi.USB_PID_LIST
 _PRODUCT_IDS[:] = [0xFAF0]
@@ -0,0 +1,169 @@
+"""
+Adaptive multi-resolution step scanning.
+
+Instead of sampling a volume at one uniform step, AdaptiveScan samples a
+coarse grid first, and then repeatedly subdivides only the cells whose
+corner measurements differ by more than a threshold, until the cells reach
+the target resolution or the time budget runs out. Each refinement level is
+measured as one batch, ordered so the stage travels in a boustrophedon
+pattern.
+
+All points lie on a lattice of the finest resolution, so they are tracked as
+integer lattice coordinates, which makes de-duplication exact.
+
+This module requires NumPy, which is why it is not imported by pyAPT itself.
+"""
+from __future__ import absolute_import, division
+import itertools
+import math
+import time
+
+import numpy as np
+
+# the time budget is measured on a monotonic clock, where there is one
+_clock = getattr(time, 'monotonic', time.time)
+
+def serpentine_order(points):
+  """
+  Returns the indices that order points, an (N, 3) array, in a boustrophedon
+  pattern: layer by layer in z, row by row in y, reversing the direction of
+  travel in y every layer and in x every row.
+  """
+  points = np.asarray(points)
+  if not len(points):
+    return np.zeros(0, dtype=int)
+
+  _, layer = np.unique(points[:, 2], return_inverse=True)
+  ysign = np.where(layer % 2, -1.0, 1.0)
+  ykey = points[:, 1] * ysign
+
+  # rows are numbered in the order they are visited within each layer
+  rowkey = np.lexsort((ykey, layer))
+  rows = np.empty(len(points), dtype=int)
+  zy = np.stack([layer[rowkey], ykey[rowkey]], axis=1)
+  newrow = np.ones(len(points), dtype=bool)
+  newrow[1:] = np.any(zy[1:] != zy[:-1], axis=1)
+  rows[rowkey] = np.cumsum(newrow) - 1
+
+  xsign = np.where(rows % 2, -1.0, 1.0)
+  return np.lexsort((points[:, 0] * xsign, rows))
+
+def value_range(values, size):
+  """
+  Default refinement score: the spread of the corner values of a cell
+  """
+  return max(values) - min(values)
+
+class AdaptiveScan(object):
+  def __init__(self, lower, upper, coarse_step, min_step, threshold,
+               score=value_range, time_budget=None):
+    """
+    lower and upper are the corners of the volume to scan, in mm.
+
+    coarse_step is the step of the initial grid, and min_step the finest
+    step refinement may go down to, with 0 < min_step <= coarse_step. The
+    actual steps are adjusted slightly down so that the grid fits the volume
+    exactly.
+
+    A cell is refined when score(corner_values, cell_size) > threshold. The
+    default score is the spread of the corner values.
+
+    time_budget, in seconds, stops the scan before the next point once
+    exceeded. None means no limit.
+    """
+    super(AdaptiveScan, self).__init__()
+    self.lower = np.asarray(lower, dtype=float)
+    self.upper = np.asarray(upper, dtype=float)
+    span = self.upper - self.lower
+    if np.any(span < 0):
+      raise ValueError('upper must not be below lower')
+    if not 0 < min_step <= coarse_step:
+      raise ValueError('min_step must be positive and at most coarse_step')
+
+    self.levels = max(0, int(math.ceil(math.log(coarse_step / min_step, 2))))
+    self.ncells = np.maximum(1, np.ceil(span / coarse_step)).astype(int)
+    # lattice coordinates are in units of the finest step
+    self.coarse_units = 1 << self.levels
+    self.unit = span / (self.ncells * self.coarse_units)
+
+    self.threshold = threshold
+    self.score = score
+    self.time_budget = time_budget
+
+    # lattice point -> measured value
+    self.values = {}
+    # number of points measured at each level
+    self.level_counts = []
+    self.exhausted = False
+
+  def to_world(self, lattice):
+    lattice = np.asarray(lattice, dtype=float).reshape(-1, len(self.lower))
+    return self.lower + lattice * self.unit
+
+  def _coarse_cells(self):
+    n = self.coarse_units
+    ranges = [range(c) for c in self.ncells]
+    return [tuple(i * n for i in idx) for idx in itertools.product(*ranges)]
+
+  @staticmethod
+  def _cell_points(origin, size, steps=(0, 1)):
+    return [tuple(o + s * size for o, s in zip(origin, offs))
+            for offs in itertools.product(steps, repeat=len(origin))]
+
+  def _measure_batch(self, lattice, visit, start):
+    """
+    Measures the given lattice points in travel order. Returns False if the
+    time budget ran out.
+    """
+    lattice = [p for p in lattice if p not in self.values]
+    if not lattice:
+      return True
+
+    world = self.to_world(lattice)
+    measured = 0
+    for idx in serpentine_order(world):
+      if (self.time_budget is not None and
+          _clock() - start > self.time_budget):
+        self.exhausted = True
+        self.level_counts.append(measured)
+        return False
+      self.values[lattice[idx]] = visit(world[idx])
+      measured += 1
+
+    self.level_counts.append(measured)
+    return True
+
+  def run(self, visit):
+    """
+    Runs the scan. visit(point) is called with each point, as an array of
+    world coordinates in mm, and must move there, measure, and return the
+    measurement as a number.
+
+    Returns (points, values): an (N, 3) array of the measured points in the
+    order they were measured, and the corresponding values.
+    """
+    start = _clock()
+    size = self.coarse_units
+    cells = self._coarse_cells()
+
+    batch = set()
+    for c in cells:
+      batch.update(self._cell_points(c, size))
+
+    while self._measure_batch(batch, visit, start) and size > 1:
+      corners = lambda c: [self.values[p] for p in self._cell_points(c, size)]
+      refine = [c for c in cells
+                if self.score(corners(c), size * self.unit) > self.threshold]
+      if not refine:
+        break
+
+      half = size // 2
+      cells = []
+      batch = set()
+      for c in refine:
+        cells.extend(self._cell_points(c, half))
+        batch.update(self._cell_points(c, half, steps=(0, 1, 2)))
+      size = half
+
+    lattice = list(self.values)
+    return self.to_world(lattice), np.array([self.values[p] for p in lattice])
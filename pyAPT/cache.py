@@ -0,0 +1,272 @@
+"""
+Persistent cache of controller identity and last known state, keyed by serial
+number, so that new processes can open the right controller class and skip
+queries whose answers don't change.
+
+Per serial number the cache holds:
+
+  - the info() tuple, and the controller class to use for the stage
+  - the last known homing parameters, per channel, which
+    Controller.request_home_params() uses instead of querying
+  - the last known homed state and position, per channel, recorded when a
+    controller opened through open_controller() is homed with
+    group.home_all() or closed. home_all() homes axes known not to be homed
+    without asking them first
+
+Identity (info and class) is kept until invalidated, since it can only
+change when hardware is swapped, in which case info() reports a different
+serial number or firmware and the entry is dropped. open_controller()
+confirms it with one info() query on every open. Parameters and state
+expire after max_age seconds, and state is only ever a hint: a controller
+that has been power cycled loses its homed state, so anything safety
+relevant should still be confirmed with status(), which is one cheap query.
+Velocity parameters are not cached, since the controller forgets them when
+power cycled and move deadlines are computed from them.
+
+The cache is a JSON file, $PYAPT_CACHE or ~/.pyAPT/cache.json by default.
+"""
+from __future__ import absolute_import, division
+import json
+import os
+import tempfile
+import time
+
+from .controller import Controller
+from .mts50 import MTS50
+from .lts300 import LTS300
+from .prm1 import PRM1
+
+# controller classes open_controller() can choose from, by name
+CONTROLLER_CLASSES = {'MTS50': MTS50,
+                      'LTS300': LTS300,
+                      'PRM1': PRM1}
+
+# controller models, as reported by info(), that identify the stage
+# unambiguously. Others, e.g. TDC001 which drives both MTS50 and PRM1 stages,
+# need the class to be set with ControllerCache.set_class()
+CLASS_BY_MODEL = {'LTS300': 'LTS300',
+                  'LTS150': 'LTS300'}
+
+def default_path():
+  return os.environ.get('PYAPT_CACHE',
+                        os.path.join(os.path.expanduser('~'), '.pyAPT',
+                                     'cache.json'))
+
+# widths of the NUL padded strings of an info() tuple, by index
+_INFO_WIDTHS = {1: 8, 4: 48}
+
+def _text(b):
+  if isinstance(b, bytes):
+    return b.rstrip(b'\x00').decode('latin-1')
+  return b
+
+def _key(name, channel):
+  return '%s/%d'%(name, channel)
+
+# os.rename doesn't replace an existing file on Windows
+_replace = getattr(os, 'replace', os.rename)
+
+class ControllerCache(object):
+  def __init__(self, path=None, max_age=24 * 3600):
+    """
+    path defaults to default_path(). Parameters and state older than max_age
+    seconds are ignored.
+    """
+    super(ControllerCache, self).__init__()
+    self.path = path or default_path()
+    self.max_age = max_age
+    self._entries = {}
+    self.load()
+
+  def load(self):
+    try:
+      with open(self.path) as f:
+        self._entries = json.load(f)
+    except (IOError, OSError, ValueError):
+      self._entries = {}
+
+  def save(self):
+    """
+    Writes the cache to disk, replacing the file atomically
+    """
+    d = os.path.dirname(self.path)
+    if d and not os.path.isdir(d):
+      os.makedirs(d)
+    # a temporary file of our own, so that processes saving at the same
+    # time don't write into each other's
+    fd, tmp = tempfile.mkstemp(prefix='.cache', dir=d or '.')
+    try:
+      with os.fdopen(fd, 'w') as f:
+        json.dump(self._entries, f, indent=2, sort_keys=True)
+      _replace(tmp, self.path)
+    except BaseException:
+      os.remove(tmp)
+      raise
+
+  def entry(self, serial_number):
+    """
+    Returns the raw cache entry of serial_number, a dict, or None
+    """
+    return self._entries.get(str(serial_number))
+
+  def _entry(self, serial_number):
+    return self._entries.setdefault(str(serial_number), {})
+
+  def _fresh(self, entry, key):
+    item = entry.get(key) if entry else None
+    if item is None:
+      return None
+    if self.max_age is not None and time.time() - item['time'] > self.max_age:
+      return None
+    return item['value']
+
+  def _set(self, serial_number, key, value):
+    self._entry(serial_number)[key] = {'value': value, 'time': time.time()}
+
+  def invalidate(self, serial_number=None):
+    """
+    Forgets everything about serial_number, or about every controller if
+    serial_number is None
+    """
+    if serial_number is None:
+      self._entries = {}
+    else:
+      self._entries.pop(str(serial_number), None)
+    self.save()
+
+  def controller_class(self, serial_number):
+    """
+    Returns the controller class to use for serial_number, or None if not
+    known
+    """
+    entry = self.entry(serial_number)
+    name = entry.get('class') if entry else None
+    return CONTROLLER_CLASSES.get(name)
+
+  def set_class(self, serial_number, cls):
+    """
+    Records which controller class, or class name, to use for serial_number
+    """
+    if not isinstance(cls, str):
+      cls = cls.__name__
+    if cls not in CONTROLLER_CLASSES:
+      raise ValueError('Unknown controller class %s'%(cls))
+    self._entry(serial_number)['class'] = cls
+    self.save()
+
+  def info(self, con, refresh=False):
+    """
+    Returns con.info(), from the cache unless refresh is True or there is
+    nothing cached yet. Strings are returned as bytes padded with NULs, as
+    info() does.
+    """
+    entry = self.entry(con.serial_number)
+    if entry and 'info' in entry and not refresh:
+      info = list(entry['info'])
+      for idx, width in _INFO_WIDTHS.items():
+        info[idx] = info[idx].encode('latin-1').ljust(width, b'\x00')
+      return tuple(info)
+
+    info = con.info()
+    self.record_info(con.serial_number, info)
+    return info
+
+  def record_info(self, serial_number, info):
+    """
+    Stores an info() tuple. If it differs in serial number, model or
+    firmware from what was cached, the hardware has changed and the rest of
+    the entry is dropped.
+    """
+    stored = [_text(x) for x in info]
+    entry = self.entry(serial_number)
+    if entry and 'info' in entry and entry['info'][:4] != stored[:4]:
+      self._entries.pop(str(serial_number))
+    entry = self._entry(serial_number)
+    entry['info'] = stored
+    if 'class' not in entry and stored[1] in CLASS_BY_MODEL:
+      entry['class'] = CLASS_BY_MODEL[stored[1]]
+    self.save()
+
+  def home_params(self, serial_number, channel=1):
+    """
+    Returns the last known homing parameters of channel of serial_number, as
+    returned by Controller.request_home_params(), or None if unknown or too
+    old
+    """
+    params = self._fresh(self.entry(serial_number), _key('home', channel))
+    return tuple(params) if params is not None else None
+
+  def record_home_params(self, serial_number, params, channel=1):
+    """
+    Stores the homing parameters of channel of serial_number
+    """
+    self._set(serial_number, _key('home', channel), list(params))
+    self.save()
+
+  def record_state(self, con, status=None, timeout=None, channel=1):
+    """
+    Records the homed state and position of channel of con, querying its
+    status if status is not given, waiting at most timeout seconds for it if
+    timeout is not None. This is best effort: errors talking to the
+    controller are ignored, since it is called while closing.
+    """
+    try:
+      if status is None:
+        status = con.status(channel, timeout=timeout)
+      self._set(con.serial_number, _key('state', channel),
+                {'homed': bool(status.homed), 'position': status.position})
+      self.save()
+    except Exception:
+      pass
+
+  def last_state(self, serial_number, channel=1):
+    """
+    Returns the last known state of channel of serial_number as a dict with
+    homed and position, or None if unknown or too old
+    """
+    return self._fresh(self.entry(serial_number), _key('state', channel))
+
+def open_controller(serial_number, cache=None, default=MTS50, **kwargs):
+  """
+  Opens the controller with the given serial number as the class recorded in
+  the cache. If no class is recorded, the controller is identified with
+  info() and the class is derived from its model where that is unambiguous,
+  falling back to default. The device is opened only once either way.
+
+  A cached class is confirmed with one info() query: if the hardware no
+  longer matches the cached identity, the entry is dropped and the class is
+  derived again as above.
+
+  The returned controller records its state into the cache when closed.
+  Extra keyword arguments are passed on to the controller class.
+  """
+  if cache is None:
+    cache = ControllerCache()
+
+  cls = cache.controller_class(serial_number)
+  if cls is None:
+    probe = Controller(serial_number=serial_number, **kwargs)
+    try:
+      cache.info(probe)
+      kwargs['device'] = probe.detach_device()
+    finally:
+      probe.close()
+    cls = cache.controller_class(serial_number) or default
+  else:
+    con = cls(serial_number=serial_number, **kwargs)
+    try:
+      cache.info(con, refresh=True)
+    except Exception:
+      con.close()
+      raise
+    if cache.controller_class(serial_number) is cls:
+      con.cache = cache
+      return con
+    # the hardware has changed, reopen the device as the right class
+    kwargs['device'] = con.detach_device()
+    con.close()
+    cls = cache.controller_class(serial_number) or default
+
+  con = cls(serial_number=serial_number, **kwargs)
+  con.cache = cache
+  return con
@@ -0,0 +1,376 @@
+"""
+Continuous contouring along parametric paths.
+
+Moving point to point stops the stage at every point. Contouring instead
+keeps all axes moving along a path at a constant speed: at a fixed control
+rate every axis is given a velocity matching its share of the path tangent,
+and a MOVE_ABSOLUTE to a point far enough ahead on the path that it never
+starts decelerating, so the controllers are retargeted before they get
+there. Status is read back every tick, giving the tracking error as the
+path is followed.
+
+Paths are in world coordinates and parametrised by arc length, so constant
+speed along the path is constant speed over the sample:
+
+  Polyline(points)                 straight segments through points
+  Arc(center, radius, start, sweep, axes=(0, 1))
+  Circle(center, radius, axes=(0, 1))
+  Helix(center, radius, pitch, turns, axes=(0, 1, 2))
+
+Measurements along the path are taken on the fly, by a sample callback
+called as the path passes every spacing mm, without stopping:
+
+  runner = ContourRunner(stage, Circle((25, 25, 10), 10), speed=0.5,
+                         sample=measure, spacing=0.1)
+  result = runner.run()
+  print(result.max_following_error, result.samples)
+
+stage is a group.AxisGroup, whose to_stage() maps the path to the axes.
+"""
+from __future__ import absolute_import, division
+import bisect
+import math
+
+from . import message
+from .controller import OutOfRangeError
+from .group import stop_all, synchronized_start
+from .timing import clock, sleep_until
+
+def _distance(a, b):
+  return math.sqrt(sum((x - y) ** 2 for x, y in zip(a, b)))
+
+class Path(object):
+  """
+  A path parametrised by arc length s, from 0 to length
+  """
+  length = 0.0
+
+  def point(self, s):
+    """
+    Returns the point at arc length s, clamped to the ends of the path, as a
+    list of world coordinates
+    """
+    raise NotImplementedError()
+
+  def closest(self, p, s, window, steps=32):
+    """
+    Returns (s', distance) of the point of the path closest to p with s' in
+    [s - window, s + window], searched on steps subdivisions and refined
+    once around the best of them
+    """
+    lo = max(0.0, s - window)
+    hi = min(self.length, s + window)
+    best = None
+    for _ in range(2):
+      step = (hi - lo) / steps
+      for k in range(steps + 1):
+        sk = lo + k * step
+        d = _distance(self.point(sk), p)
+        if best is None or d < best[1]:
+          best = (sk, d)
+      lo = max(0.0, best[0] - step)
+      hi = min(self.length, best[0] + step)
+    return best
+
+class Polyline(Path):
+  def __init__(self, points):
+    super(Polyline, self).__init__()
+    if len(points) < 2:
+      raise ValueError('A polyline needs at least 2 points')
+    self.points = [[float(x) for x in p] for p in points]
+    # arc length at every point
+    self.stations = [0.0]
+    for a, b in zip(self.points[:-1], self.points[1:]):
+      self.stations.append(self.stations[-1] + _distance(a, b))
+    self.length = self.stations[-1]
+
+  def point(self, s):
+    s = min(max(s, 0.0), self.length)
+    i = min(bisect.bisect_right(self.stations, s), len(self.points) - 1)
+    a, b = self.points[i - 1], self.points[i]
+    seg = self.stations[i] - self.stations[i - 1]
+    f = (s - self.stations[i - 1]) / seg if seg else 0.0
+    return [x + (y - x) * f for x, y in zip(a, b)]
+
+class Arc(Path):
+  def __init__(self, center, radius, start, sweep, axes=(0, 1), pitch=0.0,
+               pitch_axis=None):
+    """
+    An arc of radius around center, a full point, in the plane of world
+    axes, from angle start sweeping sweep radians, positive from the first
+    axis towards the second. If pitch_axis is given the arc advances along
+    it by pitch per full turn, making it a helix.
+    """
+    super(Arc, self).__init__()
+    self.center = [float(x) for x in center]
+    self.radius = radius
+    self.start = start
+    self.sweep = sweep
+    self.axes = axes
+    self.pitch = pitch
+    self.pitch_axis = pitch_axis
+    rise = pitch * sweep / (2 * math.pi) if pitch_axis is not None else 0.0
+    self.length = math.sqrt((radius * sweep) ** 2 + rise ** 2)
+
+  def point(self, s):
+    s = min(max(s, 0.0), self.length)
+    f = s / self.length if self.length else 0.0
+    theta = self.start + self.sweep * f
+    p = list(self.center)
+    p[self.axes[0]] += self.radius * math.cos(theta)
+    p[self.axes[1]] += self.radius * math.sin(theta)
+    if self.pitch_axis is not None:
+      p[self.pitch_axis] += self.pitch * self.sweep * f / (2 * math.pi)
+    return p
+
+def Circle(center, radius, start=0.0, axes=(0, 1), clockwise=False):
+  """
+  A full circle, starting and ending at angle start
+  """
+  sweep = -2 * math.pi if clockwise else 2 * math.pi
+  return Arc(center, radius, start, sweep, axes)
+
+def Helix(center, radius, pitch, turns, start=0.0, axes=(0, 1, 2)):
+  """
+  turns turns of a helix around the axis axes[2], rising pitch per turn
+  from center
+  """
+  return Arc(center, radius, start, 2 * math.pi * turns, axes[:2], pitch,
+             axes[2])
+
+class ContourSample(object):
+  """
+  One status readback while contouring: t seconds after the start, the arc
+  length s the path should have been at, the measured world position, the
+  following error, i.e. the distance from where the stage should have
+  been, and the contour error, i.e. the distance from the path itself
+  """
+  def __init__(self, t, s, position, following_error, contour_error):
+    super(ContourSample, self).__init__()
+    self.t = t
+    self.s = s
+    self.position = position
+    self.following_error = following_error
+    self.contour_error = contour_error
+
+class ContourResult(object):
+  def __init__(self, path, speed, duration, tracking, samples):
+    super(ContourResult, self).__init__()
+    self.path = path
+    self.speed = speed
+    self.duration = duration
+    # ContourSample of every control tick
+    self.tracking = tracking
+    # (index, s, value) for every sample() call
+    self.samples = samples
+
+  @property
+  def max_following_error(self):
+    return max([t.following_error for t in self.tracking] or [0.0])
+
+  @property
+  def max_contour_error(self):
+    return max([t.contour_error for t in self.tracking] or [0.0])
+
+  @property
+  def rms_contour_error(self):
+    if not self.tracking:
+      return 0.0
+    return math.sqrt(sum(t.contour_error ** 2 for t in self.tracking) /
+                     len(self.tracking))
+
+  def report(self):
+    return ('%.3fmm at %.3fmm/s in %.2fs, %d ticks, %d samples, following '
+            'error max %.4fmm, contour error max %.4fmm rms %.4fmm'%(
+            self.path.length, self.speed, self.duration, len(self.tracking),
+            len(self.samples), self.max_following_error,
+            self.max_contour_error, self.rms_contour_error))
+
+class ContourRunner(object):
+  def __init__(self, group, path, speed, rate=20.0, lookahead=2.0, gain=1.0,
+               sample=None, spacing=None, settle=None):
+    """
+    Follows path with group, a group.AxisGroup, at speed mm/s along the
+    path.
+
+    rate is the control rate in Hz. Every tick each axis is sent its
+    velocity and a target lookahead ticks ahead, plus its stopping distance,
+    and the status of all axes is read back. An axis lagging behind the path,
+    in its direction of travel, is given gain times its lag, in mm/s per mm,
+    on top of its velocity, up to its max_velocity, to catch up. Axes ahead
+    of the path are not slowed down.
+
+    sample(index, point), if given, is called every spacing mm along the
+    path, with the world point the stage should be at, while the stage keeps
+    moving. It runs on the control thread, so it should be quick. Its return
+    values are collected in ContourResult.samples.
+
+    settle is the policy used when stopping at the end of the path, see
+    Controller.goto().
+    """
+    super(ContourRunner, self).__init__()
+    if speed <= 0:
+      raise ValueError('speed must be positive')
+    if sample is not None and not spacing:
+      raise ValueError('sample needs a spacing')
+    self.group = group
+    self.path = path
+    self.speed = speed
+    self.rate = rate
+    self.lookahead = lookahead
+    self.gain = gain
+    self.sample = sample
+    self.spacing = spacing
+    self.settle = settle
+
+  def _stage_velocity(self, s, ds):
+    """
+    Returns the signed velocity of every stage axis at arc length s, at
+    self.speed
+    """
+    a = self.group.to_stage(self.path.point(s))
+    b = self.group.to_stage(self.path.point(min(s + ds, self.path.length)))
+    d = min(ds, self.path.length - s) or ds
+    return [(y - x) / d * self.speed for x, y in zip(a, b)]
+
+  def check(self):
+    """
+    Checks that the whole path is within the range of every axis, and that
+    no axis would have to move faster than its max_velocity. Raises
+    OutOfRangeError or ValueError.
+    """
+    cons = self.group.controllers
+    ds = self.speed / self.rate
+    n = max(2, int(math.ceil(self.path.length / ds)))
+    worst = [0.0] * len(cons)
+    for k in range(n + 1):
+      s = self.path.length * k / n
+      for con, pos in zip(cons, self.group.to_stage(self.path.point(s))):
+        if con.soft_limits and not con._position_in_range(pos):
+          raise OutOfRangeError(pos, con.linear_range)
+      worst = [max(w, abs(v))
+               for w, v in zip(worst, self._stage_velocity(s, ds))]
+    for con, w in zip(cons, worst):
+      if w > con.max_velocity * 1.000001:
+        raise ValueError('%s would need %.4f/s, more than its max_velocity '
+                         'of %.4f/s; the speed can be at most %.4f'%(
+                         con.serial_number, w, con.max_velocity,
+                         self.speed * con.max_velocity / w))
+
+  def _lead(self):
+    """
+    Arc length ahead of the path position the axes are sent to: lookahead
+    ticks, plus the longest distance any axis needs to stop, so none of
+    them starts decelerating before it is retargeted
+    """
+    acc = min(con.max_acceleration for con in self.group.controllers)
+    return (self.lookahead * self.speed / self.rate +
+            self.speed * self.speed / (2 * acc))
+
+  def run(self):
+    """
+    Moves to the start of the path, follows it and stops at its end.
+    Returns a ContourResult. If anything fails all axes are stopped.
+    """
+    group = self.group
+    path = self.path
+    self.check()
+    group.move(path.point(0), settle=self.settle)
+
+    cons = group.controllers
+    channels = [a.channel for a in group.axes]
+    suspend = message.Message(message.MGMSG_MOT_SUSPEND_ENDOFMOVEMSGS)
+    ds = self.speed / self.rate
+    lead = self._lead()
+    period = 1.0 / self.rate
+    tracking = []
+    samples = []
+    next_sample = 0
+    # how far every axis was behind the path at the last status read, along
+    # its direction of travel, so negative when ahead
+    lag = [0.0] * len(cons)
+
+    try:
+      for con in cons:
+        con.write_frames([(suspend.messageID, suspend.pack())])
+
+      t0 = clock()
+      tick = 0
+      while True:
+        now = clock()
+        s = self.speed * (now - t0)
+        if s >= path.length:
+          break
+
+        # command every axis: its share of the speed, and a target ahead
+        target = group.to_stage(path.point(s + lead))
+        velocity = self._stage_velocity(s, ds)
+        for con, ch, pos, v, l in zip(cons, channels, target, velocity, lag):
+          # a zero max velocity isn't allowed, and the axis then has
+          # nowhere to go anyway
+          v = min(max(abs(v) + self.gain * max(l, 0.0),
+                      con.max_velocity * 1e-3),
+                  con.max_velocity)
+          con.write_frames(con.velocity_frames(None, v, ch) +
+                           con.move_frames(pos, ch))
+
+        # read back where the stage actually is
+        statuses = group.status()
+        ts = clock() - t0
+        stage = [float(st.position_apt) / st.position_scale
+                 for st in statuses]
+        measured = group.to_world(stage)
+        s_at = min(self.speed * ts, path.length)
+        # an axis the path holds still can't be ahead, only off
+        lag = [(x - y) if v > 0 else (y - x) if v < 0 else abs(x - y)
+               for x, y, v in zip(group.to_stage(path.point(s_at)), stage,
+                                  self._stage_velocity(s_at, ds))]
+        following = _distance(measured, path.point(s_at))
+        contour = path.closest(measured, s_at, following + lead)[1]
+        tracking.append(ContourSample(ts, s_at, measured, following, contour))
+
+        # samples due by now, then sleep until the next tick or sample,
+        # whichever comes first, on absolute times so nothing drifts
+        tick += 1
+        while True:
+          if self.sample is not None:
+            due = self.speed * (clock() - t0)
+            while (next_sample * self.spacing <= min(due, path.length)):
+              ss = next_sample * self.spacing
+              samples.append((next_sample, ss,
+                              self.sample(next_sample, path.point(ss))))
+              next_sample += 1
+          wake = tick * period
+          if (self.sample is not None and
+              next_sample * self.spacing <= path.length):
+            wake = min(wake, next_sample * self.spacing / self.speed)
+          sleep_until(t0 + wake)
+          if wake >= tick * period:
+            break
+
+      # stop at the end of the path, with end of move messages back on. The
+      # axes are already headed there, but at the tangent velocity of the
+      # end of the path, which is all but zero for some of them, so they
+      # catch up at their usual velocity
+      end = group.to_stage(path.point(path.length))
+      velocities = [con.max_velocity for con in cons]
+      group.last_start = synchronized_start(cons, end, channels, velocities,
+                                            settle=self.settle,
+                                            parallel=group.parallel_start)
+      duration = clock() - t0
+
+      # samples at the very end of the path
+      if self.sample is not None:
+        while next_sample * self.spacing <= path.length + 1e-9:
+          ss = next_sample * self.spacing
+          samples.append((next_sample, ss,
+                          self.sample(next_sample, path.point(ss))))
+          next_sample += 1
+    except BaseException:
+      stop_all(cons, immediate=True, wait=False, channel=channels)
+      raise
+    finally:
+      for con, ch in zip(cons, channels):
+        con.set_velocity_parameters(channel=ch)
+
+    return ContourResult(path, self.speed, duration, tracking, samples)
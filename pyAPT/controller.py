@@ -3,55 +3,131 @@ Simple class which encapsulate an APT controller
 """
 from __future__ import absolute_import, division
 import pylibftdi
+import threading
 import time
 import struct as st
+from collections import deque
+from contextlib import contextmanager
 
 from .message import Message
 from . import message
+from . import instrument
+from . import trace
+from .settle import GOTO_DEFAULT, STOP_DEFAULT
+from .msgqueue import MessageQueue
+from . import tuning
+
+# messages that end a move. Every thread waiting for the end of a move on a
+# channel gets them, see Controller._wait_end_of_move()
+END_OF_MOVE_IDS = (message.MGMSG_MOT_MOVE_COMPLETED,
+                   message.MGMSG_MOT_MOVE_STOPPED,
+                   message.MGMSG_MOT_MOVE_HOMED)
+
+def _end_of_move_channel(m):
+  # MOVE_COMPLETED and MOVE_STOPPED carry a status starting with the channel,
+  # MOVE_HOMED has it in param1
+  if m.data:
+    return m.data[0] | (m.data[1] << 8)
+  return m.param1
 
 class OutOfRangeError(Exception):
   def __init__(self, requested, allowed):
     val = '%f requested, but allowed range is %.2f..%.2f'%(requested, allowed[0], allowed[1])
     super(OutOfRangeError, self).__init__(val)
 
-class Controller(object):
-  def __init__(self, serial_number=None, label=None):
-    super(Controller, self).__init__()
+class ReplyTimeoutError(Exception):
+  """
+  Raised when an expected message does not arrive in time
+  """
+  def __init__(self, messageIDs, timeout):
+    names = ', '.join(message.message_name(i) for i in messageIDs)
+    val = 'No %s within %.3fs'%(names, timeout)
+    super(ReplyTimeoutError, self).__init__(val)
+    self.messageIDs = messageIDs
+    self.timeout = timeout
 
-    if type(serial_number) == bytes:
-      serial_number = serial_number.decode()
+class _ReadTimeout(Exception):
+  pass
+
+class MotionError(Exception):
+  """
+  Base of the errors raised when a move goes wrong. Carries the serial
+  number of the controller, the operation ('goto', 'home' or 'stop'), its
+  target if any, the last status read, if any, and how long the operation
+  had been waiting, in seconds.
+  """
+  def __init__(self, reason, controller, operation, target=None, status=None,
+               elapsed=None):
+    val = '%s: %s'%(controller.serial_number, reason)
+    if target is not None:
+      val += ', %s to %.4f'%(operation, target)
     else:
-      serial_number = str(serial_number)
+      val += ', %s'%(operation)
+    if elapsed is not None:
+      val += ' after %.3fs'%(elapsed)
+    if status is not None:
+      val += ', %s'%(status)
+    super(MotionError, self).__init__(val)
+    self.serial_number = controller.serial_number
+    self.operation = operation
+    self.target = target
+    self.status = status
+    self.elapsed = elapsed
+
+class MoveTimeoutError(MotionError):
+  """
+  The move did not finish by its deadline, e.g. because the stage stalled
+  """
 
-    # this takes up to 2-3s:
-    dev = pylibftdi.Device(mode='b', device_id=serial_number)
-    dev.baudrate = 115200
+class MotionFaultError(MotionError):
+  """
+  The controller flagged excessive position error or reached its motor
+  current limit while moving
+  """
 
-    def _checked_c(ret):
-      if not ret == 0:
-        raise Exception(dev.ftdi_fn.ftdi_get_error_string())
+class MoveStoppedError(MotionError):
+  """
+  The move was stopped, e.g. by an emergency stop from another thread,
+  before it completed
+  """
 
-    _checked_c(dev.ftdi_fn.ftdi_set_line_property(  8,   # number of bits
-                                                    1,   # number of stop bits
-                                                    0   # no parity
-                                                    ))
-    time.sleep(50.0/1000)
+class _DetachedDevice(object):
+  """
+  Stands in for the device of a controller whose device has been handed over
+  to another controller, see Controller.detach_device()
+  """
+  closed = True
 
-    dev.flush(pylibftdi.FLUSH_BOTH)
+  def close(self):
+    pass
 
-    time.sleep(50.0/1000)
+class Controller(object):
+  def __init__(self, serial_number=None, label=None, device=None,
+               use_tuned_profile=True):
+    """
+    Opens the FTDI device with the given serial number.
 
-    # skipping reset part since it looks like pylibftdi does it already
+    device may be given instead to talk to something other than a real FTDI
+    device, for example a trace.ReplayDevice. It needs to provide read(),
+    write(), flush(), close() and a closed attribute like pylibftdi.Device.
 
-    # this is pulled from ftdi.h
-    SIO_RTS_CTS_HS = (0x1 << 8)
-    _checked_c(dev.ftdi_fn.ftdi_setflowctrl(SIO_RTS_CTS_HS))
+    If use_tuned_profile is True, velocity and acceleration limits found by
+    tuning.tune() for this serial number replace the built-in conservative
+    ones, see apply_tuned_profile().
+    """
+    super(Controller, self).__init__()
 
-    _checked_c(dev.ftdi_fn.ftdi_setrts(1))
+    if type(serial_number) == bytes:
+      serial_number = serial_number.decode()
+    else:
+      serial_number = str(serial_number)
+
+    if device is None:
+      device = self._open_device(serial_number)
 
     self.serial_number = serial_number
     self.label = label
-    self._device = dev
+    self._device = device
 
     # some conservative limits
     # velocity is in mm/s
@@ -59,6 +135,12 @@ class Controller(object):
     self.max_velocity = 0.3
     self.max_acceleration = 0.3
 
+    # channel -> (acceleration, max velocity) last sent with
+    # set_velocity_parameters() or write_frames(), or read with
+    # velocity_parameters(), from which the deadlines of moves are
+    # estimated. Channels not in it are assumed to move at the limits above
+    self._velocity_params = {}
+
     # these define how encode count translates into position, velocity
     # and acceleration. e.g. 1 mm is equal to 1 * self.position_scale
 
@@ -75,10 +157,100 @@ class Controller(object):
     # whether or not sofware limit in position is applied
     self.soft_limits = True
 
+    # cache.ControllerCache this controller records its last known state to
+    # when closed, and takes its homing parameters from, if any. See
+    # cache.open_controller()
+    self.cache = None
+
+    # the tuned profile in use, if any. See apply_tuned_profile()
+    self.use_tuned_profile = use_tuned_profile
+    self.tuned_profile = None
+
     # the message queue are messages that are sent asynchronously. For example
     # if we performed a move, and are waiting for move completed message,
     # any other message received in the mean time are place in the queue.
-    self.message_queue = []
+    # It is indexed by message ID and bounded, see msgqueue.MessageQueue,
+    # and is checked by _wait_message() before reading from the device.
+    self.message_queue = MessageQueue()
+
+    # instance of instrument.Instrumentation when instrumentation is enabled,
+    # None otherwise. See enable_instrumentation()
+    self.instrumentation = None
+
+    # Controllers can be shared between threads, e.g. one moving the stage
+    # while another polls status. Writes are serialised by _tx_lock, and
+    # each frame is written whole. Only one thread at a time reads from the
+    # device, and it routes messages meant for other threads through
+    # message_queue, which is guarded by _rx_cond, see _wait_message().
+    # Queries with the same reply ID are serialised by _query_locks, since
+    # their replies can't be told apart.
+    self._tx_lock = threading.Lock()
+    self._rx_cond = threading.Condition()
+    self._rx_reading = False
+    self._query_locks = {}
+
+    # End of move messages aren't queued but logged, numbered in order of
+    # arrival, so that a stop() and the goto() it interrupts both see the
+    # MOVE_STOPPED. _end_of_move_floor holds, per message ID, the number of
+    # the last message discard_messages() discarded. Guarded by _rx_cond.
+    self._end_of_move = deque(maxlen=64)
+    self._end_of_move_seq = 0
+    self._end_of_move_floor = {}
+
+    # per thread state: the batch in progress, see batch()
+    self._local = threading.local()
+
+    # Moves that take longer than deadline_factor times what their velocity
+    # profile predicts, plus deadline_margin seconds, are aborted with
+    # MoveTimeoutError. While waiting, status is polled every
+    # fault_poll_interval seconds, and moves whose status shows a fault are
+    # aborted with MotionFaultError. None disables either check.
+    self.deadline_factor = 2.0
+    self.deadline_margin = 1.0
+    self.fault_poll_interval = 0.05
+
+    # seconds close() waits for the status it records into the cache, so a
+    # controller that stopped answering doesn't hang it
+    self.close_timeout = 0.5
+
+    # worst case distance of homing, used for its deadline. None means the
+    # span of linear_range
+    self.homing_distance = None
+
+    # settle.SettlePolicy used by goto() and stop() when none is passed to
+    # them. None means settle.GOTO_DEFAULT and settle.STOP_DEFAULT
+    # respectively, which wait for zero velocity
+    self.settle_policy = None
+
+  @staticmethod
+  def _open_device(serial_number):
+    # this takes up to 2-3s:
+    dev = pylibftdi.Device(mode='b', device_id=serial_number)
+    dev.baudrate = 115200
+
+    def _checked_c(ret):
+      if not ret == 0:
+        raise Exception(dev.ftdi_fn.ftdi_get_error_string())
+
+    _checked_c(dev.ftdi_fn.ftdi_set_line_property(  8,   # number of bits
+                                                    1,   # number of stop bits
+                                                    0   # no parity
+                                                    ))
+    time.sleep(50.0/1000)
+
+    dev.flush(pylibftdi.FLUSH_BOTH)
+
+    time.sleep(50.0/1000)
+
+    # skipping reset part since it looks like pylibftdi does it already
+
+    # this is pulled from ftdi.h
+    SIO_RTS_CTS_HS = (0x1 << 8)
+    _checked_c(dev.ftdi_fn.ftdi_setflowctrl(SIO_RTS_CTS_HS))
+
+    _checked_c(dev.ftdi_fn.ftdi_setrts(1))
+
+    return dev
 
   def __enter__(self):
     return self
@@ -93,17 +265,214 @@ class Controller(object):
     if not self._device.closed:
       # print 'Closing connnection to controller',self.serial_number
       self.stop(wait=False)
+      if self.cache is not None:
+        self.cache.record_state(self, timeout=self.close_timeout)
       # XXX we might want a timeout here, or this will block forever
       self._device.close()
+    self.stop_trace()
+
+  def apply_tuned_profile(self, directory=None):
+    """
+    Loads the velocity/acceleration profile saved by tuning.tune() for this
+    controller's serial number, and uses its limits as max_velocity and
+    max_acceleration. Profiles tuned with a different controller class are
+    ignored.
+
+    Subclasses call this at the end of __init__, once their default limits
+    are set. Returns the profile applied, or None.
+    """
+    if not self.use_tuned_profile:
+      return None
+
+    profile = tuning.load_profile(self.serial_number, directory)
+    if not profile or profile.get('model') != type(self).__name__:
+      return None
+    if profile.get('max_velocity') is None:
+      return None
+
+    self.max_velocity = profile['max_velocity']
+    self.max_acceleration = profile['max_acceleration']
+    self.tuned_profile = profile
+    return profile
+
+  def detach_device(self):
+    """
+    Returns the open device of this controller, leaving this controller
+    unusable, so that the device can be passed to another controller, e.g.
+    of the right subclass, without closing and reopening it.
+    """
+    self.stop_trace()
+    dev = self._device
+    self._device = _DetachedDevice()
+    return dev
+
+  def enable_instrumentation(self, instrumentation=None):
+    """
+    Starts recording message counters, latencies, bytes on the wire and time
+    spent sleeping. If instrumentation is None a new instance of
+    instrument.Instrumentation is created, otherwise the given instance is
+    used, which allows several controllers to aggregate into one.
+
+    Returns the instrumentation instance in use.
+    """
+    if instrumentation is None:
+      instrumentation = instrument.Instrumentation()
+    self.instrumentation = instrumentation
+    return instrumentation
+
+  def disable_instrumentation(self):
+    """
+    Stops recording, and returns the instrumentation that was in use, if any.
+    """
+    instr = self.instrumentation
+    self.instrumentation = None
+    return instr
+
+  def start_trace(self, trace_file):
+    """
+    Starts capturing every byte written to and read from the device, with
+    timestamps, into trace_file, which is either a filename or an instance of
+    trace.TraceWriter. The capture can be fed back to a controller later
+    using trace.ReplayDevice.
+
+    Returns the trace.TraceWriter in use.
+    """
+    self.stop_trace()
+    writer = trace_file
+    if not isinstance(writer, trace.TraceWriter):
+      writer = trace.TraceWriter(trace_file, serial_number=self.serial_number)
+    self._device = trace.TracingDevice(self._device, writer)
+    return writer
+
+  def stop_trace(self):
+    """
+    Stops capturing, closing the trace file. Does nothing if no capture is in
+    progress.
+    """
+    if isinstance(self._device, trace.TracingDevice):
+      self._device.writer.close()
+      self._device = self._device.device
+
+  def span(self, name):
+    """
+    Returns a context manager timing the enclosed block under name when
+    instrumentation is enabled, and a no-op context manager otherwise.
+    """
+    if self.instrumentation is None:
+      return instrument.NULL_SPAN
+    return self.instrumentation.span(name)
+
+  def _sleep(self, seconds):
+    """
+    time.sleep() that accounts for the time slept when instrumented
+    """
+    instr = self.instrumentation
+    if instr is None:
+      time.sleep(seconds)
+    else:
+      st = instrument.now_ns()
+      time.sleep(seconds)
+      instr.record_sleep(instrument.now_ns() - st)
+
+  @contextmanager
+  def batch(self):
+    """
+    Context manager that coalesces all messages sent inside it into a single
+    write to the device, in order, made on exit. Every write is a separate
+    USB transaction with a fixed cost, so this cuts the latency of operations
+    made of several messages, e.g.
+
+      with con.batch():
+        con.resume_end_of_move_messages()
+        con.goto(10, wait=False)
+
+    Batches nest, only the outermost one writes. Waiting for a reply inside
+    a batch sends what has been queued so far first. If the block raises, the
+    queued messages are discarded. Batches are per thread, so other threads
+    sharing the controller are not caught up in them.
+    """
+    if self._tx_batch is not None:
+      yield self
+      return
+
+    self._tx_batch = []
+    try:
+      yield self
+    except:
+      self._tx_batch = None
+      raise
+    self._flush_batch()
+    self._tx_batch = None
+
+  @property
+  def _tx_batch(self):
+    """
+    Frames queued by _send_message() inside batch() on this thread, as a list
+    of (messageID, bytes), or None when not batching
+    """
+    return getattr(self._local, 'batch', None)
+
+  @_tx_batch.setter
+  def _tx_batch(self, frames):
+    self._local.batch = frames
+
+  def _flush_batch(self):
+    """
+    Writes the messages queued by batch() so far, if any
+    """
+    frames = self._tx_batch
+    if not frames:
+      return
+    self._tx_batch = []
+    self.write_frames(frames)
+
+  def write_frames(self, frames):
+    """
+    Writes frames, a list of (messageID, bytes) as returned by stop_frames(),
+    to the device in a single write, bypassing any batch in progress.
+    """
+    data = b''.join(f for _, f in frames)
+    instr = self.instrumentation
+    with self._tx_lock:
+      if instr is None:
+        self._device.write(data)
+      else:
+        st = instrument.now_ns()
+        self._device.write(data)
+        instr.record_batch(frames, instrument.now_ns() - st)
+    self._note_velocity_frames(frames)
+
+  def _note_velocity_frames(self, frames):
+    """
+    Records the velocity parameters sent in frames, for profile_time()
+    """
+    for messageID, frame in frames:
+      if messageID == message.MGMSG_MOT_SET_VELPARAMS:
+        # skip the 6 byte header, see _velocity_message() for the data
+        ch, _, acc, max_vel = st.unpack('<Hiii', frame[6:])
+        self._velocity_params[ch] = (acc / self.acceleration_scale,
+                                     max_vel / self.velocity_scale)
 
   def _send_message(self, m):
     """
     m should be an instance of Message, or has a pack() method which returns
     bytes to be sent to the controller
     """
-    self._device.write(m.pack())
+    if self._tx_batch is not None:
+      self._tx_batch.append((m.messageID, m.pack()))
+      return
+
+    data = m.pack()
+    instr = self.instrumentation
+    with self._tx_lock:
+      if instr is None:
+        self._device.write(data)
+      else:
+        st = instrument.now_ns()
+        self._device.write(data)
+        instr.record_send(m.messageID, len(data), instrument.now_ns() - st)
 
-  def _read(self, length, block=True):
+  def _read(self, length, block=True, deadline=None):
     """
     If block is True, then we will return only when have have length number of
     bytes. Otherwise we will perform a read, then immediately return with
@@ -111,6 +480,10 @@ class Controller(object):
 
     Note that if no data is available, then an empty byte string will be
     returned.
+
+    deadline is a time.time() value. If nothing at all has been read by
+    then, _ReadTimeout is raised. Once some data has arrived the rest
+    is always waited for, so messages are never cut in half.
     """
     data = bytes()
     while len(data) < length:
@@ -119,12 +492,18 @@ class Controller(object):
       if not block:
         break
 
-      time.sleep(0.001)
+      if len(data) < length:
+        if not data and deadline is not None and time.time() > deadline:
+          raise _ReadTimeout()
+        self._sleep(0.001)
+
+    if self.instrumentation is not None:
+      self.instrumentation.record_read(len(data))
 
     return data
 
-  def _read_message(self):
-    data = self._read(message.MGMSG_HEADER_SIZE)
+  def _read_message(self, deadline=None):
+    data = self._read(message.MGMSG_HEADER_SIZE, deadline=deadline)
     msg = Message.unpack(data, header_only=True)
     if msg.hasdata:
       data = self._read(msg.datalength)
@@ -133,44 +512,246 @@ class Controller(object):
       return Message._make(msglist)
     return msg
 
-  def _wait_message(self, expected_messageID):
-    found = False
-    while not found:
-      m = self._read_message()
-      found = m.messageID == expected_messageID
-      if found:
+  def _wait_message(self, expected_messageID, timeout=None):
+    """
+    Returns the next message with the given ID, taking it from
+    self.message_queue if one arrived earlier, otherwise reading messages
+    from the device until it arrives. Other messages read in the mean time
+    are put into self.message_queue, except end of move messages, which are
+    waited for with _wait_end_of_move().
+
+    When several threads wait at the same time, one of them reads for all,
+    and the others pick their messages from the queue as they arrive.
+
+    expected_messageID may also be a tuple of IDs, in which case the first
+    message with any of them is returned.
+
+    If timeout is not None, ReplyTimeoutError is raised if no such message
+    arrives within timeout seconds.
+    """
+    if isinstance(expected_messageID, tuple):
+      expected = expected_messageID
+    else:
+      expected = (expected_messageID, )
+
+    def take():
+      for messageID in expected:
+        m = self.message_queue.pop(messageID)
+        if m is not None:
+          return m
+      return None
+
+    return self._receive(expected, take, timeout)
+
+  def _end_of_move_since(self, messageIDs):
+    """
+    Returns the dict of message ID -> number of the last end of move message
+    discarded, for _wait_end_of_move()
+    """
+    with self._rx_cond:
+      return dict((messageID, self._end_of_move_floor.get(messageID, 0))
+                  for messageID in messageIDs)
+
+  def _wait_end_of_move(self, messageIDs, channel=1, since=None,
+                        timeout=None):
+    """
+    Returns the first end of move message for channel, with one of
+    messageIDs, that arrived after the last one discard_messages() discarded,
+    or after since, as returned by _end_of_move_since(). Unlike other
+    messages, end of move messages are not taken away by the thread that
+    gets them: every thread waiting on the channel gets them.
+
+    If timeout is not None, ReplyTimeoutError is raised if no such message
+    arrives within timeout seconds.
+    """
+    if since is None:
+      since = self._end_of_move_since(messageIDs)
+
+    def take():
+      for seq, m in self._end_of_move:
+        if (m.messageID in since and seq > since[m.messageID] and
+            _end_of_move_channel(m) == channel):
+          return m
+      return None
+
+    return self._receive(tuple(messageIDs), take, timeout)
+
+  def _receive(self, expected, take, timeout):
+    """
+    Waits for a message for _wait_message() or _wait_end_of_move(). take()
+    is called with _rx_cond held, and returns the message waited for if it
+    has arrived, None otherwise. Messages read from the device with one of
+    the expected IDs are returned directly, others are queued or logged.
+    """
+    instr = self.instrumentation
+    if instr is not None:
+      st = instrument.now_ns()
+
+    # the request we are waiting on may still be queued in a batch
+    if self._tx_batch:
+      self._flush_batch()
+
+    deadline = None
+    if timeout is not None:
+      deadline = time.time() + timeout
+
+    with self._rx_cond:
+      while True:
+        m = take()
+        if m is not None:
+          if instr is not None:
+            instr.record_wait(m.messageID, instrument.now_ns() - st)
+          return m
+        if not self._rx_reading:
+          break
+        # another thread is reading, and will wake us for every message it
+        # queues
+        if deadline is None:
+          self._rx_cond.wait()
+        else:
+          remaining = deadline - time.time()
+          if remaining <= 0:
+            raise ReplyTimeoutError(expected, timeout)
+          self._rx_cond.wait(remaining)
+      self._rx_reading = True
+
+    try:
+      while True:
+        try:
+          m = self._read_message(deadline)
+        except _ReadTimeout:
+          raise ReplyTimeoutError(expected, timeout)
+        if instr is not None:
+          instr.record_receive(m.messageID)
+
+        if m.messageID in END_OF_MOVE_IDS:
+          with self._rx_cond:
+            self._end_of_move_seq += 1
+            self._end_of_move.append((self._end_of_move_seq, m))
+            self._rx_cond.notify_all()
+            m = take()
+          if m is None:
+            continue
+        elif m.messageID not in expected:
+          if instr is not None:
+            instr.record_queued(m.messageID)
+          with self._rx_cond:
+            self.message_queue.append(m)
+            self._rx_cond.notify_all()
+          continue
+
+        if instr is not None:
+          instr.record_wait(m.messageID, instrument.now_ns() - st)
         return m
-      else:
-        self.message_queue.append(m)
+    finally:
+      with self._rx_cond:
+        self._rx_reading = False
+        self._rx_cond.notify_all()
+
+  def discard_messages(self, *messageIDs):
+    """
+    Discards queued messages with any of the given IDs, e.g. stale end of
+    move messages before starting a move. End of move messages are only
+    discarded for waits started after this, so a thread already waiting for
+    the end of a move still gets them.
+    """
+    with self._rx_cond:
+      for messageID in messageIDs:
+        if messageID in END_OF_MOVE_IDS:
+          self._end_of_move_floor[messageID] = self._end_of_move_seq
+        else:
+          self.message_queue.discard(messageID)
+
+  def _query(self, reqmsg, reply_messageID, timeout=None):
+    """
+    Sends reqmsg and returns the reply with reply_messageID. Replies of the
+    same type that were queued before the request are stale, so they are
+    discarded first.
 
-  def _position_in_range(self, absolute_pos_mm):
+    If timeout is not None, ReplyTimeoutError is raised if the reply doesn't
+    arrive within timeout seconds.
+    """
+    lock = self._query_locks.get(reply_messageID)
+    if lock is None:
+      lock = self._query_locks.setdefault(reply_messageID, threading.Lock())
+
+    with lock:
+      self.discard_messages(reply_messageID)
+      self._send_message(reqmsg)
+      return self._wait_message(reply_messageID, timeout)
+
+  def _position_in_range(self, absolute_pos_mm, limits=None):
     """
     Returns True if requested absolute position is within range, False
-    otherwise
+    otherwise. The range is limits, a (min, max) tuple, or
+    self.linear_range if that is None.
     """
+    if limits is None:
+      limits = self.linear_range
+
     # get rid of floating point artifacts below our resolution
     enccnt = int(absolute_pos_mm * self.position_scale)
     absolute_pos_mm = enccnt / self.position_scale
 
-    if absolute_pos_mm < self.linear_range[0]:
+    if absolute_pos_mm < limits[0]:
       return False
 
-    if absolute_pos_mm > self.linear_range[1]:
+    if absolute_pos_mm > limits[1]:
       return False
 
     return True
 
-  def status(self, channel=1):
+  def to_apt(self, values, kind='position'):
+    """
+    Converts an array of positions (mm), velocities (mm/s) or accelerations
+    (mm/s^2), as given by kind, to integer APT units in one go. Requires
+    NumPy, see units.
+    """
+    from . import units
+    return units.to_apt(values, units.scale_of(self, kind))
+
+  def from_apt(self, values, kind='position'):
+    """
+    Converts an array of APT units back to real world units. Velocities
+    are scaled like velocity_parameters() does, not like ControllerStatus.
+    """
+    from . import units
+    return units.from_apt(values, units.scale_of(self, kind))
+
+  def quantize(self, positions):
+    """
+    Returns an array of positions, in mm, rounded to what goto() would
+    actually send
+    """
+    from . import units
+    return units.quantize(positions, self.position_scale)
+
+  def out_of_range(self, positions, mask=False):
+    """
+    Checks a whole array of positions, in mm, against self.linear_range the
+    way goto() does, and returns the indices of those outside it, or a
+    boolean array that is True for them if mask is True. Requires NumPy.
+    """
+    from . import units
+    if mask:
+      return units.range_mask(positions, self.linear_range,
+                              self.position_scale)
+    return units.out_of_range(positions, self.linear_range,
+                              self.position_scale)
+
+  def status(self, channel=1, timeout=None):
     """
     Returns the status of the controller, which is its position, velocity, and
     statusbits
 
     Position and velocity will be in mm and mm/s respectively.
+
+    If timeout is not None, ReplyTimeoutError is raised if the controller
+    doesn't answer within timeout seconds.
     """
     reqmsg = Message(message.MGMSG_MOT_REQ_DCSTATUSUPDATE, param1=channel)
-    self._send_message(reqmsg)
-
-    getmsg = self._wait_message(message.MGMSG_MOT_GET_DCSTATUSUPDATE)
+    getmsg = self._query(reqmsg, message.MGMSG_MOT_GET_DCSTATUSUPDATE,
+                         timeout)
     return ControllerStatus(self, getmsg.datastring)
 
   def identify(self):
@@ -190,11 +771,20 @@ class Controller(object):
     resetmsg = Message(message.MGMSG_MOT_SET_PZSTAGEPARAMDEFAULTS)
     self._send_message(resetmsg)
 
-  def request_home_params(self):
-    reqmsg = Message(message.MGMSG_MOT_REQ_HOMEPARAMS)
-    self._send_message(reqmsg)
+  def request_home_params(self, channel=1, refresh=False):
+    """
+    Returns the homing parameters of channel as a tuple of channel, home
+    direction, limit switch, homing velocity and offset distance, in APT
+    units. If this controller has a cache, they are taken from it unless
+    refresh is True, and are queried and cached otherwise.
+    """
+    if self.cache is not None and not refresh:
+      params = self.cache.home_params(self.serial_number, channel)
+      if params is not None:
+        return params
 
-    getmsg = self._wait_message(message.MGMSG_MOT_GET_HOMEPARAMS)
+    reqmsg = Message(message.MGMSG_MOT_REQ_HOMEPARAMS, param1=channel)
+    getmsg = self._query(reqmsg, message.MGMSG_MOT_GET_HOMEPARAMS)
     dstr = getmsg.datastring
 
     """
@@ -205,7 +795,10 @@ class Controller(object):
     i: 4 bytes for homing velocity
     i: 4 bytes for offset distance
     """
-    return st.unpack('<HHHii', dstr)
+    params = st.unpack('<HHHii', dstr)
+    if self.cache is not None:
+      self.cache.record_home_params(self.serial_number, params, channel)
+    return params
 
   def suspend_end_of_move_messages(self):
       suspendmsg = Message(message.MGMSG_MOT_SUSPEND_ENDOFMOVEMSGS)
@@ -215,8 +808,10 @@ class Controller(object):
       resumemsg = Message(message.MGMSG_MOT_RESUME_ENDOFMOVEMSGS)
       self._send_message(resumemsg)
 
-  def home(self, wait=True, velocity=None, offset=0):
+  def home(self, wait=True, velocity=None, offset=0, channel=1):
     """
+    Homes the motor on the specified channel.
+
     When velocity is not None, homing parameters will be set so homing velocity
     will be as given, in mm per second.
 
@@ -242,13 +837,13 @@ class Controller(object):
     # documented, we get the current parameters, assuming they are correct,
     # and then modify only the velocity and offset component, then send it 
     # back to the controller.
-    curparams = list(self.request_home_params())
+    curparams = list(self.request_home_params(channel))
 
     # make sure we never exceed the limits of our stage
 
     offset = min(offset, self.linear_range[1])
     offset = max(offset, 0)
-    offset_apt = offset * self.position_scale
+    offset_apt = int(offset * self.position_scale)
 
     """
     <: little endian
@@ -268,25 +863,43 @@ class Controller(object):
     newparams= st.pack( '<HHHii',*curparams)
 
     homeparamsmsg = Message(message.MGMSG_MOT_SET_HOMEPARAMS, data=newparams)
-    self._send_message(homeparamsmsg)
+    homemsg = Message(message.MGMSG_MOT_MOVE_HOME, param1=channel)
+    self.discard_messages(message.MGMSG_MOT_MOVE_HOMED)
 
-    if wait:
-      self.resume_end_of_move_messages()
-    else:
-      self.suspend_end_of_move_messages()
+    with self.batch():
+      self._send_message(homeparamsmsg)
+      if self.cache is not None:
+        self.cache.record_home_params(self.serial_number, curparams, channel)
 
-    homemsg = Message(message.MGMSG_MOT_MOVE_HOME)
-    self._send_message(homemsg)
+      if wait:
+        self.resume_end_of_move_messages()
+      else:
+        self.suspend_end_of_move_messages()
+
+      self._send_message(homemsg)
 
     if wait:
-      self._wait_message(message.MGMSG_MOT_MOVE_HOMED)
-      return self.status()
+      # at worst the stage travels its whole range, and the offset, at the
+      # homing velocity
+      distance = self.homing_distance
+      if distance is None:
+        distance = self.linear_range[1] - self.linear_range[0]
+      velocity = curparams[-2] / self.velocity_scale or self.max_velocity
+      duration = self.move_time(distance + offset, velocity)
+      # homing is what clears a latched fault, so faults aren't checked
+      msg = self._wait_motion('home', (message.MGMSG_MOT_MOVE_HOMED,
+                                       message.MGMSG_MOT_MOVE_STOPPED),
+                              duration=duration, channel=channel,
+                              check_faults=False)
+      sts = self.status(channel)
+      if msg.messageID == message.MGMSG_MOT_MOVE_STOPPED:
+        raise MoveStoppedError('stopped before homing', self, 'home',
+                               status=sts)
+      return sts
 
   def position(self, channel=1, raw=False):
     reqmsg = Message(message.MGMSG_MOT_REQ_POSCOUNTER, param1=channel)
-    self._send_message(reqmsg)
-
-    getmsg = self._wait_message(message.MGMSG_MOT_GET_POSCOUNTER)
+    getmsg = self._query(reqmsg, message.MGMSG_MOT_GET_POSCOUNTER)
     dstr = getmsg.datastring
 
     """
@@ -302,7 +915,7 @@ class Controller(object):
     else:
       return pos_apt
 
-  def goto(self, abs_pos_mm, channel=1, wait=True):
+  def goto(self, abs_pos_mm, channel=1, wait=True, settle=None):
     """
     Tells the stage to goto the specified absolute position, in mm.
 
@@ -312,8 +925,10 @@ class Controller(object):
     that it has finished moving.
 
     Note that the wait is implemented by waiting for MGMSG_MOT_MOVE_COMPLETED,
-    then querying status until the position returned matches the requested
-    position, and velocity is zero
+    then querying status until the settle policy is satisfied. settle is a
+    settle.SettlePolicy, and defaults to self.settle_policy, or waiting until
+    velocity is zero if that is None. settle.SettleTimeout is raised if the
+    policy times out.
 
     This method returns an instance of ControllerStatus if wait is True, None
     otherwise.
@@ -321,9 +936,44 @@ class Controller(object):
     If the requested position is beyond the limits defined in
     self.linear_range, and OutOfRangeError will be thrown.
     """
+    return self._goto(abs_pos_mm, channel, wait, settle)
 
-    if self.soft_limits and not self._position_in_range(abs_pos_mm):
-      raise OutOfRangeError(abs_pos_mm, self.linear_range)
+  def _goto(self, abs_pos_mm, channel=1, wait=True, settle=None, limits=None):
+    """
+    goto(), checking abs_pos_mm against limits instead of self.linear_range
+    if limits is not None
+    """
+    movemsg = self._move_message(abs_pos_mm, channel, limits)
+    self.discard_messages(message.MGMSG_MOT_MOVE_COMPLETED,
+                          message.MGMSG_MOT_MOVE_STOPPED)
+
+    with self.batch():
+      if wait:
+        self.resume_end_of_move_messages()
+      else:
+        self.suspend_end_of_move_messages()
+
+      self._send_message(movemsg)
+
+    if wait:
+      with self.span('goto.move'):
+        sts = self.wait_move_completed(abs_pos_mm, channel)
+      # I find sometimes that after the move completed message there is still
+      # some jittering. This aims to wait out the jittering so we are
+      # stationary when we return
+      policy = settle or self.settle_policy or GOTO_DEFAULT
+      with self.span('goto.settle'):
+        sts = policy.wait(self, sts, int(abs_pos_mm * self.position_scale),
+                          channel)
+      return sts
+    else:
+      return None
+
+  def _move_message(self, abs_pos_mm, channel=1, limits=None):
+    if limits is None:
+      limits = self.linear_range
+    if self.soft_limits and not self._position_in_range(abs_pos_mm, limits):
+      raise OutOfRangeError(abs_pos_mm, limits)
 
     abs_pos_apt = int(abs_pos_mm * self.position_scale)
 
@@ -334,28 +984,127 @@ class Controller(object):
     """
     params = st.pack( '<Hi', channel, abs_pos_apt)
 
-    if wait:
-      self.resume_end_of_move_messages()
-    else:
-      self.suspend_end_of_move_messages()
+    return Message(message.MGMSG_MOT_MOVE_ABSOLUTE,data=params)
 
-    movemsg = Message(message.MGMSG_MOT_MOVE_ABSOLUTE,data=params)
-    self._send_message(movemsg)
+  def move_frames(self, abs_pos_mm, channel=1):
+    """
+    Returns the MGMSG_MOT_MOVE_ABSOLUTE message goto() would send, packed,
+    as a list of (messageID, bytes) for write_frames(). Range checks are
+    done here, so a sequence of moves can be validated before any of them
+    is sent.
+    """
+    m = self._move_message(abs_pos_mm, channel)
+    return [(m.messageID, m.pack())]
 
-    if wait:
-      msg = self._wait_message(message.MGMSG_MOT_MOVE_COMPLETED)
-      sts = ControllerStatus(self, msg.datastring)
-      # I find sometimes that after the move completed message there is still
-      # some jittering. This aims to wait out the jittering so we are
-      # stationary when we return
-      while sts.velocity_apt:
-        time.sleep(0.01)
-        sts = self.status()
-      return sts
-    else:
+  def wait_move_completed(self, target=None, channel=1, duration=None):
+    """
+    Waits for MGMSG_MOT_MOVE_COMPLETED and returns the ControllerStatus it
+    carries. End of move messages must not be suspended.
+
+    target is the position moved to, in mm, from which the deadline of the
+    move is estimated, see _wait_motion(). duration, the time the move
+    should take in seconds, may be given instead, e.g. for moves slowed down
+    to finish together with others. Without either there is no deadline.
+
+    Raises MoveStoppedError if the move was stopped instead, and
+    MoveTimeoutError or MotionFaultError as _wait_motion() does.
+    """
+    msg = self._wait_motion('goto', (message.MGMSG_MOT_MOVE_COMPLETED,
+                                     message.MGMSG_MOT_MOVE_STOPPED),
+                            target=target, duration=duration, channel=channel)
+    sts = ControllerStatus(self, msg.datastring)
+    if msg.messageID == message.MGMSG_MOT_MOVE_STOPPED:
+      raise MoveStoppedError('stopped before completing', self, 'goto',
+                             target=target, status=sts)
+    return sts
+
+  def _deadline(self, duration):
+    """
+    Returns the time.time() by which an operation expected to take duration
+    seconds must be done, or None if deadlines are disabled
+    """
+    if self.deadline_factor is None or duration is None:
       return None
+    return time.time() + duration * self.deadline_factor + self.deadline_margin
 
-  def move(self, dist_mm, channel=1, wait=True):
+  def _abort_motion(self, channel=1):
+    """
+    Stops the motor immediately without waiting, ignoring errors since this
+    is called while handling one
+    """
+    try:
+      self.stop(channel, immediate=True, wait=False)
+    except Exception:
+      pass
+
+  def _wait_motion(self, operation, messageIDs, target=None, duration=None,
+                   channel=1, check_faults=True):
+    """
+    Waits for the message, with one of messageIDs, that ends a move and
+    returns it.
+
+    If check_faults is True, the status is polled every
+    self.fault_poll_interval seconds, starting one interval in, and if it
+    shows excessive position error or the motor current limit, the motor is
+    stopped and MotionFaultError raised. A poll waits for the status until
+    the deadline at most, or for one interval if there is none, so a
+    controller that stops answering can't hold up the wait.
+
+    If the move is not over by its deadline, the motor is stopped and
+    MoveTimeoutError raised. The deadline is based on duration, the time
+    the move should take in seconds, or if that is None, on the time a move
+    from the position polled right away to target should take with the
+    velocity parameters in use, see profile_time(). Without either there is
+    no deadline.
+
+    The whole wait is timed as the span operation.wait, see span().
+    """
+    with self.span('%s.wait'%(operation)):
+      since = self._end_of_move_since(messageIDs)
+      start = time.time()
+      deadline = self._deadline(duration)
+      poll = self.fault_poll_interval if check_faults else None
+      next_poll = start + poll if poll is not None else None
+      derive = (deadline is None and target is not None and
+                self.deadline_factor is not None)
+      sts = None
+
+      while True:
+        now = time.time()
+        if derive or (poll is not None and now >= next_poll):
+          timeout = poll if deadline is None else max(0, deadline - now)
+          try:
+            sts = self.status(channel, timeout)
+          except ReplyTimeoutError:
+            # a missed deadline is caught below, a late poll retried
+            pass
+          else:
+            if check_faults and (sts.excessive_position_error or
+                                 sts.motor_current_limit_reached):
+              self._abort_motion(channel)
+              raise MotionFaultError('fault', self, operation, target, sts,
+                                     time.time() - start)
+            if derive:
+              deadline = self._deadline(
+                self.profile_time(target - sts.position, channel))
+              derive = False
+          if poll is not None:
+            next_poll = now + poll
+          now = time.time()
+
+        if deadline is not None and now > deadline:
+          self._abort_motion(channel)
+          raise MoveTimeoutError('deadline missed', self, operation, target,
+                                 sts, now - start)
+
+        wake = [t for t in (deadline, next_poll) if t is not None]
+        timeout = max(0, min(wake) - now) if wake else None
+        try:
+          return self._wait_end_of_move(messageIDs, channel, since, timeout)
+        except ReplyTimeoutError:
+          pass
+
+  def move(self, dist_mm, channel=1, wait=True, settle=None):
     """
     Tells the stage to move from its current position the specified
     distance, in mm
@@ -378,7 +1127,7 @@ class Controller(object):
     #
     # Of course by the time I have finished writing this comment, I could have
     # just implemented MGMSG_MOT_MOVE_RELATIVE.
-    return self.goto(newpos, channel=channel, wait=wait)
+    return self.goto(newpos, channel=channel, wait=wait, settle=settle)
 
   def set_soft_limits(self, soft_limits):
     """
@@ -395,6 +1144,20 @@ class Controller(object):
     When called without arguments, max acceleration and max velocity will
     be set to self.max_acceleration and self.max_velocity
     """
+    m = self._velocity_message(acceleration, max_velocity, channel)
+    self._send_message(m)
+    self._note_velocity_frames([(m.messageID, m.pack())])
+
+  def velocity_frames(self, acceleration=None, max_velocity=None, channel=1):
+    """
+    Returns the message set_velocity_parameters() would send, packed, as a
+    list of (messageID, bytes) for write_frames(). The parameters are only
+    taken as in use, e.g. by profile_time(), once the frames are written.
+    """
+    m = self._velocity_message(acceleration, max_velocity, channel)
+    return [(m.messageID, m.pack())]
+
+  def _velocity_message(self, acceleration=None, max_velocity=None, channel=1):
     if acceleration == None:
       acceleration = self.max_acceleration
 
@@ -405,8 +1168,8 @@ class Controller(object):
     acceleration = min(acceleration, self.max_acceleration)
     max_velocity = min(max_velocity, self.max_velocity)
 
-    acc_apt = acceleration * self.acceleration_scale
-    max_vel_apt = max_velocity * self.velocity_scale
+    acc_apt = int(acceleration * self.acceleration_scale)
+    max_vel_apt = int(max_velocity * self.velocity_scale)
 
     """
     <: small endian
@@ -416,8 +1179,39 @@ class Controller(object):
     i: 4 bytes for max velocity
     """
     params = st.pack('<Hiii',channel,0,acc_apt, max_vel_apt)
-    setmsg = Message(message.MGMSG_MOT_SET_VELPARAMS, data=params)
-    self._send_message(setmsg)
+    return Message(message.MGMSG_MOT_SET_VELPARAMS, data=params)
+
+  def move_time(self, distance, max_velocity=None, acceleration=None):
+    """
+    Estimates how long a move over distance, in mm, takes with a trapezoidal
+    velocity profile starting and ending at rest, in seconds. max_velocity
+    and acceleration default to self.max_velocity and
+    self.max_acceleration, which are what set_velocity_parameters() uses by
+    default. Settling is not included.
+    """
+    if max_velocity is None:
+      max_velocity = self.max_velocity
+    if acceleration is None:
+      acceleration = self.max_acceleration
+
+    distance = abs(distance)
+    if not distance:
+      return 0.0
+
+    # distance needed to reach max_velocity and stop again
+    ramp = max_velocity * max_velocity / acceleration
+    if distance < ramp:
+      # triangular profile, max_velocity is never reached
+      return 2 * (distance / acceleration) ** 0.5
+    return distance / max_velocity + max_velocity / acceleration
+
+  def profile_time(self, distance, channel=1):
+    """
+    Like move_time(), but with the velocity parameters last sent to or read
+    from channel, which is how long the controller will actually take
+    """
+    acc, vel = self._velocity_params.get(channel, (None, None))
+    return self.move_time(distance, vel or None, acc or None)
 
   def velocity_parameters(self, channel=1, raw=False):
     """
@@ -434,9 +1228,7 @@ class Controller(object):
       min_vel, acc, max_vel = con.velocity_parameters()
     """
     reqmsg = Message(message.MGMSG_MOT_REQ_VELPARAMS, param1=channel)
-    self._send_message(reqmsg)
-
-    getmsg = self._wait_message(message.MGMSG_MOT_GET_VELPARAMS)
+    getmsg = self._query(reqmsg, message.MGMSG_MOT_GET_VELPARAMS)
 
     """
     <: small endian
@@ -446,6 +1238,8 @@ class Controller(object):
     i: 4 bytes for max velocity
     """
     ch,min_vel,acc,max_vel = st.unpack('<Hiii',getmsg.datastring)
+    self._velocity_params[channel] = (acc / self.acceleration_scale,
+                                      max_vel / self.velocity_scale)
 
     if not raw:
       min_vel /= self.velocity_scale
@@ -469,9 +1263,7 @@ class Controller(object):
     """
 
     reqmsg = Message(message.MGMSG_HW_REQ_INFO)
-    self._send_message(reqmsg)
-
-    getmsg = self._wait_message(message.MGMSG_HW_GET_INFO)
+    getmsg = self._query(reqmsg, message.MGMSG_HW_GET_INFO)
     """
     <: small endian
     I:    4 bytes for serial number
@@ -488,47 +1280,76 @@ class Controller(object):
 
     sn,model,hwtype,fwver,notes,_,hwver,modstate,numchan = info
 
-    fwverminor = ord(fwver[0])
-    fwverinterim = ord(fwver[1])
-    fwvermajor = ord(fwver[2])
+    # bytearray indexes to ints under both python 2 and 3
+    fwverminor, fwverinterim, fwvermajor = bytearray(fwver)[:3]
 
     fwver = '%d.%d.%d'%(fwvermajor,fwverinterim, fwverminor)
 
     return (sn,model,hwtype,fwver,notes,hwver,modstate,numchan)
 
-  def stop(self, channel=1, immediate=False, wait=True):
+  def stop(self, channel=1, immediate=False, wait=True, settle=None):
     """
     Stops the motor on the specified channel. If immediate is True, then the
     motor stops immediately, otherwise it stops in a profiled manner, i.e.
     decelerates accoding to max acceleration from current velocity down to zero
 
     If wait is True, then this method returns only when MGMSG_MOT_MOVE_STOPPED
-    is read, and controller reports velocity of 0.
+    is read, and the settle policy is satisfied, see wait_stopped().
 
     This method returns an instance of ControllerStatus if wait is True, None
     otherwise.
     """
 
-    if wait:
-      self.resume_end_of_move_messages()
-    else:
-      self.suspend_end_of_move_messages()
-
     stopmsg = Message(message.MGMSG_MOT_MOVE_STOP,
                       param1=channel,
                       param2=int(immediate))
-    self._send_message(stopmsg)
+    self.discard_messages(message.MGMSG_MOT_MOVE_STOPPED)
+
+    with self.batch():
+      if wait:
+        self.resume_end_of_move_messages()
+      else:
+        self.suspend_end_of_move_messages()
+
+      self._send_message(stopmsg)
 
     if wait:
-      self._wait_message(message.MGMSG_MOT_MOVE_STOPPED)
-      sts = self.status()
-      while sts.velocity_apt:
-        time.sleep(0.001)
-        sts = self.status()
-      return sts
+      return self.wait_stopped(channel, settle)
     else:
       return None
 
+  def stop_frames(self, channel=1, immediate=False):
+    """
+    Returns the messages stop() sends with wait=True, packed, as a list of
+    (messageID, bytes). Stopping several controllers can then be reduced to
+    one write_frames() call each, prepared ahead of time, followed by
+    wait_stopped().
+    """
+    msgs = [Message(message.MGMSG_MOT_RESUME_ENDOFMOVEMSGS),
+            Message(message.MGMSG_MOT_MOVE_STOP,
+                    param1=channel,
+                    param2=int(immediate))]
+    return [(m.messageID, m.pack()) for m in msgs]
+
+  def wait_stopped(self, channel=1, settle=None):
+    """
+    Waits for MGMSG_MOT_MOVE_STOPPED, and then for the settle policy to be
+    satisfied. settle defaults to self.settle_policy, or waiting for the
+    controller to report a velocity of 0 if that is None. Returns the final
+    ControllerStatus.
+    """
+    # at most the time to decelerate from full speed
+    acc, vel = self._velocity_params.get(channel, (None, None))
+    acc = acc or self.max_acceleration
+    vel = vel or self.max_velocity
+    self._wait_motion('stop', (message.MGMSG_MOT_MOVE_STOPPED, ),
+                      duration=vel / acc, channel=channel)
+    sts = self.status(channel)
+    policy = settle or self.settle_policy or STOP_DEFAULT
+    with self.span('stop.settle'):
+      sts = policy.wait(self, sts, None, channel)
+    return sts
+
   def keepalive(self):
     """
     This sends MGMSG_MOT_ACK_DCSTATUSUPDATE to the controller to keep it
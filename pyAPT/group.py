@@ -0,0 +1,689 @@
+"""
+Operations on several controllers at once, e.g. the axes of a multi-axis
+stage.
+
+Each controller talks to its own USB device, so operations that mostly wait
+on the hardware can run on all axes at the same time, and take as long as
+the slowest axis rather than the sum of all of them.
+
+AxisGroup bundles any number of such axes into one stage.
+"""
+from __future__ import absolute_import, division
+import threading
+import time
+
+from . import message
+from .instrument import now_ns
+from .settle import GOTO_DEFAULT
+
+def run_parallel(fn, items, on_error=None):
+  """
+  Calls fn(item) for every item, each in its own thread, and returns the
+  results in the same order as items. If any call raises, the first
+  exception raised is re-raised once all threads have finished.
+
+  on_error, if given, is called with that first exception as soon as it is
+  raised, while the other calls may still be running, e.g. to abort them.
+  """
+  items = list(items)
+  if len(items) == 1:
+    return [fn(items[0])]
+
+  results = [None] * len(items)
+  errors = []
+  lock = threading.Lock()
+
+  def worker(idx, item):
+    try:
+      results[idx] = fn(item)
+    except BaseException as ex:
+      with lock:
+        errors.append(ex)
+        first = len(errors) == 1
+      if first and on_error is not None:
+        on_error(ex)
+
+  threads = [threading.Thread(target=worker, args=(idx, item))
+             for idx, item in enumerate(items)]
+  for t in threads:
+    t.daemon = True
+    t.start()
+  for t in threads:
+    t.join()
+
+  if errors:
+    raise errors[0]
+  return results
+
+class HomingResult(object):
+  """
+  Outcome of homing one controller: whether homing was needed, how long it
+  took in seconds, and the controller status afterwards.
+  """
+  def __init__(self, controller, homed, duration, status):
+    super(HomingResult, self).__init__()
+    self.controller = controller
+    self.homed = homed
+    self.duration = duration
+    self.status = status
+
+  def __repr__(self):
+    return 'HomingResult(%s, homed=%s, %.2fs)'%(
+            self.controller.serial_number, bool(self.homed), self.duration)
+
+def home_all(controllers, force=False, velocity=None, offset=0, channel=1):
+  """
+  Homes several controllers at the same time.
+
+  channel is the channel of every controller, or a list with one per
+  controller.
+
+  Unless force is True, controllers whose status already has the homed bit
+  set are skipped, so this costs no more than one status query per axis when
+  the stage is already referenced. Controllers opened with
+  cache.open_controller() whose cache says they were not homed are homed
+  without asking, and the state after homing is recorded in the cache.
+
+  velocity and offset are passed on to Controller.home().
+
+  If homing any controller fails, e.g. with MotionFaultError, all of them
+  are stopped and the error is raised.
+
+  Returns a list of HomingResult, one per controller, in order.
+  """
+  controllers = list(controllers)
+  n = len(controllers)
+  channels = channel if isinstance(channel, (list, tuple)) else [channel] * n
+
+  def home_one(i):
+    con = controllers[i]
+    cache = getattr(con, 'cache', None)
+    st = time.time()
+    state = None
+    if cache is not None and not force:
+      state = cache.last_state(con.serial_number, channels[i])
+    # a homed state in the cache is only a hint, so it is confirmed
+    if state is None or state['homed']:
+      status = con.status(channels[i])
+      if status.homed and not force:
+        return HomingResult(con, False, time.time() - st, status)
+    status = con.home(wait=True, velocity=velocity, offset=offset,
+                      channel=channels[i])
+    if cache is not None:
+      cache.record_state(con, status, channel=channels[i])
+    return HomingResult(con, True, time.time() - st, status)
+
+  def abort(ex):
+    stop_all(controllers, immediate=True, wait=False, channel=channels)
+
+  return run_parallel(home_one, range(n), on_error=abort)
+
+class StopResult(object):
+  """
+  Outcome of stopping one controller in stop_all(): the time in seconds from
+  the stop request until the controller reported zero velocity, and its
+  status at that point.
+  """
+  def __init__(self, controller, elapsed, status):
+    super(StopResult, self).__init__()
+    self.controller = controller
+    self.elapsed = elapsed
+    self.status = status
+
+  def __repr__(self):
+    return 'StopResult(%s, %.3fs)'%(self.controller.serial_number,
+                                     self.elapsed)
+
+def stop_all(controllers, immediate=False, wait=True, channel=1):
+  """
+  Stops several controllers as quickly as possible.
+
+  The stop messages of every controller are packed up front and written
+  back-to-back, one write per controller, before waiting on any of them, so
+  the last axis receives its stop within a few USB transactions of the
+  first. The confirmations are then awaited in parallel.
+
+  If immediate is True the motors stop abruptly, otherwise they decelerate
+  at their maximum acceleration.
+
+  channel is the channel of every controller, or a list with one per
+  controller.
+
+  Returns a list of StopResult, one per controller in order, whose elapsed
+  times are measured from just before the first stop was written. The time
+  until all axes stopped is the largest of them. If wait is False, returns
+  None as soon as the stops are written.
+  """
+  controllers = list(controllers)
+  n = len(controllers)
+  channels = channel if isinstance(channel, (list, tuple)) else [channel] * n
+  frames = [con.stop_frames(ch, immediate)
+            for con, ch in zip(controllers, channels)]
+  for con in controllers:
+    con.discard_messages(message.MGMSG_MOT_MOVE_STOPPED)
+
+  st = now_ns()
+  for con, f in zip(controllers, frames):
+    con.write_frames(f)
+
+  if not wait:
+    return None
+
+  def wait_one(i):
+    con = controllers[i]
+    status = con.wait_stopped(channels[i])
+    return StopResult(con, (now_ns() - st) / 1e9, status)
+
+  return run_parallel(wait_one, range(n))
+
+class SyncStart(object):
+  """
+  Outcome of synchronized_start(). writes[i] is the (before, after) now_ns()
+  timestamps of the write of the move frame of controller i, None if it
+  wasn't moved, and statuses[i] its ControllerStatus once the move
+  completed and settled, if waited for.
+  """
+  def __init__(self, controllers, positions, writes):
+    super(SyncStart, self).__init__()
+    self.controllers = controllers
+    self.positions = positions
+    self.writes = writes
+    self.statuses = None
+
+  @property
+  def skew(self):
+    """
+    Start skew in seconds: the time from the first move frame having been
+    written to the last, as measured on the host
+    """
+    ends = [w[1] for w in self.writes if w is not None]
+    if len(ends) < 2:
+      return 0.0
+    return (max(ends) - min(ends)) / 1e9
+
+  @property
+  def release_time(self):
+    """
+    Seconds from the first write of a move frame starting to the last one
+    completing
+    """
+    writes = [w for w in self.writes if w is not None]
+    if not writes:
+      return 0.0
+    return (max(w[1] for w in writes) - min(w[0] for w in writes)) / 1e9
+
+  def __repr__(self):
+    return 'SyncStart(%d axes, skew=%.3fms)'%(
+            len([w for w in self.writes if w is not None]), self.skew * 1e3)
+
+def synchronized_start(controllers, positions, channel=1, velocities=None,
+                       accelerations=None, wait=True, settle=None,
+                       parallel=True, frames=None, durations=None):
+  """
+  Starts moves of several controllers, to positions in mm, as close to the
+  same instant as possible. None in positions leaves a controller alone.
+
+  Everything that can be done ahead of time is: the moves are range checked
+  and packed, so an OutOfRangeError moves nothing, and end of move messages
+  are resumed and the velocity parameters in velocities and accelerations,
+  if given, written to each controller. Only then is each MOVE_ABSOLUTE
+  frame released, from one thread per controller waiting on a barrier, so
+  the writes to the different devices overlap instead of following each
+  other. The velocity parameters stay in effect afterwards.
+
+  If parallel is False the frames are instead written back-to-back from the
+  calling thread, like stop_all() does, which is tighter when writes are
+  much quicker than waking a thread, e.g. with simulated devices. The
+  measured skew tells which is better for a given setup.
+
+  channel is the channel of every controller, or a list with one per
+  controller.
+
+  frames, if given, holds for each controller the packed move frames to
+  send, as move_frames() returns them, e.g. packed for a whole plan in one
+  go. positions must still be given for the waits, but are not range
+  checked again.
+
+  If wait is True, the moves are waited for in parallel, and settled with
+  settle, see Controller.goto(). durations, if given, holds the time in
+  seconds each move should take, from which its deadline is set, see
+  Controller.wait_move_completed(). If any of them fails, e.g. with
+  MotionFaultError, all controllers are stopped and the error is raised.
+
+  Returns a SyncStart with the measured start skew.
+  """
+  controllers = list(controllers)
+  n = len(controllers)
+  channels = channel if isinstance(channel, (list, tuple)) else [channel] * n
+  velocities = velocities or [None] * n
+  accelerations = accelerations or [None] * n
+  durations = durations or [None] * n
+  moving = [i for i in range(n) if positions[i] is not None]
+
+  moves = {}
+  primes = {}
+  resume = message.Message(message.MGMSG_MOT_RESUME_ENDOFMOVEMSGS)
+  for i in moving:
+    con = controllers[i]
+    if frames is None:
+      moves[i] = con.move_frames(positions[i], channels[i])
+    else:
+      moves[i] = frames[i]
+    primes[i] = [(resume.messageID, resume.pack())]
+    if velocities[i] is not None or accelerations[i] is not None:
+      primes[i] += con.velocity_frames(accelerations[i], velocities[i],
+                                       channels[i])
+
+  for i in moving:
+    controllers[i].discard_messages(message.MGMSG_MOT_MOVE_COMPLETED,
+                                    message.MGMSG_MOT_MOVE_STOPPED)
+    controllers[i].write_frames(primes[i])
+
+  writes = [None] * n
+  if parallel and len(moving) > 1:
+    barrier = threading.Barrier(len(moving))
+  else:
+    barrier = None
+
+  def release(i):
+    if barrier is not None:
+      barrier.wait()
+    st = now_ns()
+    controllers[i].write_frames(moves[i])
+    writes[i] = (st, now_ns())
+
+  if barrier is not None:
+    run_parallel(release, moving)
+  else:
+    for i in moving:
+      release(i)
+  result = SyncStart(controllers, positions, writes)
+  if not wait:
+    return result
+
+  def wait_one(i):
+    con = controllers[i]
+    sts = con.wait_move_completed(positions[i], channels[i], durations[i])
+    policy = settle or con.settle_policy or GOTO_DEFAULT
+    with con.span('goto.settle'):
+      sts = policy.wait(con, sts, int(positions[i] * con.position_scale),
+                        channels[i])
+    return i, sts
+
+  def abort(ex):
+    stop_all([controllers[i] for i in moving], immediate=True, wait=False,
+             channel=[channels[i] for i in moving])
+
+  done = dict(run_parallel(wait_one, moving, on_error=abort))
+  result.statuses = [done.get(i) for i in range(n)]
+  return result
+
+class Axis(object):
+  """
+  One axis of an AxisGroup: the controller driving it, the range it may move
+  in, and how world coordinates along it map to positions of the stage,
+
+    stage = sign * scale * world + offset
+  """
+  def __init__(self, name, serial_number, controller='MTS50', limits=None,
+               sign=1, scale=1.0, offset=0.0, channel=1):
+    """
+    controller is the name of the controller class, see
+    cache.CONTROLLER_CLASSES, or None to look it up with
+    cache.open_controller(). limits, in stage mm (degrees for rotation
+    stages), replace the linear_range of the controller class if given.
+    """
+    super(Axis, self).__init__()
+    self.name = name
+    self.serial_number = serial_number
+    self.controller = controller
+    self.limits = tuple(limits) if limits is not None else None
+    self.sign = sign
+    self.scale = scale
+    self.offset = offset
+    self.channel = channel
+    # the open controller, see open()
+    self.con = None
+
+  def __repr__(self):
+    return 'Axis(%r, %r, %r)'%(self.name, self.serial_number, self.controller)
+
+  @classmethod
+  def from_config(cls, config):
+    """
+    Builds an Axis from one entry of the AXES list of a configuration file,
+    with keys NAME, SN and optionally CONTROLLER, LIMITS, SIGN, SCALE,
+    OFFSET and CHANNEL
+    """
+    return cls(config['NAME'], config['SN'],
+               controller=config.get('CONTROLLER', 'MTS50'),
+               limits=config.get('LIMITS'),
+               sign=config.get('SIGN', 1),
+               scale=config.get('SCALE', 1.0),
+               offset=config.get('OFFSET', 0.0),
+               channel=config.get('CHANNEL', 1))
+
+  def to_stage(self, value):
+    return self.sign * self.scale * value + self.offset
+
+  def to_world(self, position):
+    return (position - self.offset) / (self.sign * self.scale)
+
+  def open(self, simulated=False, time_scale=0.0):
+    """
+    Opens the controller of the axis, on a sim.SimulatedDevice if simulated
+    is True, and returns it
+    """
+    from . import cache, sim
+    if simulated:
+      cls = cache.CONTROLLER_CLASSES[self.controller or 'MTS50']
+      con = sim.open_simulated(cls, serial_number=self.serial_number,
+                               time_scale=time_scale)
+    elif self.controller is None:
+      con = cache.open_controller(self.serial_number)
+    else:
+      cls = cache.CONTROLLER_CLASSES[self.controller]
+      con = cls(serial_number=self.serial_number)
+    con.label = self.name
+    if self.limits is not None:
+      con.linear_range = self.limits
+    self.con = con
+    return con
+
+  def close(self):
+    if self.con is not None:
+      self.con.close()
+      self.con = None
+
+class AxisGroup(object):
+  """
+  Any number of axes, each driven by its own controller, of any class, that
+  move together as one stage.
+
+    with AxisGroup.from_config(config) as stage:
+      stage.home()
+      stage.move((10, 20, 5, 90))
+      print(stage.position())
+
+  Group operations run on all axes at once: moves are range checked on every
+  axis, then started together with synchronized_start() and waited for in
+  parallel, homing and stopping use home_all() and stop_all(), and status
+  is queried from all axes in parallel. The time they take is that of the
+  slowest axis, whatever the number of axes.
+
+  World coordinates are converted to stage positions per axis, see Axis,
+  unless a transform is given, e.g. a transform.StageTransform, whose
+  to_stage() and to_world() then convert whole points instead.
+
+  Controllers are opened by open(), or on entering a with block, and closed
+  when the outermost close() or with block is done, so operations can be
+  nested cheaply.
+  """
+  def __init__(self, axes, transform=None, simulated=False, time_scale=0.0):
+    super(AxisGroup, self).__init__()
+    names = [a.name for a in axes]
+    if len(set(names)) != len(names):
+      raise ValueError('Axis names must be unique: %r'%(names))
+    self.axes = list(axes)
+    self.transform = transform
+    self.simulated = simulated
+    self.time_scale = time_scale
+    self._depth = 0
+    # SyncStart of the last move, with its start skew
+    self.last_start = None
+    # how moves are released, see synchronized_start()
+    self.parallel_start = True
+    # profiler.ScanProfiler the controllers are attached to while open
+    self.profiler = None
+
+  def __repr__(self):
+    return 'AxisGroup(%r)'%(self.axes)
+
+  def __len__(self):
+    return len(self.axes)
+
+  @classmethod
+  def from_config(cls, config, **kwargs):
+    """
+    Builds a group from a configuration dictionary, e.g. a loaded
+    configfile.yml, with an AXES list as read by Axis.from_config().
+
+    Configurations without AXES are the historic three axis LinearStage
+    ones: X_AXIS_SN, Y_AXIS_SN and Z_AXIS_SN, each limited to
+    [0, MAX_DIST], with the StageTransform built from the configuration.
+    """
+    if 'AXES' in config:
+      return cls([Axis.from_config(a) for a in config['AXES']], **kwargs)
+
+    from .transform import StageTransform
+    limits = (0, config['MAX_DIST'])
+    axes = [Axis(name, config['%s_AXIS_SN'%(name.upper())], limits=limits)
+            for name in 'xyz']
+    kwargs.setdefault('transform', StageTransform.from_config(config))
+    return cls(axes, **kwargs)
+
+  @property
+  def names(self):
+    return [a.name for a in self.axes]
+
+  def axis(self, name):
+    for a in self.axes:
+      if a.name == name:
+        return a
+    raise KeyError(name)
+
+  @property
+  def controllers(self):
+    if not self._depth:
+      raise RuntimeError('AxisGroup is not open')
+    return [a.con for a in self.axes]
+
+  def open(self):
+    if not self._depth:
+      try:
+        for a in self.axes:
+          a.open(self.simulated, self.time_scale)
+      except:
+        for a in self.axes:
+          a.close()
+        raise
+      if self.profiler is not None:
+        for a in self.axes:
+          self.profiler.attach(a.con, a.name)
+    self._depth += 1
+    return self
+
+  def close(self):
+    if not self._depth:
+      return
+    self._depth -= 1
+    if not self._depth:
+      for a in self.axes:
+        if self.profiler is not None:
+          self.profiler.detach(a.con)
+        a.close()
+
+  def set_profiler(self, profiler):
+    """
+    Records the traffic of every axis on profiler, a profiler.ScanProfiler,
+    whenever the group is open, or stops recording if profiler is None
+    """
+    if self._depth and self.profiler is not None:
+      self.profiler.detach()
+    self.profiler = profiler
+    if self._depth and profiler is not None:
+      for a in self.axes:
+        profiler.attach(a.con, a.name)
+
+  def __enter__(self):
+    return self.open()
+
+  def __exit__(self, type_, value, traceback):
+    self.close()
+
+  def to_stage(self, world):
+    """
+    Converts a point in world coordinates to a list of stage positions
+    """
+    if self.transform is not None:
+      return [float(v) for v in self.transform.to_stage(world)]
+    return [a.to_stage(v) for a, v in zip(self.axes, world)]
+
+  def to_world(self, stage):
+    if self.transform is not None:
+      return [float(v) for v in self.transform.to_world(stage)]
+    return [a.to_world(v) for a, v in zip(self.axes, stage)]
+
+  def move(self, world, wait=True, settle=None):
+    """
+    Moves to the point world, in world coordinates, see move_stage()
+    """
+    return self.move_stage(self.to_stage(world), wait, settle)
+
+  def move_stage(self, positions, wait=True, settle=None):
+    """
+    Moves every axis to its position in positions, in stage coordinates, at
+    the same time. None leaves an axis where it is.
+
+    Every position is range checked before anything is sent, so an
+    OutOfRangeError on one axis moves none of them.
+
+    If wait is True, waits for every axis to complete its move and settle,
+    see Controller.goto() for settle, and returns their ControllerStatus,
+    None for axes that weren't moved. If any axis fails, e.g. with
+    MotionFaultError, all of them are stopped and the error is raised.
+
+    The axes are started with synchronized_start(), whose SyncStart,
+    with the measured start skew, is kept in last_start.
+    """
+    if len(positions) != len(self.axes):
+      raise ValueError('Expected %d positions, got %d'%(len(self.axes),
+                                                        len(positions)))
+    self.last_start = synchronized_start(self.controllers, positions,
+                                         [a.channel for a in self.axes],
+                                         wait=wait, settle=settle,
+                                         parallel=self.parallel_start)
+    return self.last_start.statuses
+
+  def move_linear(self, world, velocity=None, wait=True, settle=None,
+                  restore=True):
+    """
+    Moves to the point world, in world coordinates, in a straight line in
+    stage coordinates: the velocity and acceleration of each axis are
+    scaled by its share of the move, so all axes follow the same profile
+    and arrive together. velocity, if given, limits the speed along the
+    line, in stage units per second. The axes' max_velocity and
+    max_acceleration are never exceeded.
+
+    If restore is True the velocity parameters are set back to the
+    controllers' limits once the move is done, or has failed. Returns like
+    move_stage().
+    """
+    target = self.to_stage(world)
+    current = [float(s.position_apt) / s.position_scale
+               for s in self.status()]
+    delta = [abs(t - c) for t, c in zip(target, current)]
+    # axes moving less than an encoder count don't move at all
+    moving = [i for i, a in enumerate(self.axes)
+              if delta[i] * a.con.position_scale >= 1]
+    positions = [target[i] if i in moving else None
+                 for i in range(len(self.axes))]
+    if not moving:
+      return [None] * len(self.axes)
+
+    cons = self.controllers
+    vscale = min(cons[i].max_velocity / delta[i] for i in moving)
+    ascale = min(cons[i].max_acceleration / delta[i] for i in moving)
+    if velocity is not None:
+      length = sum(delta[i] ** 2 for i in moving) ** 0.5
+      vscale = min(vscale, velocity / length)
+    velocities = [None] * len(self.axes)
+    accelerations = [None] * len(self.axes)
+    duration = 0.0
+    for i in moving:
+      con = cons[i]
+      # the controller takes whole APT units, and an axis with a tiny share
+      # of the move would get 0, so it never moved. One unit is the least
+      vel_apt = max(int(vscale * delta[i] * con.velocity_scale), 1)
+      acc_apt = max(int(ascale * delta[i] * con.acceleration_scale), 1)
+      # half a unit over, so that packing truncates back to the same units
+      velocities[i] = (vel_apt + 0.5) / con.velocity_scale
+      accelerations[i] = (acc_apt + 0.5) / con.acceleration_scale
+      # the axes would take the same time but for the rounding, so the
+      # slowest of the profiles actually sent sets every deadline
+      duration = max(duration, con.move_time(delta[i],
+                                             vel_apt / con.velocity_scale,
+                                             acc_apt / con.acceleration_scale))
+    durations = [duration if i in moving else None
+                 for i in range(len(self.axes))]
+
+    try:
+      self.last_start = synchronized_start(cons, positions,
+                                           [a.channel for a in self.axes],
+                                           velocities, accelerations,
+                                           wait=wait, settle=settle,
+                                           parallel=self.parallel_start,
+                                           durations=durations)
+    finally:
+      if wait and restore:
+        for i in moving:
+          cons[i].set_velocity_parameters(channel=self.axes[i].channel)
+    return self.last_start.statuses
+
+  def move_axis(self, name, value, wait=True, settle=None):
+    """
+    Moves the axis name to value, in world coordinates along it, leaving
+    the others where they are. With a transform, the axis is the stage axis
+    driven by world axis name, which must be an index or 'x', 'y' or 'z'.
+    If the calibration matrix of the transform couples the axes, the whole
+    point is moved instead, from the current position with the coordinate
+    along name replaced, and the status of the stage axis driven by name is
+    returned.
+    """
+    positions = [None] * len(self.axes)
+    if self.transform is not None:
+      if not isinstance(name, int):
+        name = 'xyz'.index(name.lower())
+      if self.transform.coupled:
+        world = list(self.position())
+        world[name] = value
+        statuses = self.move(world, wait, settle)
+        i = int(self.transform.axis_map.tolist().index(name))
+        return statuses[i] if wait else None
+      i, pos = self.transform.axis_to_stage(name, value)
+    else:
+      i = self.names.index(name)
+      pos = self.axes[i].to_stage(value)
+    positions[i] = pos
+    statuses = self.move_stage(positions, wait, settle)
+    return statuses[i] if wait else None
+
+  def home(self, force=False, velocity=None, offset=0):
+    """
+    Homes all axes at the same time, see home_all()
+    """
+    return home_all(self.controllers, force, velocity, offset,
+                    [a.channel for a in self.axes])
+
+  def stop(self, immediate=False, wait=True):
+    """
+    Stops all axes as quickly as possible, see stop_all()
+    """
+    return stop_all(self.controllers, immediate, wait,
+                    [a.channel for a in self.axes])
+
+  def status(self):
+    """
+    Returns the ControllerStatus of every axis, queried in parallel
+    """
+    return run_parallel(lambda a: a.con.status(a.channel), self.axes)
+
+  def position(self, statuses=None):
+    """
+    Returns the current position in world coordinates, from statuses as
+    returned by status(), or a fresh snapshot
+    """
+    if statuses is None:
+      statuses = self.status()
+    return self.to_world([float(s.position_apt) / s.position_scale
+                          for s in statuses])
@@ -0,0 +1,266 @@
+"""
+Low overhead instrumentation of the traffic between a Controller and its
+device.
+
+Instrumentation is off by default. Enable it on a controller with
+
+  instr = con.enable_instrumentation()
+  ... do things ...
+  print(instr.report())
+
+While enabled, the controller records per message ID send counts and latency,
+how long it blocked waiting for each reply, how many unexpected frames were
+queued, bytes on the wire, and the time spent in sleeps. Named spans can be
+used to time larger operations:
+
+  with con.span('my.operation'):
+    con.goto(10)
+
+When instrumentation is disabled all hooks reduce to a single attribute check.
+"""
+from __future__ import absolute_import, division
+import threading
+import time
+from contextlib import contextmanager
+
+from . import message
+
+if hasattr(time, 'perf_counter_ns'):
+  now_ns = time.perf_counter_ns
+else:
+  def now_ns():
+    """
+    Monotonic-ish timestamp in nanoseconds for Pythons without
+    time.perf_counter_ns
+    """
+    return int(time.time() * 1e9)
+
+class LatencyHistogram(object):
+  """
+  Histogram of durations with power-of-two microsecond buckets. Bucket i
+  counts durations d with 2**(i-1) <= d/us < 2**i, bucket 0 counts durations
+  below 1us.
+  """
+  NBUCKETS = 32
+
+  def __init__(self):
+    super(LatencyHistogram, self).__init__()
+    self.count = 0
+    self.total_ns = 0
+    self.min_ns = None
+    self.max_ns = 0
+    self.buckets = [0] * self.NBUCKETS
+
+  def add(self, elapsed_ns):
+    self.count += 1
+    self.total_ns += elapsed_ns
+    if self.min_ns is None or elapsed_ns < self.min_ns:
+      self.min_ns = elapsed_ns
+    if elapsed_ns > self.max_ns:
+      self.max_ns = elapsed_ns
+
+    idx = min(int(elapsed_ns // 1000).bit_length(), self.NBUCKETS - 1)
+    self.buckets[idx] += 1
+
+  @property
+  def mean_ns(self):
+    if self.count:
+      return self.total_ns / self.count
+    return 0
+
+  def percentile(self, p):
+    """
+    Returns an upper bound, in ns, for the p-th percentile (0..100). The
+    resolution is that of the buckets, i.e. a factor of two.
+    """
+    if not self.count:
+      return 0
+
+    target = self.count * p / 100.0
+    seen = 0
+    for idx, n in enumerate(self.buckets):
+      seen += n
+      if seen >= target:
+        return min((1 << idx) * 1000, self.max_ns)
+    return self.max_ns
+
+  def snapshot(self):
+    return {'count': self.count,
+            'total_ns': self.total_ns,
+            'mean_ns': self.mean_ns,
+            'min_ns': self.min_ns or 0,
+            'max_ns': self.max_ns,
+            'p50_ns': self.percentile(50),
+            'p99_ns': self.percentile(99),
+            'buckets': list(self.buckets)}
+
+class _NullSpan(object):
+  """
+  Context manager that does nothing, returned by Controller.span() when
+  instrumentation is disabled.
+  """
+  def __enter__(self):
+    return self
+
+  def __exit__(self, type_, value, traceback):
+    return False
+
+NULL_SPAN = _NullSpan()
+
+class Instrumentation(object):
+  """
+  Collects counters and latency histograms. An instance may be shared by
+  several controllers, in which case the numbers are aggregated.
+  """
+  def __init__(self):
+    super(Instrumentation, self).__init__()
+    self._lock = threading.Lock()
+    self.reset()
+
+  def reset(self):
+    with self._lock:
+      # messageID -> count
+      self.sent = {}
+      self.received = {}
+      self.queued = {}
+
+      # messageID -> LatencyHistogram of the time taken to write the message
+      self.send_latency = {}
+      # messageID -> LatencyHistogram of the time spent waiting for it
+      self.wait_latency = {}
+      # span name -> LatencyHistogram
+      self.spans = {}
+
+      self.bytes_sent = 0
+      self.bytes_received = 0
+      self.writes = 0
+      self.reads = 0
+
+      self.sleeps = 0
+      self.sleep_ns = 0
+
+      self.started_ns = now_ns()
+
+  def _hist(self, table, key):
+    h = table.get(key)
+    if h is None:
+      h = table[key] = LatencyHistogram()
+    return h
+
+  def record_send(self, messageID, nbytes, elapsed_ns):
+    with self._lock:
+      self.sent[messageID] = self.sent.get(messageID, 0) + 1
+      self._hist(self.send_latency, messageID).add(elapsed_ns)
+      self.bytes_sent += nbytes
+      self.writes += 1
+
+  def record_batch(self, frames, elapsed_ns):
+    """
+    Records a single write of several frames, given as (messageID, bytes)
+    """
+    with self._lock:
+      for messageID, data in frames:
+        self.sent[messageID] = self.sent.get(messageID, 0) + 1
+        self._hist(self.send_latency, messageID).add(elapsed_ns)
+        self.bytes_sent += len(data)
+      self.writes += 1
+
+  def record_read(self, nbytes):
+    with self._lock:
+      self.bytes_received += nbytes
+      self.reads += 1
+
+  def record_receive(self, messageID):
+    with self._lock:
+      self.received[messageID] = self.received.get(messageID, 0) + 1
+
+  def record_queued(self, messageID):
+    with self._lock:
+      self.queued[messageID] = self.queued.get(messageID, 0) + 1
+
+  def record_wait(self, messageID, elapsed_ns):
+    with self._lock:
+      self._hist(self.wait_latency, messageID).add(elapsed_ns)
+
+  def record_sleep(self, elapsed_ns):
+    with self._lock:
+      self.sleeps += 1
+      self.sleep_ns += elapsed_ns
+
+  def record_span(self, name, elapsed_ns):
+    with self._lock:
+      self._hist(self.spans, name).add(elapsed_ns)
+
+  @contextmanager
+  def span(self, name):
+    """
+    Times the enclosed block and records it under name
+    """
+    st = now_ns()
+    try:
+      yield self
+    finally:
+      self.record_span(name, now_ns() - st)
+
+  def snapshot(self):
+    """
+    Returns a copy of all counters as plain dicts, lists and numbers. Message
+    tables are keyed by message name rather than ID.
+    """
+    name = message.message_name
+    def hists(table, keyfn=name):
+      return dict((keyfn(k), h.snapshot()) for k, h in table.items())
+    def counts(table):
+      return dict((name(k), n) for k, n in table.items())
+
+    with self._lock:
+      return {'elapsed_ns': now_ns() - self.started_ns,
+              'sent': counts(self.sent),
+              'received': counts(self.received),
+              'queued': counts(self.queued),
+              'send_latency': hists(self.send_latency),
+              'wait_latency': hists(self.wait_latency),
+              'spans': hists(self.spans, keyfn=str),
+              'bytes_sent': self.bytes_sent,
+              'bytes_received': self.bytes_received,
+              'writes': self.writes,
+              'reads': self.reads,
+              'sleeps': self.sleeps,
+              'sleep_ns': self.sleep_ns}
+
+  def report(self):
+    """
+    Returns a human readable summary of snapshot()
+    """
+    snap = self.snapshot()
+    lines = []
+    lines.append('elapsed %.3fs, %d writes (%d B), %d reads (%d B), '
+                 '%d sleeps (%.3fs)'%(snap['elapsed_ns'] / 1e9,
+                                      snap['writes'], snap['bytes_sent'],
+                                      snap['reads'], snap['bytes_received'],
+                                      snap['sleeps'], snap['sleep_ns'] / 1e9))
+
+    fmt = '%-34s %7s %10s %10s %10s %10s'
+    def table(title, hists):
+      if not hists:
+        return
+      lines.append('')
+      lines.append(fmt%(title, 'count', 'total ms', 'mean ms', 'p99 ms',
+                        'max ms'))
+      for key in sorted(hists, key=lambda k: -hists[k]['total_ns']):
+        h = hists[key]
+        lines.append(fmt%(key, h['count'],
+                          '%.3f'%(h['total_ns'] / 1e6),
+                          '%.3f'%(h['mean_ns'] / 1e6),
+                          '%.3f'%(h['p99_ns'] / 1e6),
+                          '%.3f'%(h['max_ns'] / 1e6)))
+
+    table('send', snap['send_latency'])
+    table('wait', snap['wait_latency'])
+    table('span', snap['spans'])
+
+    if snap['queued']:
+      lines.append('')
+      lines.append('queued: ' + ', '.join('%s=%d'%kv for kv in
+                                          sorted(snap['queued'].items())))
+    return '\n'.join(lines)
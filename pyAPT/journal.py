@@ -0,0 +1,150 @@
+"""
+Durable progress journal for long scans, so an interrupted scan can resume
+from where it stopped instead of starting again.
+
+The journal is a small binary file:
+
+  8 bytes magic 'APTJRN01'
+  20 bytes SHA-1 of the scan plan
+  20 bytes SHA-1 of the stage configuration
+  Q: number of points in the plan
+  q: index of the last completed point, -1 if none
+
+Marking a point complete rewrites only the last 8 bytes in place, so the
+cost per point is one small write (and an fsync if requested) regardless of
+the size of the plan.
+"""
+from __future__ import absolute_import, division
+import hashlib
+import json
+import os
+import struct as st
+
+MAGIC = b'APTJRN01'
+_HEADER = st.Struct('<8s20s20sQ')
+_PROGRESS = st.Struct('<q')
+
+class JournalMismatchError(Exception):
+  """
+  Raised when an existing journal was written for a different plan or stage
+  configuration than the one being run.
+  """
+  pass
+
+def plan_digest(points):
+  """
+  Returns the SHA-1 digest of a scan plan, given as a sequence of points or
+  an array. Arrays are hashed from their raw bytes, which is much faster for
+  large plans.
+  """
+  h = hashlib.sha1()
+  if hasattr(points, 'tobytes'):
+    h.update(points.tobytes())
+    return h.digest()
+
+  buf = []
+  for p in points:
+    buf.append(st.pack('<%dd'%(len(p)), *p))
+    if len(buf) >= 4096:
+      h.update(b''.join(buf))
+      buf = []
+  h.update(b''.join(buf))
+  return h.digest()
+
+def config_digest(config):
+  """
+  Returns the SHA-1 digest of a configuration dictionary
+  """
+  s = json.dumps(config, sort_keys=True, default=str)
+  return hashlib.sha1(s.encode()).digest()
+
+class ScanJournal(object):
+  """
+  Records the progress of a scan through a plan.
+
+    journal = ScanJournal('scan.journal', points, config)
+    for i in range(journal.next_index, len(points)):
+      ... visit points[i] ...
+      journal.complete(i)
+    journal.remove()
+
+  If the journal file exists and was written for the same plan and
+  configuration, next_index continues after the last completed point.
+  If it was written for something else JournalMismatchError is raised, unless
+  restart is True in which case the journal starts over.
+
+  When fsync is True every update is flushed to disk before complete()
+  returns, so progress survives power loss as well as crashes.
+  """
+  def __init__(self, path, points, config, restart=False, fsync=True):
+    super(ScanJournal, self).__init__()
+    self.path = path
+    self.fsync = fsync
+    self.npoints = len(points)
+    self.last_completed = -1
+
+    header = _HEADER.pack(MAGIC, plan_digest(points), config_digest(config),
+                          self.npoints)
+
+    if os.path.exists(path) and not restart:
+      with open(path, 'rb') as f:
+        existing = f.read(_HEADER.size)
+        progress = f.read(_PROGRESS.size)
+      if existing != header or len(progress) != _PROGRESS.size:
+        raise JournalMismatchError(
+                '%s was written for a different scan plan or stage '
+                'configuration'%(path))
+      self.last_completed = _PROGRESS.unpack(progress)[0]
+      self._file = open(path, 'r+b')
+    else:
+      self._file = open(path, 'w+b')
+      self._file.write(header)
+      self._write_progress()
+
+  @property
+  def resumed(self):
+    """
+    True if the journal picked up progress from an earlier run
+    """
+    return self.last_completed >= 0
+
+  @property
+  def next_index(self):
+    return self.last_completed + 1
+
+  @property
+  def finished(self):
+    return self.next_index >= self.npoints
+
+  def _write_progress(self):
+    self._file.seek(_HEADER.size)
+    self._file.write(_PROGRESS.pack(self.last_completed))
+    self._file.flush()
+    if self.fsync:
+      os.fsync(self._file.fileno())
+
+  def complete(self, index):
+    """
+    Marks every point up to and including index as completed
+    """
+    self.last_completed = index
+    self._write_progress()
+
+  def close(self):
+    if self._file is not None:
+      self._file.close()
+      self._file = None
+
+  def remove(self):
+    """
+    Closes and deletes the journal, typically once the scan has finished
+    """
+    self.close()
+    if os.path.exists(self.path):
+      os.remove(self.path)
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, type_, value, traceback):
+    self.close()
@@ -30,3 +30,5 @@ class LTS300(Controller):
     # The linear range for this stage is 300mm
     self.linear_range = (0,300)
 
+    # replace the limits above with tuned ones, if this stage was profiled
+    self.apply_tuned_profile()
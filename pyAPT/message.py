@@ -212,3 +212,13 @@ MGMSG_MOT_RESUME_ENDOFMOVEMSGS = 0x046C
 
 MGMSG_MOT_MOVE_STOP = 0x0465
 MGMSG_MOT_MOVE_STOPPED = 0x0466
+
+def message_name(messageID):
+  """
+  Returns the symbolic name of messageID, e.g. 'MGMSG_MOT_MOVE_COMPLETED', or
+  its hex representation if it is not a message we know about.
+  """
+  return _MESSAGE_NAMES.get(messageID, '0x%04X'%(messageID))
+
+_MESSAGE_NAMES = dict((v, k) for k, v in list(globals().items())
+                      if k.startswith('MGMSG_') and k != 'MGMSG_HEADER_SIZE')
@@ -0,0 +1,126 @@
+"""
+Bounded store for messages that arrive while the controller is waiting for
+some other message.
+"""
+from __future__ import absolute_import, division
+import itertools
+from collections import deque
+
+from . import message
+
+DROP_OLDEST = 'drop_oldest'
+DROP_NEWEST = 'drop_newest'
+
+class MessageQueue(object):
+  """
+  Messages indexed by message ID, holding at most capacity messages in total.
+
+  When full, put() evicts according to policy: DROP_OLDEST evicts the message
+  that has been held the longest, regardless of its ID, DROP_NEWEST drops the
+  message being put. Evictions are counted per message ID in self.dropped.
+
+  Messages of the same ID are popped in the order they were put.
+  """
+  def __init__(self, capacity=256, policy=DROP_OLDEST):
+    super(MessageQueue, self).__init__()
+    if policy not in (DROP_OLDEST, DROP_NEWEST):
+      raise ValueError('Unknown eviction policy %r'%(policy))
+
+    self.capacity = capacity
+    self.policy = policy
+
+    # messageID -> deque of (sequence number, message)
+    self._queues = {}
+    self._size = 0
+    self._seq = itertools.count()
+
+    # messageID -> number of messages evicted
+    self.dropped = {}
+
+  def __len__(self):
+    return self._size
+
+  def __iter__(self):
+    """
+    Iterates over the held messages in arrival order
+    """
+    entries = sorted(itertools.chain(*self._queues.values()),
+                     key=lambda e: e[0])
+    return iter([m for _, m in entries])
+
+  def __contains__(self, messageID):
+    return bool(self._queues.get(messageID))
+
+  @property
+  def dropped_total(self):
+    return sum(self.dropped.values())
+
+  def _drop(self, messageID):
+    self.dropped[messageID] = self.dropped.get(messageID, 0) + 1
+
+  def _evict_oldest(self):
+    oldest = min((q[0][0], mid) for mid, q in self._queues.items() if q)[1]
+    self._queues[oldest].popleft()
+    self._size -= 1
+    self._drop(oldest)
+
+  def put(self, m):
+    """
+    Stores message m. Returns False if m was dropped because the queue is
+    full, True otherwise.
+    """
+    if self.capacity <= 0:
+      self._drop(m.messageID)
+      return False
+
+    if self._size >= self.capacity:
+      if self.policy == DROP_NEWEST:
+        self._drop(m.messageID)
+        return False
+      self._evict_oldest()
+
+    q = self._queues.get(m.messageID)
+    if q is None:
+      q = self._queues[m.messageID] = deque()
+    q.append((next(self._seq), m))
+    self._size += 1
+    return True
+
+  # so code treating message_queue as a list keeps working
+  append = put
+
+  def pop(self, messageID):
+    """
+    Removes and returns the oldest message with the given ID, or None if there
+    isn't one.
+    """
+    q = self._queues.get(messageID)
+    if not q:
+      return None
+    self._size -= 1
+    return q.popleft()[1]
+
+  def discard(self, messageID):
+    """
+    Removes all messages with the given ID, returning how many were removed.
+    """
+    q = self._queues.pop(messageID, None)
+    if not q:
+      return 0
+    self._size -= len(q)
+    return len(q)
+
+  def clear(self):
+    self._queues.clear()
+    self._size = 0
+
+  def counts(self):
+    """
+    Returns a dict of message name -> number of messages held
+    """
+    return dict((message.message_name(mid), len(q))
+                for mid, q in self._queues.items() if q)
+
+  def __repr__(self):
+    return 'MessageQueue(%d/%d, dropped=%d)'%(self._size, self.capacity,
+                                              self.dropped_total)
@@ -30,3 +30,5 @@ class MTS50(Controller):
 
     self.linear_range = (0,50)
 
+    # replace the limits above with tuned ones, if this stage was profiled
+    self.apply_tuned_profile()
@@ -0,0 +1,175 @@
+"""
+Step scan executor that overlaps acquisition post-processing with motion.
+
+A step scan visits a list of points, and at each point acquires some data.
+Run naively, every point costs move + acquire + process. ScanPipeline keeps
+move and acquire strictly sequential, since the stage must not move while
+acquiring, but
+
+  - prepares the next move (e.g. converts and packs it) on a helper thread
+    while the current acquisition runs, so it can be sent the moment
+    acquisition ends
+  - hands the acquired data to a pool of worker threads for processing while
+    the stage moves on to the next point
+  - bounds the amount of data in flight to depth buffers, blocking the scan
+    if processing falls that far behind
+
+Example:
+
+  pipe = ScanPipeline(move=stage.moveAbsolute, acquire=camera.grab,
+                      process=analyse)
+  results = pipe.run(points)
+  print(pipe.report())
+"""
+from __future__ import absolute_import, division
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from .instrument import LatencyHistogram, now_ns
+
+class ScanPipeline(object):
+  PHASES = ('prepare', 'move', 'acquire', 'process', 'backpressure')
+
+  def __init__(self, move, acquire, process=None, prepare=None, workers=2,
+               depth=2):
+    """
+    move(prepared) moves to a point and returns once the stage is there.
+
+    prepare(point) returns whatever move() needs, and defaults to passing
+    the point through unchanged. It runs on a helper thread, at the same
+    time as acquire() of the previous point, so it must not touch the stage
+    either.
+
+    acquire(index, point) acquires data at the point, and is always called
+    with the stage stationary.
+
+    process(index, point, data) post-processes the acquired data and returns
+    the result for the point. It runs on a worker thread while the scan
+    continues, so it must not touch the stage. If None, the acquired data is
+    the result.
+
+    workers is the number of processing threads and depth the maximum number
+    of points acquired but not yet processed.
+    """
+    super(ScanPipeline, self).__init__()
+    self.move = move
+    self.acquire = acquire
+    self.process = process
+    self.prepare = prepare
+    self.workers = workers
+    self.depth = max(1, depth)
+    # timings are added to from the worker threads too
+    self._lock = threading.Lock()
+    self.reset_timings()
+
+  def reset_timings(self):
+    self.timings = dict((p, LatencyHistogram()) for p in self.PHASES)
+    self.total_ns = 0
+
+  def _timed(self, phase, fn, *args):
+    st = now_ns()
+    try:
+      return fn(*args)
+    finally:
+      elapsed = now_ns() - st
+      with self._lock:
+        self.timings[phase].add(elapsed)
+
+  def _process(self, index, point, data):
+    return self._timed('process', self.process, index, point, data)
+
+  def run(self, points, start=0, on_point=None):
+    """
+    Visits points in order, starting at index start, and returns the list of
+    results, one per visited point, in order.
+
+    on_point(index, point, result), if given, is called in scan order as the
+    result of each point becomes available.
+    """
+    points = points[start:] if start else points
+    prepare = self.prepare or (lambda p: p)
+    results = []
+    inflight = deque()
+
+    def retire(block):
+      while inflight and (block or inflight[0][2].done()):
+        index, point, fut = inflight.popleft()
+        result = fut.result()
+        results.append(result)
+        if on_point is not None:
+          on_point(index, point, result)
+
+    t0 = now_ns()
+    pool = ThreadPoolExecutor(max_workers=self.workers) if self.process \
+           else None
+    # the default prepare is free, so only a real one gets a thread
+    preparer = ThreadPoolExecutor(max_workers=1) if self.prepare else None
+    try:
+      it = iter(enumerate(points, start))
+      nxt = next(it, None)
+      if nxt is not None:
+        nxt = nxt + (self._timed('prepare', prepare, nxt[1]),)
+
+      while nxt is not None:
+        index, point, prepared = nxt
+        self._timed('move', self.move, prepared)
+
+        # get the following move ready while we acquire
+        nxt = next(it, None)
+        pending = None
+        if nxt is not None:
+          if preparer is not None:
+            pending = preparer.submit(self._timed, 'prepare', prepare, nxt[1])
+          else:
+            nxt = nxt + (self._timed('prepare', prepare, nxt[1]),)
+
+        data = self._timed('acquire', self.acquire, index, point)
+        if pending is not None:
+          nxt = nxt + (pending.result(),)
+
+        if pool is None:
+          results.append(data)
+          if on_point is not None:
+            on_point(index, point, data)
+          continue
+
+        if len(inflight) >= self.depth:
+          st = now_ns()
+          inflight[0][2].result()
+          self.timings['backpressure'].add(now_ns() - st)
+        retire(False)
+        inflight.append((index, point,
+                         pool.submit(self._process, index, point, data)))
+
+      retire(True)
+    finally:
+      if preparer is not None:
+        preparer.shutdown(wait=True)
+      if pool is not None:
+        pool.shutdown(wait=True)
+      self.total_ns += now_ns() - t0
+
+    return results
+
+  def summary(self):
+    """
+    Returns a dict of phase -> histogram snapshot, plus the total wall time.
+    """
+    ret = dict((p, h.snapshot()) for p, h in self.timings.items())
+    ret['total_ns'] = self.total_ns
+    return ret
+
+  def report(self):
+    """
+    Returns a human readable breakdown of where the scan time went.
+    Preparing and processing happen on other threads, so their totals may
+    overlap the others.
+    """
+    lines = ['total %.3fs'%(self.total_ns / 1e9)]
+    for p in self.PHASES:
+      h = self.timings[p]
+      share = 100.0 * h.total_ns / self.total_ns if self.total_ns else 0
+      lines.append('%-12s %7d calls %10.3fs %6.1f%% mean %.3fms'%(
+                    p, h.count, h.total_ns / 1e9, share, h.mean_ns / 1e6))
+    return '\n'.join(lines)
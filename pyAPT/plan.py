@@ -0,0 +1,468 @@
+"""
+Scan plans stored as files, for scans too large to hold as Python lists.
+
+A plan file holds one record per point, with the target of every stage axis
+in mm, a dwell time in seconds and flags, as a NumPy structured array that is
+memory-mapped rather than loaded. The file layout is
+
+  header: 8s magic 'APTPLN01', H number of axes, H reserved,
+          I length of the configuration, Q number of points,
+          20s SHA-1 of the point records
+  the stage configuration as JSON
+  padding to a multiple of 64 bytes
+  the point records
+
+Plans are written in chunks with PlanWriter, or write_plan(), so they never
+have to exist in memory as a whole, e.g.
+
+  write_plan('scan.plan', raster_chunks(lower, upper, step), config=config)
+
+PlanExecutor runs a plan on a set of controllers a window of points at a
+time: each window is range checked and its move frames packed in one go,
+and completion is recorded per point in a CompletionMap next to the plan, so
+an interrupted run resumes with the points not yet done.
+
+This module requires NumPy, which is why it is not imported by pyAPT itself.
+"""
+from __future__ import absolute_import, division
+import hashlib
+import json
+import os
+import struct as st
+import time
+
+import numpy as np
+
+from . import message
+from .controller import OutOfRangeError
+from .group import synchronized_start
+from .journal import config_digest
+from .settle import IMMEDIATE
+from .timing import DwellScheduler
+
+# os.rename() doesn't replace an existing file on Windows
+_replace = getattr(os, 'replace', os.rename)
+
+MAGIC = b'APTPLN01'
+_HEADER = st.Struct('<8sHHIQ20s')
+_ALIGN = 64
+
+DONE_MAGIC = b'APTDON01'
+_DONE_HEADER = st.Struct('<8s20sQ')
+
+# point flags
+FLAG_ACQUIRE = 0x01   # call visit() once the stage is at the point
+FLAG_SKIP = 0x02      # don't go to the point at all
+
+class PlanError(Exception):
+  pass
+
+class PlanChecksumError(PlanError):
+  pass
+
+class PlanMismatchError(PlanError):
+  pass
+
+def plan_dtype(naxes):
+  return np.dtype([('target', '<f8', (naxes, )),
+                   ('dwell', '<f4'),
+                   ('flags', '<u4')])
+
+def _data_offset(config_len):
+  n = _HEADER.size + config_len
+  return (n + _ALIGN - 1) // _ALIGN * _ALIGN
+
+class PlanWriter(object):
+  """
+  Writes a plan file chunk by chunk. The file is written under a temporary
+  name and renamed into place by close(), so a plan file is always complete.
+
+    with PlanWriter('scan.plan', 3, config) as w:
+      for chunk in chunks:
+        w.append(chunk)
+  """
+  def __init__(self, path, naxes, config=None):
+    super(PlanWriter, self).__init__()
+    self.path = path
+    self.naxes = naxes
+    self.dtype = plan_dtype(naxes)
+    self.npoints = 0
+
+    self._config = json.dumps(config or {}, sort_keys=True,
+                              default=str).encode()
+    self._sha = hashlib.sha1()
+    self._tmp = path + '.tmp'
+    self._file = open(self._tmp, 'wb')
+    self._write_header()
+    self._file.write(self._config)
+    self._file.write(b'\x00' * (_data_offset(len(self._config)) -
+                                _HEADER.size - len(self._config)))
+
+  def _write_header(self):
+    self._file.write(_HEADER.pack(MAGIC, self.naxes, 0, len(self._config),
+                                  self.npoints, self._sha.digest()))
+
+  def append(self, targets, dwell=0.0, flags=FLAG_ACQUIRE):
+    """
+    Appends points. targets is an array of shape (n, naxes) in mm, dwell and
+    flags are scalars or arrays of n values.
+    """
+    targets = np.asarray(targets, dtype=float).reshape(-1, self.naxes)
+    recs = np.zeros(len(targets), dtype=self.dtype)
+    recs['target'] = targets
+    recs['dwell'] = dwell
+    recs['flags'] = flags
+    data = recs.tobytes()
+    self._sha.update(data)
+    self._file.write(data)
+    self.npoints += len(recs)
+
+  def close(self):
+    if self._file is None:
+      return
+    self._file.seek(0)
+    self._write_header()
+    self._file.close()
+    self._file = None
+    _replace(self._tmp, self.path)
+
+  def abort(self):
+    """
+    Discards the plan being written
+    """
+    if self._file is not None:
+      self._file.close()
+      self._file = None
+      os.remove(self._tmp)
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, type_, value, traceback):
+    if type_ is None:
+      self.close()
+    else:
+      self.abort()
+
+def write_plan(path, targets, dwell=0.0, flags=FLAG_ACQUIRE, config=None):
+  """
+  Writes a plan file. targets is an array of shape (n, naxes), or an
+  iterable of such arrays, e.g. from raster_chunks(), which are written one
+  at a time. Returns the number of points written.
+  """
+  if hasattr(targets, 'shape'):
+    targets = [targets]
+
+  writer = None
+  try:
+    for chunk in targets:
+      chunk = np.asarray(chunk, dtype=float)
+      if writer is None:
+        writer = PlanWriter(path, chunk.shape[-1], config)
+      writer.append(chunk, dwell, flags)
+  except:
+    if writer is not None:
+      writer.abort()
+    raise
+  if writer is None:
+    raise PlanError('Plan has no points')
+  writer.close()
+  return writer.npoints
+
+def raster_chunks(lower, upper, step, chunk=1 << 16):
+  """
+  Yields the points of a 3D raster scan from lower to upper in chunks of at
+  most chunk points, in the same order as LinearStage.rasterPoints(): x
+  fastest, reversing direction every row, y reversing direction every
+  layer, and z slowest.
+  """
+  lower = np.asarray(lower, dtype=float)
+  upper = np.asarray(upper, dtype=float)
+  counts = np.floor((upper - lower) / step + 1e-9).astype(np.int64) + 1
+  nx, ny, nz = counts.tolist()
+  total = nx * ny * nz
+
+  for start in range(0, total, chunk):
+    k = np.arange(start, min(start + chunk, total), dtype=np.int64)
+    iz = k // (nx * ny)
+    r = k % (nx * ny)
+    iy = r // nx
+    ix = r % nx
+    row = iz * ny + iy
+    ix = np.where(row % 2, nx - 1 - ix, ix)
+    iy = np.where(iz % 2, ny - 1 - iy, iy)
+    yield lower + np.stack([ix, iy, iz], axis=1) * step
+
+class PlanFile(object):
+  """
+  A plan file opened for reading. records is a read-only memory map of the
+  point records, config the stage configuration stored with the plan.
+  """
+  def __init__(self, path, verify=True):
+    super(PlanFile, self).__init__()
+    self.path = path
+    with open(path, 'rb') as f:
+      head = f.read(_HEADER.size)
+      if len(head) < _HEADER.size:
+        raise PlanError('%s: truncated header'%(path))
+      magic, naxes, _, config_len, npoints, checksum = _HEADER.unpack(head)
+      if magic != MAGIC:
+        raise PlanError('%s is not a plan file'%(path))
+      self.config = json.loads(f.read(config_len).decode())
+
+    self.naxes = naxes
+    self.npoints = npoints
+    self.checksum = checksum
+    self.dtype = plan_dtype(naxes)
+
+    offset = _data_offset(config_len)
+    expected = offset + npoints * self.dtype.itemsize
+    if os.path.getsize(path) != expected:
+      raise PlanError('%s: expected %d bytes, found %d'%(
+                      path, expected, os.path.getsize(path)))
+    if npoints:
+      self.records = np.memmap(path, dtype=self.dtype, mode='r',
+                               offset=offset, shape=(npoints, ))
+    else:
+      self.records = np.zeros(0, dtype=self.dtype)
+
+    if verify:
+      self.verify()
+
+  def __len__(self):
+    return self.npoints
+
+  @property
+  def config_digest(self):
+    return config_digest(self.config)
+
+  def check_config(self, config):
+    """
+    Raises PlanMismatchError unless the plan was written for config
+    """
+    if self.config_digest != config_digest(config):
+      raise PlanMismatchError('%s was written for a different stage '
+                              'configuration'%(self.path))
+
+  def verify(self, chunk=1 << 16):
+    """
+    Checks the records against the checksum in the header, reading them in
+    chunks. Raises PlanChecksumError if they differ.
+    """
+    sha = hashlib.sha1()
+    for start in range(0, self.npoints, chunk):
+      sha.update(np.ascontiguousarray(self.records[start:start + chunk]).tobytes())
+    if sha.digest() != self.checksum:
+      raise PlanChecksumError('%s: checksum mismatch'%(self.path))
+
+  def close(self):
+    mm = getattr(self.records, '_mmap', None)
+    self.records = None
+    if mm is not None:
+      mm.close()
+
+class CompletionMap(object):
+  """
+  Records which points of a plan are done, one bit per point, in a sidecar
+  file memory-mapped for writing. The file is tied to the plan by its
+  checksum; a map for a different plan, or any map if restart is True, is
+  started afresh.
+  """
+  def __init__(self, plan, path=None, restart=False):
+    super(CompletionMap, self).__init__()
+    self.path = path or plan.path + '.done'
+    self.npoints = plan.npoints
+    nbytes = (self.npoints + 7) // 8
+    header = _DONE_HEADER.pack(DONE_MAGIC, plan.checksum, self.npoints)
+
+    valid = False
+    if not restart and os.path.exists(self.path):
+      with open(self.path, 'rb') as f:
+        valid = (f.read(_DONE_HEADER.size) == header and
+                 os.path.getsize(self.path) == _DONE_HEADER.size + nbytes)
+    if not valid:
+      with open(self.path, 'wb') as f:
+        f.write(header)
+        f.truncate(_DONE_HEADER.size + nbytes)
+
+    self.resumed = valid
+    if nbytes:
+      self.bits = np.memmap(self.path, dtype=np.uint8, mode='r+',
+                            offset=_DONE_HEADER.size, shape=(nbytes, ))
+    else:
+      self.bits = np.zeros(0, dtype=np.uint8)
+
+  def mark(self, index):
+    self.bits[index >> 3] |= np.uint8(1 << (index & 7))
+
+  def is_done(self, index):
+    return bool(self.bits[index >> 3] & (1 << (index & 7)))
+
+  def done_mask(self, start, stop):
+    """
+    Returns a boolean array telling which of the points start..stop-1 are
+    done
+    """
+    first = start >> 3
+    bits = np.unpackbits(np.asarray(self.bits[first:(stop + 7) >> 3]),
+                         bitorder='little')
+    offset = start - first * 8
+    return bits[offset:offset + stop - start].astype(bool)
+
+  def count(self):
+    """
+    Returns the number of points done
+    """
+    return int(np.unpackbits(np.asarray(self.bits)).sum())
+
+  def flush(self):
+    if hasattr(self.bits, 'flush'):
+      self.bits.flush()
+
+  def close(self):
+    self.flush()
+    mm = getattr(self.bits, '_mmap', None)
+    self.bits = None
+    if mm is not None:
+      mm.close()
+
+  def remove(self):
+    self.close()
+    os.remove(self.path)
+
+def pack_moves(con, positions, channel=1):
+  """
+  Returns the MGMSG_MOT_MOVE_ABSOLUTE frames for moving con to each of
+  positions, in mm, as an (n, 12) array of bytes, packed in one go from a
+  template frame. Positions must have been range checked.
+  """
+  template = con.move_frames(con.linear_range[0], channel)[0][1]
+  template = np.frombuffer(template, dtype=np.uint8)
+  frames = np.tile(template, (len(positions), 1))
+  counts = con.to_apt(positions).astype('<i4')
+  frames[:, -4:] = counts.view(np.uint8).reshape(-1, 4)
+  return frames
+
+class PlanExecutor(object):
+  def __init__(self, plan, controllers, visit=None, done=None, window=4096,
+               settle=IMMEDIATE, channel=1, flush_every=256, timing=None):
+    """
+    Prepares to run plan, a PlanFile, on controllers, where controllers[i]
+    drives axis i of the plan targets.
+
+    visit(index, target) is called at every point flagged FLAG_ACQUIRE, with
+    the stage stationary, after the point's dwell.
+
+    done is the CompletionMap to record progress in, by default the one
+    next to the plan file. Points already marked done are skipped.
+
+    window is the number of points read, range checked and packed at a time,
+    which bounds memory use. settle is the settle.SettlePolicy applied after
+    every move. Completion is flushed to disk every flush_every points.
+
+    timing is the timing.DwellScheduler timing and logging the dwells, by
+    default a new one.
+    """
+    super(PlanExecutor, self).__init__()
+    if plan.naxes != len(controllers):
+      raise PlanError('Plan has %d axes, but %d controllers were given'%(
+                      plan.naxes, len(controllers)))
+    self.plan = plan
+    self.controllers = list(controllers)
+    self.visit = visit
+    self.done = done if done is not None else CompletionMap(plan)
+    self.window = window
+    self.settle = settle
+    self.channel = channel
+    self.flush_every = flush_every
+    self.timing = timing if timing is not None else DwellScheduler()
+
+    self.visited = 0
+    self.moves = 0
+    self.elapsed = None
+
+  def validate(self):
+    """
+    Range checks every target of the plan against the controllers, a window
+    at a time. Raises OutOfRangeError for the first point out of range.
+    """
+    for start in range(0, len(self.plan), self.window):
+      self._check(self.plan.records[start:start + self.window]['target'])
+
+  def _check(self, targets):
+    for axis, con in enumerate(self.controllers):
+      if not con.soft_limits:
+        continue
+      bad = con.out_of_range(targets[:, axis])
+      if len(bad):
+        raise OutOfRangeError(float(targets[bad[0], axis]), con.linear_range)
+
+  def run(self, validate=True):
+    """
+    Runs the points of the plan not yet done, in order, and returns the
+    number visited by this run. Axes whose target doesn't change from one
+    point to the next are not moved. Completion is flushed to disk before
+    returning, including when interrupted.
+    """
+    if validate:
+      self.validate()
+
+    started = time.time()
+    cons = self.controllers
+    # last commanded position of each axis, in encoder counts
+    last = [int(con.to_apt([con.position(self.channel)])[0]) for con in cons]
+
+    try:
+      for start in range(0, len(self.plan), self.window):
+        stop = min(start + self.window, len(self.plan))
+        todo = ~self.done.done_mask(start, stop)
+        if not todo.any():
+          continue
+
+        recs = np.array(self.plan.records[start:stop])
+        targets = recs['target']
+        if not validate:
+          self._check(targets)
+        frames = [pack_moves(con, targets[:, axis], self.channel)
+                  for axis, con in enumerate(cons)]
+        counts = [con.to_apt(targets[:, axis])
+                  for axis, con in enumerate(cons)]
+
+        for j in np.flatnonzero(todo):
+          self._run_point(start + int(j), recs[j], frames, counts, j, last)
+    finally:
+      self.done.flush()
+      self.elapsed = time.time() - started
+    return self.visited
+
+  def _run_point(self, index, rec, frames, counts, j, last):
+    flags = int(rec['flags'])
+    if not flags & FLAG_SKIP:
+      # start every axis that has to move together, then wait for all of
+      # them
+      n = len(self.controllers)
+      positions = [None] * n
+      moves = [None] * n
+      for axis in range(n):
+        if counts[axis][j] == last[axis]:
+          continue
+        positions[axis] = float(rec['target'][axis])
+        moves[axis] = [(message.MGMSG_MOT_MOVE_ABSOLUTE,
+                        frames[axis][j].tobytes())]
+        last[axis] = counts[axis][j]
+
+      moving = n - positions.count(None)
+      if moving:
+        synchronized_start(self.controllers, positions, self.channel,
+                           settle=self.settle, frames=moves)
+      self.moves += moving
+
+      if rec['dwell'] > 0:
+        self.timing.dwell(float(rec['dwell']), index)
+      if self.visit is not None and flags & FLAG_ACQUIRE:
+        self.visit(index, rec['target'])
+      self.visited += 1
+
+    self.done.mark(index)
+    if index % self.flush_every == 0:
+      self.done.flush()
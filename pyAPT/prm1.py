@@ -1,5 +1,6 @@
 from __future__ import absolute_import, division
 from .controller import Controller
+from . import rotary
 
 class PRM1(Controller):
   """
@@ -34,3 +35,63 @@ class PRM1(Controller):
 
     self.linear_range = (-180,180)
 
+    # the stage turns continuously and the position counter is not wrapped,
+    # so goto_angle() and rotate() move to unwrapped angles, see rotary.
+    # This range only keeps the counter well within 32 bits
+    self.unwrapped_range = (-360 * 1000, 360 * 1000)
+
+    # homing takes at most a full turn
+    self.homing_distance = 360
+
+    # replace the limits above with tuned ones, if this stage was profiled
+    self.apply_tuned_profile()
+
+  def angle(self, channel=1):
+    """
+    Returns the current angle in degrees, wrapped to [-180, 180). position()
+    returns the unwrapped angle.
+    """
+    return rotary.wrap(self.position(channel))
+
+  def goto_angle(self, angle, direction=rotary.SHORTEST, channel=1, wait=True,
+                 settle=None):
+    """
+    Rotates to angle, in degrees, going the shortest way round by default,
+    or as given by direction, see rotary. A move from 179 to -179 degrees is
+    then a 2 degree move rather than 358.
+
+    The unwrapped angle moved to is checked against self.unwrapped_range
+    rather than self.linear_range. Returns what goto() returns.
+    """
+    current = self.position(channel)
+    return self._goto(rotary.target(current, angle, direction), channel, wait,
+                      settle, self.unwrapped_range)
+
+  def rotate(self, degrees, channel=1, wait=True, settle=None):
+    """
+    Rotates by degrees, which may be more than a full turn, in the direction
+    of its sign. The unwrapped angle moved to is checked against
+    self.unwrapped_range.
+    """
+    target = self.position(channel) + degrees
+    return self._goto(target, channel, wait, settle, self.unwrapped_range)
+
+  def plan_angles(self, angles, start=None):
+    """
+    Returns the indices of angles in the order that visits them all in the
+    least time, starting from start or the current position, with the
+    current velocity limits. See rotary.plan_angles().
+    """
+    if start is None:
+      start = self.position()
+    return rotary.plan_angles(angles, start, self.move_time)
+
+  def plan_scan(self, points, angle_index=0, start=None):
+    """
+    Orders the points of a scan combining this rotation stage with linear
+    axes, see rotary.plan_scan(). Returns the indices of points in visit
+    order.
+    """
+    if start is None:
+      start = self.position()
+    return rotary.plan_scan(points, start, angle_index, self.move_time)
@@ -0,0 +1,409 @@
+"""
+Timeline profiling of scans.
+
+ScanProfiler records where the time of a scan goes, point by point, as spans
+with a begin and an end on a timeline:
+
+  comm      writing messages to a controller and waiting for its replies
+  motion    waiting for a move to complete
+  settle    settle policy polling after a move
+  overhead  time of a point not covered by any span, i.e. Python
+
+plus the phases the scan loop marks itself, e.g. dwell, acquire or plot.
+Controllers are hooked through their instrumentation, see
+Controller.enable_instrumentation(), so comm, motion and settle are recorded
+per axis without changing the code driving them:
+
+  prof = ScanProfiler(sample=10)
+  prof.attach(xcon, 'x')
+  prof.attach(ycon, 'y')
+  for k, point in enumerate(points):
+    with prof.point(k):
+      move_to(point)
+      with prof.phase('acquire'):
+        acquire()
+  print(prof.report())
+  prof.export_chrome_trace('scan.json')
+
+Only every sample-th point is recorded. The others cost two clock reads
+each, so the profiling overhead of a long scan can be kept down by sampling,
+report() gives an estimate of it. The trace file opens in chrome://tracing,
+with one track per axis and one per thread of the scan loop.
+"""
+from __future__ import absolute_import, division
+import json
+import threading
+
+from . import message
+from .instrument import NULL_SPAN, now_ns
+
+# waits for these are motion rather than communication
+_MOTION_IDS = (message.MGMSG_MOT_MOVE_COMPLETED,
+               message.MGMSG_MOT_MOVE_STOPPED,
+               message.MGMSG_MOT_MOVE_HOMED)
+
+def _ignore(*args):
+  pass
+
+class _Span(object):
+  def __init__(self, profiler, name, track):
+    self.profiler = profiler
+    self.name = name
+    self.track = track
+
+  def __enter__(self):
+    self.st = now_ns()
+    return self
+
+  def __exit__(self, type_, value, traceback):
+    self.profiler._add(self.name, self.track, self.st, now_ns())
+    return False
+
+class _Point(object):
+  def __init__(self, profiler, index):
+    self.profiler = profiler
+    self.index = index
+
+  def __enter__(self):
+    prof = self.profiler
+    self.sampled = self.index % prof.sample == 0
+    prof._point = self.index if self.sampled else None
+    prof.active = self.sampled
+    self.st = now_ns()
+    return self
+
+  def __exit__(self, type_, value, traceback):
+    end = now_ns()
+    prof = self.profiler
+    prof.points += 1
+    prof.point_ns += end - self.st
+    if self.sampled:
+      prof.sampled += 1
+      prof.events.append(('point', threading.current_thread().name, self.st,
+                          end, self.index))
+    prof._point = None
+    prof.active = True
+    return False
+
+class _ControllerHooks(object):
+  """
+  Takes the place of the instrumentation of a controller, recording its
+  traffic on the timeline of a ScanProfiler, under the track name, and
+  passing everything on to the instrumentation it replaced, if any
+  """
+  def __init__(self, profiler, name, inner):
+    super(_ControllerHooks, self).__init__()
+    self.profiler = profiler
+    self.name = name
+    self.inner = inner
+
+  def __getattr__(self, name):
+    if self.inner is not None:
+      return getattr(self.inner, name)
+    # record_read(), record_receive() and the like aren't on the timeline
+    if name.startswith('record_'):
+      return _ignore
+    raise AttributeError(name)
+
+  def record_send(self, messageID, nbytes, elapsed_ns):
+    self.profiler._add_elapsed('comm', self.name, elapsed_ns)
+    if self.inner is not None:
+      self.inner.record_send(messageID, nbytes, elapsed_ns)
+
+  def record_batch(self, frames, elapsed_ns):
+    self.profiler._add_elapsed('comm', self.name, elapsed_ns)
+    if self.inner is not None:
+      self.inner.record_batch(frames, elapsed_ns)
+
+  def record_wait(self, messageID, elapsed_ns):
+    # the end of a move is waited for within an operation.wait span, which
+    # is recorded as motion
+    if messageID not in _MOTION_IDS:
+      self.profiler._add_elapsed('comm', self.name, elapsed_ns)
+    if self.inner is not None:
+      self.inner.record_wait(messageID, elapsed_ns)
+
+  def record_span(self, name, elapsed_ns):
+    if name.endswith('.wait'):
+      self.profiler._add_elapsed('motion', self.name, elapsed_ns)
+    elif name.endswith('.settle'):
+      self.profiler._add_elapsed('settle', self.name, elapsed_ns)
+    elif not name.endswith('.move'):
+      # spans around moves only hold the operation.wait span
+      self.profiler._add_elapsed(name, self.name, elapsed_ns)
+    if self.inner is not None:
+      self.inner.record_span(name, elapsed_ns)
+
+  def span(self, name):
+    return _ControllerSpan(self, name)
+
+class _ControllerSpan(object):
+  def __init__(self, hooks, name):
+    self.hooks = hooks
+    self.name = name
+
+  def __enter__(self):
+    self.st = now_ns()
+    return self
+
+  def __exit__(self, type_, value, traceback):
+    self.hooks.record_span(self.name, now_ns() - self.st)
+    return False
+
+class ScanProfiler(object):
+  def __init__(self, sample=1):
+    """
+    sample is the interval between recorded points: 1 records every point,
+    10 every tenth. Spans outside of points, e.g. homing before the scan,
+    are always recorded.
+    """
+    super(ScanProfiler, self).__init__()
+    if sample < 1:
+      raise ValueError('sample must be at least 1')
+    self.sample = sample
+    # (phase, track, start ns, end ns, point index or None)
+    self.events = []
+    # number and total time of all points, sampled or not
+    self.points = 0
+    self.point_ns = 0
+    self.sampled = 0
+    # whether spans are being recorded, False during points not sampled
+    self.active = True
+    self.started_ns = now_ns()
+    self._point = None
+    # controller -> its hooks
+    self._hooks = {}
+    # names of the tracks of controllers
+    self._axis_tracks = set()
+    self._cost = None
+
+  def attach(self, con, name=None):
+    """
+    Records the traffic of con, on the track name, by default its serial
+    number. Instrumentation already enabled on con keeps working.
+    """
+    if con in self._hooks:
+      return
+    if name is None:
+      name = str(con.serial_number)
+    hooks = _ControllerHooks(self, name, con.instrumentation)
+    self._hooks[con] = hooks
+    self._axis_tracks.add(name)
+    con.instrumentation = hooks
+
+  def detach(self, con=None):
+    """
+    Stops recording con, or every controller attached if None, putting back
+    the instrumentation they had
+    """
+    cons = list(self._hooks) if con is None else [con]
+    for c in cons:
+      hooks = self._hooks.pop(c, None)
+      if hooks is not None and c.instrumentation is hooks:
+        c.instrumentation = hooks.inner
+
+  def point(self, index):
+    """
+    Returns a context manager marking the scan point index. Whether the
+    point is recorded depends on sample.
+    """
+    return _Point(self, index)
+
+  def phase(self, name, track=None):
+    """
+    Returns a context manager recording the enclosed block as phase name, on
+    track, by default the name of the current thread
+    """
+    if not self.active:
+      return NULL_SPAN
+    if track is None:
+      track = threading.current_thread().name
+    return _Span(self, name, track)
+
+  def _add(self, phase, track, start_ns, end_ns):
+    if self.active:
+      self.events.append((phase, track, start_ns, end_ns, self._point))
+
+  def _add_elapsed(self, phase, track, elapsed_ns):
+    if self.active:
+      end = now_ns()
+      self.events.append((phase, track, end - elapsed_ns, end, self._point))
+
+  def reset(self):
+    self.events = []
+    self.points = 0
+    self.point_ns = 0
+    self.sampled = 0
+    self.started_ns = now_ns()
+
+  def _self_times(self):
+    """
+    Returns the time of every event not spent in events nested in it on the
+    same track, in the order of self.events
+    """
+    own = [e[3] - e[2] for e in self.events]
+    order = sorted(range(len(self.events)),
+                   key=lambda i: (self.events[i][1], self.events[i][2],
+                                  -self.events[i][3]))
+    stack = []
+    track = None
+    for i in order:
+      phase, tr, st, end, _ = self.events[i]
+      if tr != track:
+        stack = []
+        track = tr
+      while stack and self.events[stack[-1]][3] <= st:
+        stack.pop()
+      if stack:
+        own[stack[-1]] -= end - st
+      stack.append(i)
+    return own
+
+  def _overhead_ns(self):
+    """
+    Returns the total time of the sampled points not covered by any span
+    """
+    spans = {}
+    points = []
+    for phase, _, st, end, p in self.events:
+      if p is None:
+        continue
+      if phase == 'point':
+        points.append((p, st, end))
+      else:
+        spans.setdefault(p, []).append((st, end))
+
+    total = 0
+    for p, pst, pend in points:
+      covered = 0
+      last = pst
+      for st, end in sorted(spans.get(p, [])):
+        st = max(st, last)
+        end = min(end, pend)
+        if end > st:
+          covered += end - st
+          last = end
+      total += pend - pst - covered
+    return total
+
+  def _calibrate(self):
+    """
+    Measures the cost of recording a span and of a point that isn't sampled
+    """
+    if self._cost is None:
+      n = 1000
+      prof = ScanProfiler(sample=n + 1)
+      st = now_ns()
+      for _ in range(n):
+        prof._add_elapsed('comm', 'x', 0)
+      span_ns = (now_ns() - st) / n
+      st = now_ns()
+      for k in range(1, n + 1):
+        with prof.point(k):
+          pass
+      self._cost = (span_ns, (now_ns() - st) / n)
+    return self._cost
+
+  def summary(self):
+    """
+    Returns a dict with the number of points, sampled points, total time of
+    all points and of the sampled ones, the time not covered by any span in
+    the sampled points, the estimated cost of profiling, and 'phases' and
+    'tracks', mapping phase and (phase, track) to the count, total and self
+    time of the spans in sampled points, all times in ns
+    """
+    own = self._self_times()
+    phases = {}
+    tracks = {}
+    sampled_ns = 0
+    for (phase, track, st, end, p), self_ns in zip(self.events, own):
+      if p is None:
+        continue
+      if phase == 'point':
+        sampled_ns += end - st
+        continue
+      for table, key in ((phases, phase), (tracks, (phase, track))):
+        row = table.setdefault(key, {'count': 0, 'total_ns': 0,
+                                     'self_ns': 0})
+        row['count'] += 1
+        row['total_ns'] += end - st
+        row['self_ns'] += self_ns
+
+    span_ns, point_cost_ns = self._calibrate()
+    return {'points': self.points,
+            'sampled': self.sampled,
+            'point_ns': self.point_ns,
+            'sampled_ns': sampled_ns,
+            'overhead_ns': self._overhead_ns(),
+            'profiling_ns': int(len(self.events) * span_ns +
+                                self.points * point_cost_ns),
+            'phases': phases,
+            'tracks': tracks}
+
+  def report(self):
+    """
+    Returns a human readable table of where the time of the sampled points
+    went, by phase and by axis. Shares are of the time of the sampled
+    points; axes move in parallel, so they may add up to more than 100%.
+    """
+    s = self.summary()
+    base = s['sampled_ns'] or 1
+    lines = ['%d points, %d sampled (every %d), %.3fs in points, '
+             'profiling overhead ~%.2f%%'%(
+             s['points'], s['sampled'], self.sample, s['point_ns'] / 1e9,
+             100.0 * s['profiling_ns'] / (s['point_ns'] or 1))]
+
+    fmt = '%-24s %7s %10s %10s %7s'
+    def row(key, count, self_ns):
+      lines.append(fmt%(key, count, '%.3f'%(self_ns / 1e6),
+                        '%.3f'%(self_ns / 1e6 / count if count else 0),
+                        '%.1f%%'%(100.0 * self_ns / base)))
+
+    lines.append('')
+    lines.append(fmt%('phase', 'count', 'self ms', 'mean ms', 'share'))
+    for phase in sorted(s['phases'], key=lambda k: -s['phases'][k]['self_ns']):
+      p = s['phases'][phase]
+      row(phase, p['count'], p['self_ns'])
+    row('overhead', s['sampled'], s['overhead_ns'])
+
+    lines.append('')
+    lines.append(fmt%('phase/track', 'count', 'self ms', 'mean ms', 'share'))
+    tracks = s['tracks']
+    for key in sorted(tracks, key=lambda k: (k[1], -tracks[k]['self_ns'])):
+      t = tracks[key]
+      row('%s/%s'%key, t['count'], t['self_ns'])
+    return '\n'.join(lines)
+
+  def chrome_trace(self):
+    """
+    Returns the timeline as a Chrome trace event dict, with a complete event
+    per span, timestamps in us from the start of the profiler, and a track
+    per axis or thread
+    """
+    tids = {}
+    events = []
+    for phase, track, st, end, p in sorted(self.events,
+                                           key=lambda e: (e[2], -e[3])):
+      tid = tids.setdefault(track, len(tids) + 1)
+      ev = {'name': phase, 'cat': 'axis' if track in self._axis_tracks else
+            'scan', 'ph': 'X', 'pid': 1, 'tid': tid,
+            'ts': (st - self.started_ns) / 1e3, 'dur': (end - st) / 1e3}
+      if p is not None:
+        ev['args'] = {'point': p}
+      events.append(ev)
+
+    meta = [{'name': 'process_name', 'ph': 'M', 'pid': 1,
+             'args': {'name': 'pyAPT scan'}}]
+    for track, tid in sorted(tids.items(), key=lambda t: t[1]):
+      meta.append({'name': 'thread_name', 'ph': 'M', 'pid': 1, 'tid': tid,
+                   'args': {'name': track}})
+      meta.append({'name': 'thread_sort_index', 'ph': 'M', 'pid': 1,
+                   'tid': tid, 'args': {'sort_index': tid}})
+    return {'traceEvents': meta + events, 'displayTimeUnit': 'ms'}
+
+  def export_chrome_trace(self, path):
+    """
+    Writes chrome_trace() to the JSON file path
+    """
+    with open(path, 'w') as f:
+      json.dump(self.chrome_trace(), f)
@@ -0,0 +1,341 @@
+"""
+Host-side motion programs.
+
+A motion program is a list of segments for one or more controllers, called
+axes and numbered by their position in the list of controllers the program
+runs on:
+
+  prog = MotionProgram()
+  prog.velocity(0, max_velocity=2.0)
+  prog.absolute(0, 10)
+  prog.absolute(1, 5)
+  prog.barrier()              # wait until both axes are there
+  prog.dwell(0.5)             # on every axis
+  prog.relative(0, -2.5)
+
+  executor = ProgramExecutor(prog, [xcon, ycon])
+  timings = executor.run()
+  print(executor.report())
+
+Every frame of the program is packed, and every target range checked,
+before the first one is sent. Each axis then runs on its own thread, which
+writes its next command the moment the previous move completes, so the gaps
+between segments are USB turnaround rather than Python control flow.
+Barriers synchronise the axes they name, relative targets are taken relative
+to the previous target of the axis.
+"""
+from __future__ import absolute_import, division
+import threading
+
+from . import message
+from .controller import MoveStoppedError
+from .group import stop_all
+from .instrument import now_ns
+from .settle import IMMEDIATE
+from .timing import DwellScheduler
+
+ABSOLUTE = 'absolute'
+RELATIVE = 'relative'
+DWELL = 'dwell'
+VELOCITY = 'velocity'
+BARRIER = 'barrier'
+
+class ProgramAborted(Exception):
+  pass
+
+class Segment(object):
+  """
+  One step of a motion program. axes is the tuple of axes the segment
+  applies to, which has a single element except for barriers.
+  """
+  def __init__(self, kind, axes, value=None, acceleration=None):
+    super(Segment, self).__init__()
+    self.kind = kind
+    self.axes = axes
+    self.value = value
+    self.acceleration = acceleration
+
+  def __repr__(self):
+    return 'Segment(%s, axes=%s, %r)'%(self.kind, self.axes, self.value)
+
+class SegmentTiming(object):
+  """
+  When a segment of an axis ran, in seconds since the program started.
+  For moves, completed is when MGMSG_MOT_MOVE_COMPLETED arrived and end when
+  the settle policy was satisfied, for other segments they are the same.
+  """
+  def __init__(self, index, axis, kind, start, completed, end):
+    super(SegmentTiming, self).__init__()
+    self.index = index
+    self.axis = axis
+    self.kind = kind
+    self.start = start
+    self.completed = completed
+    self.end = end
+
+  @property
+  def duration(self):
+    return self.end - self.start
+
+  def __repr__(self):
+    return 'SegmentTiming(%d, axis=%d, %s, %.4fs)'%(self.index, self.axis,
+                                                   self.kind, self.duration)
+
+class MotionProgram(object):
+  def __init__(self, segments=None):
+    super(MotionProgram, self).__init__()
+    self.segments = list(segments or [])
+
+  def __len__(self):
+    return len(self.segments)
+
+  def absolute(self, axis, position):
+    """
+    Moves axis to position, in mm
+    """
+    self.segments.append(Segment(ABSOLUTE, (axis, ), position))
+    return self
+
+  def relative(self, axis, distance):
+    """
+    Moves axis by distance, in mm, from its previous target
+    """
+    self.segments.append(Segment(RELATIVE, (axis, ), distance))
+    return self
+
+  def dwell(self, seconds, axis=None):
+    """
+    Waits seconds on axis. If axis is None, every axis is synchronised with
+    a barrier and then waits.
+    """
+    if axis is None:
+      self.barrier()
+      self.segments.append(Segment(DWELL, None, seconds))
+    else:
+      self.segments.append(Segment(DWELL, (axis, ), seconds))
+    return self
+
+  def velocity(self, axis, max_velocity=None, acceleration=None):
+    """
+    Switches the trapezoidal velocity profile of axis for the following
+    moves. None means the controller's maximum.
+    """
+    self.segments.append(Segment(VELOCITY, (axis, ), max_velocity,
+                                 acceleration))
+    return self
+
+  def barrier(self, *axes):
+    """
+    Makes the given axes, or all axes if none are given, wait for each other
+    before going on
+    """
+    self.segments.append(Segment(BARRIER, axes or None))
+    return self
+
+class ProgramExecutor(object):
+  def __init__(self, program, controllers, settle=IMMEDIATE,
+               channel=1, timing=None):
+    """
+    Prepares program to run on controllers, where axis i of the program is
+    controllers[i]. Frames are packed, and range checked, here, so
+    OutOfRangeError is raised before anything moves.
+
+    settle is the settle.SettlePolicy applied after every move before the
+    next segment of the axis starts. The default starts it as soon as the
+    move completes.
+
+    timing is the timing.DwellScheduler timing the dwells, and logging them
+    by segment, by default a new one.
+
+    The start position of every axis is queried once, to resolve relative
+    targets.
+    """
+    super(ProgramExecutor, self).__init__()
+    self.program = program
+    self.controllers = list(controllers)
+    self.settle = settle
+    self.channel = channel
+    self.timing = timing if timing is not None else DwellScheduler()
+
+    self.timings = []
+    self.total = None
+    self._lock = threading.Lock()
+    self._aborted = threading.Event()
+    self._threads = []
+    self._errors = []
+    self._ops = self._compile()
+
+  def _compile(self):
+    naxes = len(self.controllers)
+    ops = [[] for _ in range(naxes)]
+    targets = [con.position(self.channel) for con in self.controllers]
+
+    for idx, seg in enumerate(self.program.segments):
+      axes = seg.axes
+      if axes is None:
+        axes = tuple(range(naxes))
+      for axis in axes:
+        if not 0 <= axis < naxes:
+          raise ValueError('Segment %d: no axis %d'%(idx, axis))
+
+      if seg.kind == BARRIER:
+        if len(axes) > 1:
+          barrier = threading.Barrier(len(axes))
+          for axis in axes:
+            ops[axis].append((idx, BARRIER, barrier))
+        continue
+
+      for axis in axes:
+        con = self.controllers[axis]
+        if seg.kind == DWELL:
+          ops[axis].append((idx, DWELL, seg.value))
+        elif seg.kind == VELOCITY:
+          frames = con.velocity_frames(seg.acceleration, seg.value,
+                                       self.channel)
+          ops[axis].append((idx, VELOCITY, frames))
+        elif seg.kind in (ABSOLUTE, RELATIVE):
+          if seg.kind == ABSOLUTE:
+            targets[axis] = seg.value
+          else:
+            targets[axis] += seg.value
+          frames = con.move_frames(targets[axis], self.channel)
+          target_apt = int(targets[axis] * con.position_scale)
+          ops[axis].append((idx, seg.kind, (frames, targets[axis],
+                                            target_apt)))
+        else:
+          raise ValueError('Segment %d: unknown kind %s'%(idx, seg.kind))
+    return ops
+
+  def _run_axis(self, axis, start_ns):
+    con = self.controllers[axis]
+    elapsed = lambda: (now_ns() - start_ns) / 1e9
+    try:
+      con.resume_end_of_move_messages()
+      for idx, kind, arg in self._ops[axis]:
+        if self._aborted.is_set():
+          raise ProgramAborted()
+        st = elapsed()
+        completed = None
+        if kind == BARRIER:
+          try:
+            arg.wait()
+          except threading.BrokenBarrierError:
+            raise ProgramAborted()
+        elif kind == DWELL:
+          self.timing.dwell(arg, idx)
+        elif kind == VELOCITY:
+          con.write_frames(arg)
+        else:
+          con.discard_messages(message.MGMSG_MOT_MOVE_COMPLETED,
+                               message.MGMSG_MOT_MOVE_STOPPED)
+          frames, target, target_apt = arg
+          con.write_frames(frames)
+          sts = con.wait_move_completed(target, self.channel)
+          completed = elapsed()
+          self.settle.wait(con, sts, target_apt, self.channel)
+        end = elapsed()
+        if completed is None:
+          completed = end
+        with self._lock:
+          self.timings.append(SegmentTiming(idx, axis, kind, st, completed,
+                                            end))
+    except MoveStoppedError as ex:
+      # expected when the program is aborted, an error otherwise
+      if not self._aborted.is_set():
+        self._fail(ex)
+    except ProgramAborted:
+      pass
+    except BaseException as ex:
+      self._fail(ex)
+
+  def _fail(self, ex):
+    """
+    Records the error of an axis, and aborts the program and stops every
+    axis, so one axis failing doesn't leave the others running into it
+    """
+    with self._lock:
+      self._errors.append(ex)
+    self._abort_barriers()
+    stop_all(self.controllers, immediate=True, wait=False,
+             channel=self.channel)
+
+  def _abort_barriers(self):
+    self._aborted.set()
+    for ops in self._ops:
+      for _, kind, arg in ops:
+        if kind == BARRIER:
+          arg.abort()
+
+  def start(self):
+    """
+    Starts executing the program in the background, one thread per axis
+    """
+    if self._threads:
+      raise RuntimeError('Program already started')
+    start_ns = now_ns()
+    self._start_ns = start_ns
+    self._threads = [threading.Thread(target=self._run_axis,
+                                      args=(axis, start_ns))
+                     for axis in range(len(self.controllers))]
+    for t in self._threads:
+      t.daemon = True
+      t.start()
+
+  def join(self):
+    """
+    Waits for the program to finish and returns the segment timings, sorted
+    by segment and axis. Re-raises the first error of any axis, e.g.
+    MotionFaultError, after which all axes will have been stopped.
+    """
+    for t in self._threads:
+      t.join()
+    self.total = (now_ns() - self._start_ns) / 1e9
+    self.timings.sort(key=lambda t: (t.index, t.axis))
+    if self._errors:
+      raise self._errors[0]
+    if self._aborted.is_set():
+      raise ProgramAborted()
+    return self.timings
+
+  def run(self):
+    """
+    Runs the program to completion, see start() and join()
+    """
+    self.start()
+    return self.join()
+
+  def abort(self, immediate=False):
+    """
+    Stops the program: no further segments are started, and the axes are
+    stopped with group.stop_all(). Call join() afterwards.
+    """
+    self._abort_barriers()
+    stop_all(self.controllers, immediate=immediate, wait=False,
+             channel=self.channel)
+
+  def report(self):
+    """
+    Returns a human readable summary of the timings of the last run
+    """
+    lines = ['%d segments in %.3fs'%(len(self.program), self.total or 0)]
+    kinds = {}
+    for t in self.timings:
+      n, total = kinds.get(t.kind, (0, 0))
+      kinds[t.kind] = (n + 1, total + t.duration)
+    for kind in sorted(kinds):
+      n, total = kinds[kind]
+      lines.append('%-10s %6d %10.3fs %10.4fs mean'%(kind, n, total,
+                                                     total / n))
+
+    # time between one move of an axis finishing and its next command going
+    # out, which is the host side overhead the executor is meant to remove
+    gaps = []
+    last = {}
+    for t in sorted(self.timings, key=lambda t: (t.axis, t.start)):
+      if t.axis in last:
+        gaps.append(t.start - last[t.axis])
+      last[t.axis] = t.end
+    if gaps:
+      lines.append('gap between segments: mean %.3fms, max %.3fms'%(
+                    sum(gaps) / len(gaps) * 1e3, max(gaps) * 1e3))
+    return '\n'.join(lines)
@@ -0,0 +1,124 @@
+"""
+Angle arithmetic and move planning for rotation stages.
+
+Rotation stages such as the PRM1 turn continuously, and their position
+counter keeps counting across turns, so the position a controller reports is
+an unwrapped angle. An angle in the usual sense is that position wrapped to
+[-180, 180). Moving to an angle can then go either way round, and
+target() picks the unwrapped position to move to:
+
+  SHORTEST  the shorter way round
+  FORWARD   towards increasing angles, up to one full turn
+  REVERSE   towards decreasing angles, up to one full turn
+
+plan_angles() orders angular waypoints to minimise total rotation time, and
+plan_scan() does the same for scans that combine rotation with linear axes.
+"""
+from __future__ import absolute_import, division
+
+SHORTEST = 'shortest'
+FORWARD = 'forward'
+REVERSE = 'reverse'
+
+def wrap(angle):
+  """
+  Returns angle, in degrees, wrapped to [-180, 180)
+  """
+  return (angle + 180.0) % 360.0 - 180.0
+
+def delta(current, angle, direction=SHORTEST):
+  """
+  Returns the signed rotation, in degrees, that takes the stage from
+  current to angle going in direction. Both may be unwrapped.
+  """
+  d = wrap(angle - current)
+  if direction == SHORTEST:
+    return d
+  elif direction == FORWARD:
+    return d % 360.0
+  elif direction == REVERSE:
+    return -((-d) % 360.0)
+  raise ValueError('Unknown direction %r'%(direction))
+
+def target(current, angle, direction=SHORTEST):
+  """
+  Returns the unwrapped position to move to, to get from the unwrapped
+  position current to angle going in direction
+  """
+  return current + delta(current, angle, direction)
+
+def path_cost(angles, start, cost=abs):
+  """
+  Returns the total cost of visiting angles in order from start with
+  shortest moves, where cost(rotation) is the cost of one move
+  """
+  total = 0.0
+  current = start
+  for a in angles:
+    d = delta(current, a)
+    total += cost(d)
+    current += d
+  return total
+
+def plan_angles(angles, start=0.0, cost=abs):
+  """
+  Returns the indices of angles in the order that visits all of them from
+  start with the least total cost, where cost(rotation) is the cost of one
+  shortest move, e.g. its duration as estimated by Controller.move_time().
+  The default is the rotation itself.
+
+  Points on a circle are best visited by sweeping one way, possibly turning
+  back once, so only those orders are considered: for every turning point,
+  forward then back and back then forward.
+  """
+  if not len(angles):
+    return []
+
+  # sort by angle relative to start, in [0, 360)
+  rel = [(wrap(a - start) % 360.0, i) for i, a in enumerate(angles)]
+  rel.sort()
+  fwd = [i for _, i in rel]
+  n = len(fwd)
+
+  candidates = []
+  for k in range(n + 1):
+    # forward through the first k, then back through the rest
+    candidates.append(fwd[:k] + fwd[k:][::-1])
+    # back through the last n - k, then forward through the first k
+    candidates.append(fwd[k:][::-1] + fwd[:k])
+
+  best = None
+  for order in candidates:
+    c = path_cost([angles[i] for i in order], start, cost)
+    if best is None or c < best[0]:
+      best = (c, order)
+  return best[1]
+
+def plan_scan(points, start=0.0, angle_index=0, cost=abs, decimals=6):
+  """
+  Orders the points of a scan combining rotation with linear axes. points
+  are tuples with the angle at angle_index and linear positions elsewhere.
+
+  Rotation is assumed to be the slowest move, so points are grouped by
+  angle, the angles ordered with plan_angles(), and the points within each
+  group ordered by their linear positions, alternating direction from group
+  to group so the linear axes don't travel back every time.
+
+  Angles equal to within decimals decimal places are the same group.
+
+  Returns the indices of points in visit order.
+  """
+  groups = {}
+  for i, p in enumerate(points):
+    key = round(wrap(p[angle_index]), decimals)
+    groups.setdefault(key, []).append(i)
+
+  keys = sorted(groups)
+  order = []
+  reverse = False
+  for g in plan_angles(keys, start, cost):
+    idx = groups[keys[g]]
+    linear = lambda i: [x for j, x in enumerate(points[i]) if j != angle_index]
+    order.extend(sorted(idx, key=linear, reverse=reverse))
+    reverse = not reverse
+  return order
@@ -0,0 +1,133 @@
+"""
+Settle policies decide when a stage counts as in position after the
+controller reports the end of a move.
+
+  - Immediate: as soon as MGMSG_MOT_MOVE_COMPLETED arrives
+  - ZeroVelocity: once the reported velocity is exactly zero, which is what
+    goto() and stop() have always done
+  - PositionWindow: once N consecutive position samples are within a
+    tolerance of the target, or of each other when there is no target
+  - SettledBit: once the controller sets the settled status bit
+
+Policies that poll take a timeout in seconds, after which SettleTimeout is
+raised, carrying the last status. None waits forever.
+
+A policy can be given per call, e.g. con.goto(10, settle=settle.IMMEDIATE),
+or per controller by setting con.settle_policy, which replaces the defaults
+of both goto() and stop().
+"""
+from __future__ import absolute_import, division
+import time
+
+class SettleTimeout(Exception):
+  def __init__(self, policy, status):
+    val = '%r did not settle in %.3fs, last status: %s'%(policy,
+                                                           policy.timeout,
+                                                           status)
+    super(SettleTimeout, self).__init__(val)
+    self.status = status
+
+class SettlePolicy(object):
+  def __init__(self, interval=0.01, timeout=None):
+    """
+    interval is the time in seconds between status queries, timeout the
+    time after which SettleTimeout is raised, or None
+    """
+    super(SettlePolicy, self).__init__()
+    self.interval = interval
+    self.timeout = timeout
+
+  def __repr__(self):
+    return '%s(interval=%r, timeout=%r)'%(type(self).__name__, self.interval,
+                                           self.timeout)
+
+  def checker(self, target_apt):
+    """
+    Returns a function that is called with every status sample in order, and
+    returns True once the policy is satisfied. A new one is made for every
+    wait, so it may keep state, and policies can be shared between
+    controllers.
+    """
+    raise NotImplementedError()
+
+  def wait(self, con, status, target_apt=None, channel=1):
+    """
+    Polls con until the policy is satisfied, starting with status, the one
+    that came with the end of move message. target_apt is the target
+    position in encoder counts, or None if there is none, e.g. after a stop.
+
+    Returns the last status.
+    """
+    done = self.checker(target_apt)
+    st = time.time()
+    while not done(status):
+      if self.timeout is not None and time.time() - st > self.timeout:
+        raise SettleTimeout(self, status)
+      con._sleep(self.interval)
+      status = con.status(channel)
+    return status
+
+class Immediate(SettlePolicy):
+  def __init__(self):
+    super(Immediate, self).__init__(interval=0)
+
+  def __repr__(self):
+    return 'Immediate()'
+
+  def checker(self, target_apt):
+    return lambda status: True
+
+  def wait(self, con, status, target_apt=None, channel=1):
+    return status
+
+class ZeroVelocity(SettlePolicy):
+  def checker(self, target_apt):
+    return lambda status: not status.velocity_apt
+
+class PositionWindow(SettlePolicy):
+  def __init__(self, tolerance, samples=3, interval=0.001, timeout=1.0):
+    """
+    tolerance is in mm. The stage is settled once samples consecutive
+    positions are within tolerance of the target, or, without a target,
+    within tolerance of the first of them.
+    """
+    super(PositionWindow, self).__init__(interval=interval, timeout=timeout)
+    self.tolerance = tolerance
+    self.samples = samples
+
+  def __repr__(self):
+    return 'PositionWindow(%r, samples=%r, interval=%r, timeout=%r)'%(
+            self.tolerance, self.samples, self.interval, self.timeout)
+
+  def checker(self, target_apt):
+    # number of consecutive samples in the window, and the window centre
+    state = {'count': 0, 'reference': target_apt}
+
+    def done(status):
+      if state['reference'] is None:
+        state['reference'] = status.position_apt
+      tolerance_apt = self.tolerance * status.position_scale
+      if abs(status.position_apt - state['reference']) <= tolerance_apt:
+        state['count'] += 1
+      elif target_apt is None:
+        # no target, so the window follows the stage until it stays put
+        state['reference'] = status.position_apt
+        state['count'] = 1
+      else:
+        state['count'] = 0
+      return state['count'] >= self.samples
+    return done
+
+class SettledBit(SettlePolicy):
+  def __init__(self, interval=0.001, timeout=1.0):
+    super(SettledBit, self).__init__(interval=interval, timeout=timeout)
+
+  def checker(self, target_apt):
+    return lambda status: bool(status.settled)
+
+IMMEDIATE = Immediate()
+
+# the policies goto() and stop() use when neither the call nor the controller
+# specifies one
+GOTO_DEFAULT = ZeroVelocity(interval=0.01)
+STOP_DEFAULT = ZeroVelocity(interval=0.001)
@@ -0,0 +1,423 @@
+"""
+Running one scan on several independent rigs at once.
+
+Each rig is a multi-axis stage with its own controllers, described by a Rig,
+usually read from the rig's configfile.yml. ShardedScan splits the points of
+a scan into chunks, hands them out to one worker process per rig, and merges
+what comes back:
+
+  rigs = [Rig.from_config('rig1/configfile.yml'),
+          Rig.from_config('rig2/configfile.yml')]
+  scan = ShardedScan(rigs, points, acquire=measure)
+  result = scan.run(progress=print)
+
+Chunks are assigned up front, either as one contiguous region of the scan per
+rig (REGION), which keeps moves short, or round robin (INTERLEAVE). A rig
+that runs out of chunks takes the last chunk still queued for the rig with
+the most work left, so rigs that are faster, or got easier regions, take over
+work from the others and the scan finishes when the whole campaign is done
+rather than when the slowest rig is.
+
+If a rig fails, the points it had not completed are handed to the others,
+and the scan only fails once no rig is left.
+
+acquire(rig_name, index, point) is called in the worker process with the
+stage at every point, in world coordinates, and whatever it returns is sent
+back and collected in ShardResult.results. It must be picklable, i.e. a
+module level function.
+
+Rig(..., simulated=True) runs on sim.SimulatedDevice instead of hardware.
+
+This module requires NumPy, which is why it is not imported by pyAPT itself.
+"""
+from __future__ import absolute_import, division
+import collections
+import multiprocessing
+import os
+import time
+import traceback
+
+try:
+  import queue
+except ImportError:
+  import Queue as queue
+
+import numpy as np
+
+from . import cache, sim
+from .group import home_all, synchronized_start
+from .settle import GOTO_DEFAULT
+from .transform import StageTransform
+
+REGION = 'region'
+INTERLEAVE = 'interleave'
+
+# messages from workers: (kind, rig name, chunk id, payload)
+_READY = 'ready'
+_DONE = 'done'
+_FAILED = 'failed'
+
+class ShardError(Exception):
+  pass
+
+class Rig(object):
+  def __init__(self, name, serial_numbers, controller='MTS50', transform=None,
+               home=False, simulated=False, time_scale=0.0):
+    """
+    serial_numbers are those of the axes of the rig, in stage axis order.
+    controller is the name of the controller class, see
+    cache.CONTROLLER_CLASSES, or None to look it up with
+    cache.open_controller(). transform is the transform.StageTransform from
+    world to stage coordinates, or None if they are the same.
+
+    If home is True, the worker homes the axes that need it before starting.
+    If simulated is True the rig runs on simulated devices, whose moves take
+    time_scale times as long as on the real stage.
+
+    A Rig is sent to the worker process, so it must only hold picklable
+    things.
+    """
+    super(Rig, self).__init__()
+    self.name = name
+    self.serial_numbers = list(serial_numbers)
+    self.controller = controller
+    self.transform = transform
+    self.home = home
+    self.simulated = simulated
+    self.time_scale = time_scale
+
+  def __repr__(self):
+    return 'Rig(%r, %r)'%(self.name, self.serial_numbers)
+
+  @classmethod
+  def from_config(cls, path, name=None, **kwargs):
+    """
+    Builds a Rig from a LinearStage configfile.yml. name defaults to the
+    directory the file is in.
+    """
+    import yaml
+    with open(path) as f:
+      config = yaml.safe_load(f)
+    if name is None:
+      name = os.path.basename(os.path.dirname(os.path.abspath(path)))
+    serials = [config['X_AXIS_SN'], config['Y_AXIS_SN'], config['Z_AXIS_SN']]
+    return cls(name, serials, transform=StageTransform.from_config(config),
+               **kwargs)
+
+  def open(self):
+    """
+    Opens the controllers of the axes, in order. The caller must close them.
+    """
+    cons = []
+    try:
+      for sn in self.serial_numbers:
+        if self.simulated:
+          cls = cache.CONTROLLER_CLASSES[self.controller or 'MTS50']
+          cons.append(sim.open_simulated(cls, serial_number=sn,
+                                         time_scale=self.time_scale))
+        elif self.controller is None:
+          cons.append(cache.open_controller(sn))
+        else:
+          cls = cache.CONTROLLER_CLASSES[self.controller]
+          cons.append(cls(serial_number=sn))
+    except:
+      for con in cons:
+        con.close()
+      raise
+    return cons
+
+  def to_stage(self, points):
+    points = np.atleast_2d(np.asarray(points, dtype=float))
+    if self.transform is None:
+      return points
+    return np.atleast_2d(self.transform.to_stage(points))
+
+def _move(cons, target, settle):
+  """
+  Moves every axis to target at the same time, and waits for all of them
+  """
+  synchronized_start(cons, [float(pos) for pos in target], settle=settle)
+
+def _worker(rig, acquire, settle, inbox, outbox):
+  """
+  Body of the worker process of rig: runs the chunks sent to inbox until it
+  gets None, and reports each one to outbox
+  """
+  chunk_id = None
+  results = []
+  cons = []
+  try:
+    cons = rig.open()
+    for con in cons:
+      con.resume_end_of_move_messages()
+    if rig.home:
+      home_all(cons)
+    outbox.put((_READY, rig.name, None, None))
+
+    while True:
+      task = inbox.get()
+      if task is None:
+        break
+      chunk_id, indices, points = task
+      results = []
+      for idx, point, target in zip(indices, points, rig.to_stage(points)):
+        _move(cons, target, settle)
+        value = acquire(rig.name, idx, point) if acquire else None
+        results.append((idx, value))
+      outbox.put((_DONE, rig.name, chunk_id, results))
+      chunk_id = None
+  except BaseException:
+    outbox.put((_FAILED, rig.name, chunk_id,
+                (results, traceback.format_exc())))
+  finally:
+    for con in cons:
+      try:
+        con.close()
+      except Exception:
+        pass
+
+class RigStats(object):
+  """
+  What one rig did in a sharded scan: points and chunks completed, chunks
+  taken over from other rigs, seconds from its first chunk to its last, and
+  the traceback of its failure, if it failed
+  """
+  def __init__(self, name):
+    super(RigStats, self).__init__()
+    self.name = name
+    self.points = 0
+    self.chunks = 0
+    self.stolen = 0
+    self.elapsed = 0.0
+    self.error = None
+
+  def __repr__(self):
+    return 'RigStats(%s, %d points, %d chunks, %d stolen, %.2fs%s)'%(
+            self.name, self.points, self.chunks, self.stolen, self.elapsed,
+            ', failed' if self.error else '')
+
+class ShardProgress(object):
+  """
+  Progress of a sharded scan as a whole, passed to the progress callback of
+  ShardedScan.run() every time a chunk completes
+  """
+  def __init__(self, done, total, elapsed, rigs):
+    super(ShardProgress, self).__init__()
+    self.done = done
+    self.total = total
+    self.elapsed = elapsed
+    # {rig name: points done}
+    self.rigs = rigs
+
+  def __str__(self):
+    per_rig = ', '.join('%s %d'%(name, n) for name, n in sorted(self.rigs.items()))
+    return '%d/%d points in %.1fs (%s)'%(self.done, self.total, self.elapsed,
+                                         per_rig)
+
+class ShardResult(object):
+  """
+  Merged outcome of a sharded scan. results[i] is what acquire returned at
+  point i, rig_of[i] the index in rigs of the rig that visited it, and
+  stats the RigStats of every rig, by name.
+  """
+  def __init__(self, results, rig_of, stats, elapsed):
+    super(ShardResult, self).__init__()
+    self.results = results
+    self.rig_of = rig_of
+    self.stats = stats
+    self.elapsed = elapsed
+
+  @property
+  def throughput(self):
+    """
+    Points per second over the whole scan
+    """
+    return len(self.results) / self.elapsed if self.elapsed else 0.0
+
+class ShardedScan(object):
+  def __init__(self, rigs, points, acquire=None, partition=REGION, chunk=64,
+               settle=GOTO_DEFAULT, start_method=None):
+    """
+    points is an array of shape (n, naxes) in world coordinates, in the
+    order they would be visited by a single rig. Each rig visits its chunks
+    in that order.
+
+    chunk is the number of points handed out at a time. Smaller chunks
+    balance the load better, larger ones cost fewer messages between
+    processes. settle is the settle.SettlePolicy used after every move.
+
+    start_method is the multiprocessing start method, e.g. 'spawn', or None
+    for the platform default.
+    """
+    super(ShardedScan, self).__init__()
+    if not rigs:
+      raise ValueError('No rigs to run on')
+    names = [rig.name for rig in rigs]
+    if len(set(names)) != len(names):
+      raise ValueError('Rig names must be unique: %r'%(names))
+    if partition not in (REGION, INTERLEAVE):
+      raise ValueError('Unknown partition %r'%(partition))
+
+    self.rigs = list(rigs)
+    self.points = np.atleast_2d(np.asarray(points, dtype=float))
+    self.acquire = acquire
+    self.partition = partition
+    self.chunk = chunk
+    self.settle = settle
+    self._mp = multiprocessing.get_context(start_method)
+
+    n = len(self.points)
+    self.chunks = [np.arange(i, min(i + chunk, n))
+                   for i in range(0, n, chunk)]
+
+  def _assign(self):
+    """
+    Returns {rig name: deque of chunk ids} with the initial assignment
+    """
+    nrigs = len(self.rigs)
+    nchunks = len(self.chunks)
+    queues = collections.OrderedDict((rig.name, collections.deque())
+                                     for rig in self.rigs)
+    for cid in range(nchunks):
+      if self.partition == REGION:
+        r = cid * nrigs // nchunks
+      else:
+        r = cid % nrigs
+      queues[self.rigs[r].name].append(cid)
+    return queues
+
+  def _next_chunk(self, name, queues, orphans, stats):
+    """
+    Returns the id of the chunk rig name should run next, or None if there
+    is no work left
+    """
+    if orphans:
+      return orphans.popleft()
+    if queues[name]:
+      return queues[name].popleft()
+    # steal from the back of the longest queue, the work its owner would
+    # have got to last
+    victim = max(queues, key=lambda k: len(queues[k]))
+    if queues[victim]:
+      stats[name].stolen += 1
+      return queues[victim].pop()
+    return None
+
+  def run(self, progress=None, poll_interval=0.5):
+    """
+    Runs the scan on all rigs and returns a ShardResult. progress, if
+    given, is called with a ShardProgress every time a chunk completes.
+
+    Raises ShardError if every rig failed before the scan was done.
+    """
+    st = time.time()
+    n = len(self.points)
+    results = [None] * n
+    rig_of = np.full(n, -1, dtype=int)
+    rig_index = dict((rig.name, i) for i, rig in enumerate(self.rigs))
+    stats = collections.OrderedDict((rig.name, RigStats(rig.name))
+                                    for rig in self.rigs)
+
+    queues = self._assign()
+    orphans = collections.deque()
+    # chunk id each rig is running, None while idle. Idle rigs are kept
+    # until the end, in case a failing rig leaves work behind
+    running = dict((rig.name, None) for rig in self.rigs)
+    idle = set()
+    started = {}
+    done = 0
+
+    outbox = self._mp.Queue()
+    inboxes = {}
+    procs = {}
+    for rig in self.rigs:
+      inboxes[rig.name] = self._mp.Queue()
+      procs[rig.name] = self._mp.Process(target=_worker,
+                                         name='pyAPT-shard-%s'%(rig.name),
+                                         args=(rig, self.acquire, self.settle,
+                                               inboxes[rig.name], outbox))
+      procs[rig.name].daemon = True
+      procs[rig.name].start()
+    live = set(procs)
+
+    def dispatch(name):
+      cid = self._next_chunk(name, queues, orphans, stats)
+      running[name] = cid
+      if cid is None:
+        idle.add(name)
+        return
+      idle.discard(name)
+      started.setdefault(name, time.time())
+      idx = self.chunks[cid]
+      inboxes[name].put((cid, idx, self.points[idx]))
+
+    def collect(name, chunk_results):
+      count = 0
+      for idx, value in chunk_results:
+        if rig_of[idx] < 0:
+          count += 1
+        results[idx] = value
+        rig_of[idx] = rig_index[name]
+      stats[name].points += count
+      stats[name].elapsed = time.time() - started.get(name, st)
+      return count
+
+    def fail(name, cid, error):
+      live.discard(name)
+      idle.discard(name)
+      stats[name].error = error
+      running[name] = None
+      # whatever the rig had queued, and the rest of the chunk it was on,
+      # goes to the others
+      orphans.extend(queues[name])
+      queues[name].clear()
+      if cid is not None:
+        rest = [i for i in self.chunks[cid] if rig_of[i] < 0]
+        if rest:
+          self.chunks.append(np.array(rest))
+          orphans.append(len(self.chunks) - 1)
+      for k in list(idle):
+        if orphans:
+          dispatch(k)
+
+    try:
+      while done < n:
+        if not live:
+          errors = '\n'.join('%s: %s'%(s.name, s.error)
+                             for s in stats.values() if s.error)
+          raise ShardError('All rigs failed with %d of %d points done:\n%s'%(
+                           done, n, errors))
+        try:
+          kind, name, cid, payload = outbox.get(timeout=poll_interval)
+        except queue.Empty:
+          for name in list(live):
+            if not procs[name].is_alive():
+              fail(name, running[name], 'worker process exited with code %s'%(
+                   procs[name].exitcode))
+          continue
+
+        if name not in live:
+          continue
+        if kind == _READY:
+          dispatch(name)
+        elif kind == _DONE:
+          done += collect(name, payload)
+          stats[name].chunks += 1
+          if progress is not None:
+            progress(ShardProgress(done, n, time.time() - st,
+                                   dict((k, s.points)
+                                        for k, s in stats.items())))
+          dispatch(name)
+        elif kind == _FAILED:
+          partial, error = payload
+          done += collect(name, partial)
+          fail(name, cid, error)
+    finally:
+      for name in live:
+        inboxes[name].put(None)
+      for name, proc in procs.items():
+        proc.join(5.0 if name in live else 0.1)
+        if proc.is_alive():
+          proc.terminate()
+
+    return ShardResult(results, rig_of, stats, time.time() - st)
@@ -0,0 +1,268 @@
+"""
+A simulated APT motor controller, for running code that drives stages
+without any hardware, e.g.
+
+  con = pyAPT.sim.open_simulated(pyAPT.MTS50, serial_number='sim-x')
+  con.goto(10)
+
+SimulatedDevice takes the place of the FTDI device under a Controller and
+answers the messages Controller sends: status, position and parameter
+queries, absolute moves, homing and stops, with end of move
+messages when they are not suspended.
+
+Moves take the time a trapezoidal velocity profile with the current velocity
+parameters would take, multiplied by time_scale, so 1.0 is real time and 0.0
+completes every move as soon as the next message is read.
+"""
+from __future__ import absolute_import, division
+import struct as st
+import threading
+import time
+
+from . import message
+from .message import Message
+
+# status bits, see ControllerStatus
+_MOVING_FORWARD = 0x10
+_MOVING_REVERSE = 0x20
+_HOMING = 0x200
+_HOMED = 0x400
+_SETTLED = 0x2000
+_EXCESSIVE_POSITION_ERROR = 0x4000
+_CHANNEL_ENABLED = 0x80000000
+
+class SimulatedDevice(object):
+  def __init__(self, time_scale=0.0, position=0.0, homed=True,
+               serial_number=0):
+    """
+    position is the initial position in mm. The device knows nothing about
+    the stage until attach() gives it the scales and range of a controller.
+    """
+    super(SimulatedDevice, self).__init__()
+    self.time_scale = time_scale
+    self.serial_number = serial_number
+    self.closed = False
+
+    self.position_scale = None
+    self.velocity_scale = None
+    self.acceleration_scale = None
+    self.linear_range = None
+
+    self.homed = homed
+    self.end_of_move_messages = True
+    # acceleration and max velocity, in APT units
+    self.velocity_params = (0, 0)
+    # home direction, limit switch, velocity and offset, as in
+    # MGMSG_MOT_SET_HOMEPARAMS
+    self.home_params = (1, 1, 0, 0)
+    self.faults = 0
+    # number of messages handled, for tests and statistics
+    self.messages = 0
+
+    self._initial_position = position
+    self._pos = 0
+    # (start time, duration, start position, end position, message sent at
+    # the end) of the move in progress, or None
+    self._move = None
+    self._inbuf = bytearray()
+    self._outbuf = bytearray()
+    self._lock = threading.Lock()
+
+  def attach(self, con):
+    """
+    Takes the scales, range and velocity limits of the stage from con, the
+    controller this device is simulated for
+    """
+    self.position_scale = con.position_scale
+    self.velocity_scale = con.velocity_scale
+    self.acceleration_scale = con.acceleration_scale
+    self.linear_range = con.linear_range
+    self.velocity_params = (int(con.max_acceleration * con.acceleration_scale),
+                            int(con.max_velocity * con.velocity_scale))
+    self.home_params = (1, 1, self.velocity_params[1], 0)
+    self._pos = int(self._initial_position * con.position_scale)
+
+  def _move_duration(self, distance_apt, velocity_apt=None, initial=0.0):
+    """
+    initial is the velocity in mm/s the stage already has in the direction of
+    the move, when a move replaces one in progress
+    """
+    acc = self.velocity_params[0] / self.acceleration_scale
+    vel = (velocity_apt or self.velocity_params[1]) / self.velocity_scale
+    distance = abs(distance_apt) / self.position_scale
+    if not distance or not acc or not vel:
+      return 0.0
+    initial = min(max(initial, 0.0), vel)
+    ramp = (vel * vel - initial * initial / 2) / acc
+    if distance < ramp:
+      t = 2 * (distance / acc) ** 0.5
+    else:
+      t = (distance / vel + (vel - initial) ** 2 / (2 * acc * vel) +
+           vel / (2 * acc))
+    return t * self.time_scale
+
+  def _position(self, now):
+    """
+    Returns the position in APT units and velocity in mm/s at time now,
+    completing the move in progress if it is over
+    """
+    if self._move is None:
+      return self._pos, 0.0
+
+    start, duration, frm, to, done_id = self._move
+    if now - start >= duration:
+      self._pos = to
+      self._move = None
+      if done_id == message.MGMSG_MOT_MOVE_HOMED:
+        self.homed = True
+      if self.end_of_move_messages:
+        self._outbuf += self._status_message(done_id, now)
+      return self._pos, 0.0
+
+    # linear interpolation is good enough for a simulation
+    frac = (now - start) / duration
+    pos = int(frm + (to - frm) * frac)
+    velocity = (to - frm) / self.position_scale / duration
+    return pos, velocity
+
+  def _statusbits(self, velocity):
+    bits = _CHANNEL_ENABLED | self.faults
+    if self.homed:
+      bits |= _HOMED
+    if velocity > 0:
+      bits |= _MOVING_FORWARD
+    elif velocity < 0:
+      bits |= _MOVING_REVERSE
+    elif self._move is None:
+      bits |= _SETTLED
+    if self._move is not None and self._move[4] == message.MGMSG_MOT_MOVE_HOMED:
+      bits |= _HOMING
+    return bits
+
+  def _status_message(self, messageID, now):
+    if messageID == message.MGMSG_MOT_MOVE_HOMED:
+      return Message(messageID, param1=1).pack()
+    pos, velocity = self._position(now) if self._move else (self._pos, 0.0)
+    vel_apt = int(velocity * 10)
+    if velocity and not vel_apt:
+      vel_apt = 1 if velocity > 0 else -1
+    data = st.pack('<HihHI', 1, pos, vel_apt, 0, self._statusbits(velocity))
+    return Message(messageID, data=data).pack()
+
+  def _start_move(self, to, done_id, velocity_apt=None, now=None):
+    now = now or time.time()
+    pos, velocity = self._position(now)
+    # a new move replaces the one in progress, as on the real controller,
+    # keeping the velocity it has
+    initial = velocity if (to - pos) * velocity > 0 else 0.0
+    self._move = (now, self._move_duration(to - pos, velocity_apt,
+                                           abs(initial)), pos, to, done_id)
+    self._pos = pos
+
+  def inject_fault(self, statusbits=_EXCESSIVE_POSITION_ERROR):
+    """
+    Sets fault statusbits and stops the move in progress where it is,
+    without an end of move message, as a controller does on a fault
+    """
+    with self._lock:
+      now = time.time()
+      self._pos, _ = self._position(now)
+      self._move = None
+      self.faults |= statusbits
+
+  def clear_faults(self):
+    with self._lock:
+      self.faults = 0
+
+  def _handle(self, mid, data, now):
+    self.messages += 1
+
+    if mid == message.MGMSG_MOT_REQ_DCSTATUSUPDATE:
+      self._outbuf += self._status_message(message.MGMSG_MOT_GET_DCSTATUSUPDATE,
+                                           now)
+    elif mid == message.MGMSG_MOT_REQ_POSCOUNTER:
+      pos, _ = self._position(now)
+      self._outbuf += Message(message.MGMSG_MOT_GET_POSCOUNTER,
+                              data=st.pack('<Hi', 1, pos)).pack()
+    elif mid == message.MGMSG_MOT_SUSPEND_ENDOFMOVEMSGS:
+      self.end_of_move_messages = False
+    elif mid == message.MGMSG_MOT_RESUME_ENDOFMOVEMSGS:
+      self.end_of_move_messages = True
+    elif mid == message.MGMSG_MOT_MOVE_ABSOLUTE:
+      if not self.faults:
+        _, pos = st.unpack('<Hi', data)
+        self._start_move(pos, message.MGMSG_MOT_MOVE_COMPLETED, now=now)
+    elif mid == message.MGMSG_MOT_MOVE_HOME:
+      if not self.faults:
+        self.homed = False
+        # homing zeroes the position counter at the home switch, and then
+        # moves by the home offset
+        self._start_move(self.home_params[3],
+                         message.MGMSG_MOT_MOVE_HOMED,
+                         velocity_apt=self.home_params[2], now=now)
+    elif mid == message.MGMSG_MOT_MOVE_STOP:
+      self._pos, _ = self._position(now)
+      self._move = None
+      if self.end_of_move_messages:
+        self._outbuf += self._status_message(message.MGMSG_MOT_MOVE_STOPPED,
+                                             now)
+    elif mid == message.MGMSG_MOT_REQ_VELPARAMS:
+      acc, vel = self.velocity_params
+      self._outbuf += Message(message.MGMSG_MOT_GET_VELPARAMS,
+                              data=st.pack('<Hiii', 1, 0, acc, vel)).pack()
+    elif mid == message.MGMSG_MOT_SET_VELPARAMS:
+      self.velocity_params = st.unpack('<Hiii', data)[2:]
+    elif mid == message.MGMSG_MOT_REQ_HOMEPARAMS:
+      self._outbuf += Message(message.MGMSG_MOT_GET_HOMEPARAMS,
+                              data=st.pack('<HHHii', 1,
+                                           *self.home_params)).pack()
+    elif mid == message.MGMSG_MOT_SET_HOMEPARAMS:
+      self.home_params = st.unpack('<HHHii', data)[1:]
+    elif mid == message.MGMSG_HW_REQ_INFO:
+      info = st.pack('<I8sH4s48s12sHHH', self.serial_number, b'SIM001', 44,
+                     b'\x00\x00\x01\x00', b'pyAPT simulated controller', b'',
+                     1, 0, 1)
+      self._outbuf += Message(message.MGMSG_HW_GET_INFO, data=info).pack()
+    # anything else, e.g. MGMSG_MOD_IDENTIFY or MGMSG_MOT_ACK_DCSTATUSUPDATE,
+    # needs no reply
+
+  def write(self, data):
+    with self._lock:
+      now = time.time()
+      self._inbuf += data
+      while len(self._inbuf) >= message.MGMSG_HEADER_SIZE:
+        hd = Message.unpack(bytes(self._inbuf[:message.MGMSG_HEADER_SIZE]),
+                            header_only=True)
+        length = message.MGMSG_HEADER_SIZE
+        if hd.hasdata:
+          length += hd.datalength
+        if len(self._inbuf) < length:
+          break
+        payload = bytes(self._inbuf[message.MGMSG_HEADER_SIZE:length])
+        del self._inbuf[:length]
+        self._handle(hd.messageID, payload, now)
+    return len(data)
+
+  def read(self, length):
+    with self._lock:
+      self._position(time.time())
+      data = bytes(self._outbuf[:length])
+      del self._outbuf[:length]
+      return data
+
+  def flush(self, *args):
+    pass
+
+  def close(self):
+    self.closed = True
+
+def open_simulated(cls, serial_number='sim', time_scale=0.0, position=0.0,
+                   homed=True):
+  """
+  Returns a controller of class cls, e.g. pyAPT.MTS50, on a SimulatedDevice
+  with the scales and range of that class. Tuned profiles are not applied.
+  """
+  dev = SimulatedDevice(time_scale=time_scale, position=position, homed=homed)
+  con = cls(serial_number=serial_number, device=dev, use_tuned_profile=False)
+  dev.attach(con)
+  return con
@@ -0,0 +1,244 @@
+"""
+Drift-free timing of dwells and acquisitions.
+
+time.sleep(delay) wakes up late by whatever the OS scheduler adds, a little
+different every time, and a scan paced by sleeps drifts by the sum of it.
+DwellScheduler waits for absolute deadlines instead: it sleeps until shortly
+before the deadline and spins on the clock for the last stretch, and it
+learns how late sleeps wake up on this machine, so it starts spinning early
+enough. The most recent waits are logged with the time requested and the
+time each actually took:
+
+  timing = DwellScheduler()
+  for k, point in enumerate(points):
+    move_to(point)
+    timing.dwell(0.05, index=k)     # 50ms from now
+    acquire()
+  print(timing.report())
+
+A scan paced by a clock rather than by its moves uses the schedule started
+by start(): at(t) waits until t seconds after the start, so lateness in one
+wait doesn't delay the ones after it:
+
+  timing.start()
+  for k in range(n):
+    timing.at(k * 0.1, index=k)
+    acquire()
+"""
+from __future__ import absolute_import, division
+import array
+import threading
+import time
+
+if hasattr(time, 'perf_counter'):
+  clock = time.perf_counter
+else:
+  clock = time.time
+
+def sleep_until(deadline, spin=0.002, clock=clock):
+  """
+  Waits until clock() reaches deadline: sleeps until spin seconds before it,
+  then spins, yielding to other threads. Returns clock() on waking.
+  """
+  remaining = deadline - clock() - spin
+  if remaining > 0:
+    time.sleep(remaining)
+  now = clock()
+  while now < deadline:
+    time.sleep(0)
+    now = clock()
+  return now
+
+class DwellScheduler(object):
+  # weight of the latest sleep in the running estimate of oversleep
+  ALPHA = 0.1
+
+  def __init__(self, spin=0.002, adapt=True, carry=False, history=65536,
+               clock=clock):
+    """
+    spin is the time in seconds spent spinning before every deadline. If
+    adapt is True the sleep before it is shortened by how late sleeps have
+    been waking up, as measured on the way.
+
+    If carry is True, the time a dwell() overshoots by is taken off the next
+    one, so a scan of dwells takes the sum of the times requested, rather
+    than drifting by the overshoot of every point.
+
+    history is the number of waits kept in the log, the most recent ones,
+    so long scans don't grow it without bound. None keeps every wait, 0
+    none. The counts and totals of summary() cover every wait either way.
+
+    Waits may be made from several threads at once.
+    """
+    super(DwellScheduler, self).__init__()
+    self.spin = spin
+    self.adapt = adapt
+    self.carry = carry
+    self.history = history
+    self.clock = clock
+    # running estimate of how late time.sleep() wakes up, in seconds
+    self.oversleep = 0.0
+    self._lock = threading.Lock()
+    self.reset()
+
+  def reset(self):
+    """
+    Forgets every wait, and the schedule of at(), e.g. before a new scan.
+    The estimate of oversleep is kept, since it depends on the machine.
+    """
+    with self._lock:
+      # clock() at start(), for at()
+      self.epoch = None
+      # number of at() calls made after their deadline had already passed
+      self.behind = 0
+      # number of waits, and the seconds requested and actually waited
+      self.count = 0
+      self.total_requested = 0.0
+      self.total_actual = 0.0
+
+      # log of the last history waits: point index, or -1, seconds
+      # requested and actual. Once full, the oldest entry is at _next
+      self.indices = array.array('l')
+      self.requested = array.array('d')
+      self.actual = array.array('d')
+      self._next = 0
+      self._debt = 0.0
+
+  def __len__(self):
+    return self.count
+
+  def wait_until(self, deadline):
+    """
+    Waits until clock() reaches deadline, without logging. Returns clock() on
+    waking.
+    """
+    margin = self.spin + (self.oversleep if self.adapt else 0.0)
+    wake = deadline - margin
+    remaining = wake - self.clock()
+    if remaining > 0:
+      time.sleep(remaining)
+      late = max(self.clock() - wake, 0.0)
+      with self._lock:
+        self.oversleep += self.ALPHA * (late - self.oversleep)
+    now = self.clock()
+    while now < deadline:
+      time.sleep(0)
+      now = self.clock()
+    return now
+
+  def _record(self, index, requested, actual):
+    index = -1 if index is None else index
+    with self._lock:
+      self.count += 1
+      self.total_requested += requested
+      self.total_actual += actual
+      if self.history is None or len(self.requested) < self.history:
+        self.indices.append(index)
+        self.requested.append(requested)
+        self.actual.append(actual)
+      elif self.history:
+        k = self._next
+        self.indices[k] = index
+        self.requested[k] = requested
+        self.actual[k] = actual
+        self._next = (k + 1) % self.history
+
+  def _ordered(self, log):
+    # a full ring buffer starts at _next
+    return log[self._next:] + log[:self._next]
+
+  def dwell(self, seconds, index=None):
+    """
+    Waits seconds from now, and logs it for point index. Returns the time
+    actually waited.
+    """
+    start = self.clock()
+    if self.carry:
+      with self._lock:
+        debt = min(self._debt, seconds)
+        self._debt -= debt
+    else:
+      debt = 0.0
+    end = self.wait_until(start + seconds - debt)
+    actual = end - start
+    if self.carry:
+      with self._lock:
+        self._debt += max(actual - (seconds - debt), 0.0)
+    self._record(index, seconds, actual)
+    return actual
+
+  def start(self, epoch=None):
+    """
+    Starts the schedule of at() now, or at epoch, a clock() value. Returns
+    the epoch.
+    """
+    self.epoch = self.clock() if epoch is None else epoch
+    return self.epoch
+
+  def at(self, offset, index=None):
+    """
+    Waits until offset seconds after start(), which is called first if it
+    hasn't been. Logs the wait for point index, with the time it should
+    have taken as requested. If the deadline has already passed it returns
+    at once and counts in behind.
+
+    Returns how late it woke up, in seconds.
+    """
+    if self.epoch is None:
+      self.start()
+    now = self.clock()
+    deadline = self.epoch + offset
+    if now >= deadline:
+      with self._lock:
+        self.behind += 1
+    end = self.wait_until(deadline)
+    self._record(index, max(deadline - now, 0.0), end - now)
+    return end - deadline
+
+  def errors(self):
+    """
+    Returns the list of actual minus requested time of every wait logged,
+    oldest first
+    """
+    with self._lock:
+      requested = self._ordered(self.requested)
+      actual = self._ordered(self.actual)
+    return [a - r for r, a in zip(requested, actual)]
+
+  def log(self):
+    """
+    Returns the list of (index, requested, actual) of every wait logged,
+    oldest first, index being None for waits that weren't given one
+    """
+    with self._lock:
+      logs = [self._ordered(l) for l in (self.indices, self.requested,
+                                         self.actual)]
+    return [(None if i < 0 else i, r, a) for i, r, a in zip(*logs)]
+
+  def summary(self):
+    """
+    Returns a dict with the number of waits, the total time requested and
+    actually waited, and the mean, max and 99th percentile of the error of
+    the waits logged, all in seconds
+    """
+    errors = sorted(self.errors())
+    n = len(errors)
+    return {'count': self.count,
+            'requested': self.total_requested,
+            'actual': self.total_actual,
+            'mean_error': sum(errors) / n if n else 0.0,
+            'max_error': errors[-1] if n else 0.0,
+            'p99_error': errors[min(int(n * 0.99), n - 1)] if n else 0.0,
+            'oversleep': self.oversleep,
+            'behind': self.behind}
+
+  def report(self):
+    """
+    Returns a human readable summary of how accurate the waits were
+    """
+    s = self.summary()
+    return ('%d waits, %.3fs requested, %.3fs actual, error mean %.1fus '
+            'p99 %.1fus max %.1fus, oversleep %.1fus, %d behind schedule'%(
+            s['count'], s['requested'], s['actual'], s['mean_error'] * 1e6,
+            s['p99_error'] * 1e6, s['max_error'] * 1e6, s['oversleep'] * 1e6,
+            s['behind']))
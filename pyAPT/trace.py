@@ -0,0 +1,254 @@
+"""
+Wire level capture and replay of the byte stream between a Controller and its
+device.
+
+Capture with
+
+  con.start_trace('run.apttrace')
+  ... use con as usual ...
+  con.stop_trace()
+
+and feed the recording back to a controller without any hardware with
+
+  dev = pyAPT.trace.ReplayDevice('run.apttrace')
+  con = pyAPT.MTS50(serial_number=dev.serial_number, device=dev)
+
+The trace file format is a header followed by a sequence of records, all
+little endian:
+
+  header: 8 bytes magic 'APTTRC01'
+          Q: wall clock time of the start of the capture, in ns since epoch
+          H: length of the serial number, followed by the serial number
+  record: c: 'W' for bytes written to the device, 'R' for bytes read from it
+          Q: ns since the start of the capture
+          I: length of the payload, followed by the payload
+"""
+from __future__ import absolute_import, division
+import struct as st
+import threading
+import time
+
+from .instrument import now_ns
+
+MAGIC = b'APTTRC01'
+WRITE = b'W'
+READ = b'R'
+
+_HEADER = st.Struct('<QH')
+_RECORD = st.Struct('<cQI')
+
+class ReplayMismatchError(Exception):
+  """
+  Raised by a strict ReplayDevice when the bytes written by the controller
+  differ from what was written in the recorded session.
+  """
+  def __init__(self, offset, expected, got):
+    val = 'write at byte %d of the trace differs: expected %r, got %r'%(
+            offset, expected, got)
+    super(ReplayMismatchError, self).__init__(val)
+
+class ReplayExhausted(EOFError):
+  """
+  Raised by ReplayDevice when a read is attempted after the whole recording
+  has been consumed.
+  """
+  pass
+
+class TraceWriter(object):
+  """
+  Writes trace records to a file. f may be a filename, or a file object
+  opened in binary mode.
+  """
+  def __init__(self, f, serial_number=None):
+    super(TraceWriter, self).__init__()
+    if hasattr(f, 'write'):
+      self._file = f
+    else:
+      self._file = open(f, 'wb')
+
+    serial = (serial_number or '').encode()
+    self._file.write(MAGIC)
+    self._file.write(_HEADER.pack(int(time.time() * 1e9), len(serial)))
+    self._file.write(serial)
+
+    self._start_ns = now_ns()
+    # reads and writes may be recorded from different threads
+    self._lock = threading.Lock()
+
+  @property
+  def closed(self):
+    return self._file is None
+
+  def record(self, direction, data):
+    if self._file is None or not data:
+      return
+    with self._lock:
+      self._file.write(_RECORD.pack(direction, now_ns() - self._start_ns,
+                                    len(data)))
+      self._file.write(data)
+
+  def close(self):
+    if self._file is not None:
+      self._file.close()
+      self._file = None
+
+class TracingDevice(object):
+  """
+  Wraps a device, recording everything written to and read from it with a
+  TraceWriter. Everything else is passed through to the wrapped device.
+  """
+  def __init__(self, device, writer):
+    super(TracingDevice, self).__init__()
+    self.device = device
+    self.writer = writer
+
+  def write(self, data):
+    self.writer.record(WRITE, data)
+    return self.device.write(data)
+
+  def read(self, length):
+    data = self.device.read(length)
+    self.writer.record(READ, data)
+    return data
+
+  def __getattr__(self, name):
+    return getattr(self.device, name)
+
+class TraceReader(object):
+  """
+  Reads a trace file. Iterating over an instance yields
+  (direction, timestamp_ns, data) tuples in recorded order.
+  """
+  def __init__(self, f):
+    super(TraceReader, self).__init__()
+    if hasattr(f, 'read'):
+      self._file = f
+    else:
+      self._file = open(f, 'rb')
+
+    magic = self._file.read(len(MAGIC))
+    if magic != MAGIC:
+      raise ValueError('Not a pyAPT trace file')
+
+    self.start_time_ns, seriallen = _HEADER.unpack(
+                                          self._file.read(_HEADER.size))
+    self.serial_number = self._file.read(seriallen).decode() or None
+
+  def __iter__(self):
+    while True:
+      hd = self._file.read(_RECORD.size)
+      if len(hd) < _RECORD.size:
+        return
+      direction, ts, length = _RECORD.unpack(hd)
+      yield direction, ts, self._file.read(length)
+
+  def close(self):
+    self._file.close()
+
+class ReplayDevice(object):
+  """
+  A device that plays back a recorded session to a Controller.
+
+  Writes from the controller are matched against the recorded writes as a
+  byte stream, so a change in how frames are split across writes does not
+  matter. When strict is True a difference raises ReplayMismatchError,
+  otherwise the differing bytes are discarded and replay carries on.
+
+  Recorded reads only become available once every write recorded before them
+  has been made. If realtime is True they are further held back until the
+  same amount of time has elapsed since the preceding write as in the
+  recording, reproducing the timing of the original device. Otherwise replay
+  runs as fast as possible.
+  """
+  def __init__(self, f, realtime=False, strict=True):
+    super(ReplayDevice, self).__init__()
+    reader = TraceReader(f)
+    self.serial_number = reader.serial_number
+    self._records = list(reader)
+    reader.close()
+
+    self.realtime = realtime
+    self.strict = strict
+    self.closed = False
+
+    self._idx = 0
+    self._rbuf = bytearray()
+    self._wbuf = bytearray()
+    # number of recorded bytes written so far, for error messages
+    self._woffset = 0
+    # (host time, trace time) of the last matched write, for realtime replay
+    self._anchor = (now_ns(), 0)
+
+  def _pending_write(self):
+    """
+    Returns True if the next unconsumed record is a write
+    """
+    return (self._idx < len(self._records) and
+            self._records[self._idx][0] == WRITE)
+
+  def _release_reads(self, force=False):
+    """
+    Moves recorded reads up to the next write record into the read buffer.
+    Unless force is True, realtime replay only releases reads whose time has
+    come.
+    """
+    host, trace_ts = self._anchor
+    while self._idx < len(self._records):
+      direction, ts, data = self._records[self._idx]
+      if direction != READ:
+        break
+      if (self.realtime and not force and
+          ts - trace_ts > now_ns() - host):
+        break
+      self._rbuf += data
+      self._idx += 1
+
+  def read(self, length):
+    self._release_reads()
+    if not self._rbuf and self._idx >= len(self._records):
+      raise ReplayExhausted('End of recorded session')
+
+    data = bytes(self._rbuf[:length])
+    del self._rbuf[:length]
+    return data
+
+  def write(self, data):
+    # anything recorded as read before this write would have arrived by now
+    self._release_reads(force=True)
+    self._wbuf += data
+
+    while self._wbuf and self._pending_write():
+      _, ts, expected = self._records[self._idx]
+      n = min(len(expected), len(self._wbuf))
+      if bytes(self._wbuf[:n]) != expected[:n]:
+        if self.strict:
+          raise ReplayMismatchError(self._woffset, expected[:n],
+                                    bytes(self._wbuf[:n]))
+      del self._wbuf[:n]
+      self._woffset += n
+      if n == len(expected):
+        self._idx += 1
+        self._anchor = (now_ns(), ts)
+        self._release_reads()
+      else:
+        self._records[self._idx] = (WRITE, ts, expected[n:])
+
+    if self._wbuf:
+      if self.strict:
+        raise ReplayMismatchError(self._woffset, b'', bytes(self._wbuf))
+      self._wbuf = bytearray()
+
+    return len(data)
+
+  @property
+  def finished(self):
+    """
+    True once every recorded record has been consumed
+    """
+    return self._idx >= len(self._records) and not self._rbuf
+
+  def flush(self, *args):
+    pass
+
+  def close(self):
+    self.closed = True
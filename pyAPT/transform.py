@@ -0,0 +1,196 @@
+"""
+Vectorised transforms between world coordinates and stage coordinates of a
+multi-axis stage.
+
+World coordinates are what the user thinks in, e.g. the sample frame in mm.
+Stage coordinates are the positions, in mm, that each controller is told to
+goto. For stage axis i:
+
+  stage[i] = sign[i] * scale[i] * world'[axis_map[i]] + offset[i]
+
+where world' is world, optionally passed through an affine calibration
+matrix first. All methods accept a single point of shape (naxes,) or an array
+of points of shape (npoints, naxes), and convert the whole array in one NumPy
+operation.
+
+This module requires NumPy, which is why it is not imported by pyAPT itself.
+"""
+from __future__ import absolute_import, division
+import numpy as np
+
+class StageTransform(object):
+  def __init__(self, naxes=3, axis_map=None, sign=None, offset=None,
+               scale=None, matrix=None):
+    """
+    axis_map[i] is the world axis that drives stage axis i, and defaults to
+    the identity mapping. sign, offset (mm) and scale default to 1, 0 and 1
+    for every axis.
+
+    matrix is an optional affine calibration applied to world coordinates
+    before the per-axis mapping, either naxes x naxes, naxes x (naxes+1) or
+    (naxes+1) x (naxes+1) in homogeneous form.
+    """
+    super(StageTransform, self).__init__()
+    self.naxes = naxes
+
+    def vec(v, default):
+      if v is None:
+        return np.full(naxes, default, dtype=float)
+      v = np.asarray(v, dtype=float)
+      if v.shape != (naxes,):
+        raise ValueError('Expected %d values, got %r'%(naxes, v.tolist()))
+      return v
+
+    if axis_map is None:
+      axis_map = range(naxes)
+    self.axis_map = np.asarray(list(axis_map), dtype=int)
+    if sorted(self.axis_map.tolist()) != list(range(naxes)):
+      raise ValueError('axis_map must be a permutation of 0..%d'%(naxes - 1))
+    self._inverse_map = np.argsort(self.axis_map)
+
+    self.sign = vec(sign, 1.0)
+    self.offset = vec(offset, 0.0)
+    self.scale = vec(scale, 1.0)
+    if np.any(self.sign * self.scale == 0):
+      raise ValueError('sign and scale must be non-zero')
+    self._gain = self.sign * self.scale
+
+    self.set_matrix(matrix)
+
+  def set_matrix(self, matrix):
+    """
+    Sets, or clears if matrix is None, the affine calibration matrix.
+    """
+    n = self.naxes
+    if matrix is None:
+      self._linear = None
+      self._translation = None
+      return
+
+    m = np.asarray(matrix, dtype=float)
+    if m.shape == (n, n):
+      m = np.hstack([m, np.zeros((n, 1))])
+    elif m.shape == (n + 1, n + 1):
+      m = m[:n]
+    if m.shape != (n, n + 1):
+      raise ValueError('Calibration matrix has the wrong shape %r'%(m.shape,))
+
+    self._linear = m[:, :n]
+    self._translation = m[:, n]
+    self._linear_inv = np.linalg.inv(self._linear)
+
+  @property
+  def matrix(self):
+    if self._linear is None:
+      return None
+    return np.hstack([self._linear, self._translation[:, None]])
+
+  @property
+  def coupled(self):
+    """
+    True if the calibration matrix mixes world axes, so that moving along
+    one world axis may move several stage axes
+    """
+    return (self._linear is not None and
+            not np.allclose(self._linear, np.eye(self.naxes)))
+
+  @classmethod
+  def from_config(cls, config, naxes=3):
+    """
+    Builds a transform from a configuration dictionary such as the one in
+    configfile.yml. The optional TRANSFORM entry may contain AXIS_MAP, SIGN,
+    OFFSET, SCALE and MATRIX.
+
+    Without a TRANSFORM entry the transform reproduces the historic
+    LinearStage behaviour, where the X and Z axes are inverted, i.e. the
+    stage position is MAX_DIST - x.
+    """
+    tconfig = config.get('TRANSFORM') or {}
+    max_dist = float(config['MAX_DIST'])
+
+    if 'SIGN' in tconfig or 'OFFSET' in tconfig:
+      sign = tconfig.get('SIGN')
+      offset = tconfig.get('OFFSET')
+    else:
+      sign = [-1, 1, -1]
+      offset = [max_dist, 0, max_dist]
+
+    return cls(naxes=naxes,
+               axis_map=tconfig.get('AXIS_MAP'),
+               sign=sign,
+               offset=offset,
+               scale=tconfig.get('SCALE'),
+               matrix=tconfig.get('MATRIX'))
+
+  def to_stage(self, world):
+    """
+    Converts world coordinates to stage coordinates, in mm
+    """
+    w = np.asarray(world, dtype=float)
+    if self._linear is not None:
+      w = w.dot(self._linear.T) + self._translation
+    return w[..., self.axis_map] * self._gain + self.offset
+
+  def to_world(self, stage):
+    """
+    Converts stage coordinates, in mm, to world coordinates
+    """
+    s = np.asarray(stage, dtype=float)
+    w = ((s - self.offset) / self._gain)[..., self._inverse_map]
+    if self._linear is not None:
+      w = (w - self._translation).dot(self._linear_inv.T)
+    return w
+
+  def to_counts(self, world, counts_per_mm):
+    """
+    Converts world coordinates straight to integer encoder counts.
+    counts_per_mm is either a scalar or one value per stage axis, e.g. the
+    controllers' position_scale.
+    """
+    counts = np.rint(self.to_stage(world) * np.asarray(counts_per_mm))
+    return counts.astype(np.int64)
+
+  def from_counts(self, counts, counts_per_mm):
+    """
+    Converts encoder counts of each stage axis to world coordinates
+    """
+    stage = np.asarray(counts, dtype=float) / np.asarray(counts_per_mm)
+    return self.to_world(stage)
+
+  def axis_to_stage(self, world_axis, value):
+    """
+    Converts a coordinate along a single world axis to the position of the
+    stage axis it drives, returning (stage axis, position). The translation
+    of the calibration matrix is applied, but a matrix that couples axes,
+    see coupled, can't be, and raises ValueError; use to_stage() with whole
+    points then.
+    """
+    if self.coupled:
+      raise ValueError('The calibration matrix couples the axes, single axis '
+                       'coordinates can\'t be converted; use to_stage()')
+    if self._translation is not None:
+      value = value + self._translation[world_axis]
+    i = int(self._inverse_map[world_axis])
+    return i, float(value * self._gain[i] + self.offset[i])
+
+  def stage_to_axis(self, stage_axis, value):
+    """
+    Inverse of axis_to_stage(): converts the position of a single stage axis
+    to a coordinate along the world axis it is driven by, returning
+    (world axis, coordinate). Raises ValueError like axis_to_stage().
+    """
+    if self.coupled:
+      raise ValueError('The calibration matrix couples the axes, single axis '
+                       'coordinates can\'t be converted; use to_world()')
+    world_axis = int(self.axis_map[stage_axis])
+    value = (value - self.offset[stage_axis]) / self._gain[stage_axis]
+    if self._translation is not None:
+      value = value - self._translation[world_axis]
+    return world_axis, float(value)
+
+  def __repr__(self):
+    return ('StageTransform(axis_map=%s, sign=%s, offset=%s, scale=%s, '
+            'matrix=%s)'%(self.axis_map.tolist(), self.sign.tolist(),
+                          self.offset.tolist(), self.scale.tolist(),
+                          None if self._linear is None else
+                          self.matrix.tolist()))
@@ -0,0 +1,179 @@
+"""
+Profiling of velocity and acceleration settings, to find the fastest
+parameters a particular stage can move with reliably.
+
+tune() steps through velocity/acceleration pairs up to configurable caps,
+moves the stage back and forth with each, and measures move time, settle
+time, and whether the controller flagged excessive position error or hit its
+current limit. The fastest setting that stayed clean is saved as a profile
+for the controller's serial number, which controllers load when they are
+opened, see Controller.apply_tuned_profile().
+
+Profiles are JSON files named after the serial number, stored in the
+directory given by the PYAPT_PROFILE_DIR environment variable, or
+~/.pyAPT/profiles by default.
+"""
+from __future__ import absolute_import, division
+import json
+import os
+import time
+
+from . import controller
+from .instrument import Instrumentation
+
+def profile_dir():
+  return os.environ.get('PYAPT_PROFILE_DIR',
+                        os.path.join(os.path.expanduser('~'), '.pyAPT',
+                                     'profiles'))
+
+def profile_path(serial_number, directory=None):
+  return os.path.join(directory or profile_dir(), '%s.json'%(serial_number))
+
+def load_profile(serial_number, directory=None):
+  """
+  Returns the tuned profile of the given serial number as a dict, or None if
+  there isn't one or it can't be read.
+  """
+  path = profile_path(serial_number, directory)
+  try:
+    with open(path) as f:
+      return json.load(f)
+  except (IOError, OSError, ValueError):
+    return None
+
+def save_profile(profile, directory=None):
+  """
+  Writes profile, as returned by tune(), to the profile directory and
+  returns its path. The file is replaced atomically.
+  """
+  path = profile_path(profile['serial_number'], directory)
+  d = os.path.dirname(path)
+  if not os.path.isdir(d):
+    os.makedirs(d)
+  tmp = path + '.tmp'
+  with open(tmp, 'w') as f:
+    json.dump(profile, f, indent=2, sort_keys=True)
+  os.rename(tmp, path)
+  return path
+
+def _steps(lower, upper, n):
+  if n <= 1:
+    return [upper]
+  return [lower + (upper - lower) * i / (n - 1) for i in range(n)]
+
+def measure_move(con, position):
+  """
+  Moves con to position and returns (move time, settle time, status), where
+  move time runs until MGMSG_MOT_MOVE_COMPLETED, and settle time from then
+  until the controller reports zero velocity.
+  """
+  previous = con.instrumentation
+  instr = con.enable_instrumentation(Instrumentation())
+  try:
+    con.goto(position, wait=True)
+    snap = instr.snapshot()
+  finally:
+    con.instrumentation = previous
+
+  move_ns = snap['spans'].get('goto.move', {}).get('total_ns', 0)
+  settle_ns = snap['spans'].get('goto.settle', {}).get('total_ns', 0)
+  return move_ns / 1e9, settle_ns / 1e9, con.status()
+
+def tune(con, start, distance, max_velocity, max_acceleration,
+         min_velocity=None, min_acceleration=None, steps=4, repeats=2,
+         max_settle=None, log=None):
+  """
+  Profiles con by moving between start and start + distance (mm) with
+  steps x steps velocity/acceleration settings, from min_* to max_*, which
+  are hard caps never exceeded. min_* default to the controller's current
+  conservative limits.
+
+  Each setting is tried with repeats round trips. A setting fails if any
+  move ends with excessive position error or motor current limit flags
+  set, or, if max_settle is given, takes longer than max_settle seconds to
+  settle. After a failure the stage is re-homed, and faster velocities at
+  the same acceleration are not tried.
+
+  log, if given, is called with a line of text after each setting.
+
+  Returns the profile as a dict, with the fastest passing setting in
+  max_velocity and max_acceleration and every measurement in results.
+  """
+  if min_velocity is None:
+    min_velocity = min(con.max_velocity, max_velocity)
+  if min_acceleration is None:
+    min_acceleration = min(con.max_acceleration, max_acceleration)
+
+  saved_limits = con.max_velocity, con.max_acceleration
+  con.max_velocity = max_velocity
+  con.max_acceleration = max_acceleration
+
+  results = []
+  best = None
+  try:
+    for acc in _steps(min_acceleration, max_acceleration, steps):
+      for vel in _steps(min_velocity, max_velocity, steps):
+        con.set_velocity_parameters(acc, vel)
+
+        moves = []
+        failed = None
+        try:
+          con.goto(start, wait=True)
+          for _ in range(repeats):
+            for target in (start + distance, start):
+              mt, settle, sts = measure_move(con, target)
+              moves.append((mt, settle))
+              if sts.excessive_position_error:
+                failed = 'excessive position error'
+              elif sts.motor_current_limit_reached:
+                failed = 'motor current limit reached'
+              elif max_settle is not None and settle > max_settle:
+                failed = 'settle time %.3fs'%(settle)
+              if failed:
+                break
+            if failed:
+              break
+        except controller.MotionError as ex:
+          # goto() raises on faults and stalls, and stops the stage
+          failed = type(ex).__name__
+
+        if failed:
+          try:
+            con.home(wait=True)
+          except controller.MotionError as ex:
+            failed = '%s, then homing failed with %s'%(failed,
+                                                      type(ex).__name__)
+
+        n = max(1, len(moves))
+        res = {'velocity': vel,
+               'acceleration': acc,
+               'move_time': sum(m for m, _ in moves) / n,
+               'settle_time': sum(s for _, s in moves) / n,
+               'failed': failed}
+        results.append(res)
+        if log is not None:
+          log('vel %.3f acc %.3f: move %.3fs settle %.3fs %s'%(
+                vel, acc, res['move_time'], res['settle_time'],
+                failed or 'ok'))
+
+        if failed:
+          break
+
+        total = res['move_time'] + res['settle_time']
+        if best is None or total < best[0]:
+          best = (total, res)
+  finally:
+    con.max_velocity, con.max_acceleration = saved_limits
+    con.set_velocity_parameters()
+
+  profile = {'serial_number': con.serial_number,
+             'model': type(con).__name__,
+             'tuned_at': time.time(),
+             'distance': distance,
+             'results': results,
+             'max_velocity': None,
+             'max_acceleration': None}
+  if best is not None:
+    profile['max_velocity'] = best[1]['velocity']
+    profile['max_acceleration'] = best[1]['acceleration']
+  return profile
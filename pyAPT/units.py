@@ -0,0 +1,62 @@
+"""
+Vectorised conversion between real world units and APT units, and range
+checks, for whole arrays of positions at once.
+
+The conversions match what Controller does for single values: real world
+values are multiplied by the controller's scale and truncated to integer
+counts, as goto() does, so quantize() returns exactly the positions the
+stage would be sent to.
+
+Controller exposes these through to_apt(), from_apt(), quantize() and
+out_of_range(), which import this module on first use. It requires NumPy,
+which is why it is not imported by pyAPT itself.
+"""
+from __future__ import absolute_import, division
+import numpy as np
+
+POSITION = 'position'
+VELOCITY = 'velocity'
+ACCELERATION = 'acceleration'
+
+def scale_of(con, kind=POSITION):
+  """
+  Returns the scale of con for kind, i.e. APT units per mm, mm/s or mm/s^2
+  """
+  if kind == POSITION:
+    return con.position_scale
+  elif kind == VELOCITY:
+    return con.velocity_scale
+  elif kind == ACCELERATION:
+    return con.acceleration_scale
+  raise ValueError('Unknown kind %r'%(kind))
+
+def to_apt(values, scale):
+  """
+  Converts values to integer APT units, truncating like int() does
+  """
+  return np.trunc(np.asarray(values, dtype=float) * scale).astype(np.int64)
+
+def from_apt(values, scale):
+  return np.asarray(values, dtype=float) / scale
+
+def quantize(values, scale):
+  """
+  Returns values rounded to what the controller can represent, the same
+  way goto() rounds them
+  """
+  return from_apt(to_apt(values, scale), scale)
+
+def range_mask(positions, linear_range, scale):
+  """
+  Returns a boolean array that is True where positions lie outside
+  linear_range once quantized, matching Controller._position_in_range()
+  """
+  q = quantize(positions, scale)
+  return (q < linear_range[0]) | (q > linear_range[1])
+
+def out_of_range(positions, linear_range, scale):
+  """
+  Returns the indices of positions outside linear_range, an empty array if
+  all are in range
+  """
+  return np.flatnonzero(range_mask(positions, linear_range, scale))
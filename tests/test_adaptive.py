@@ -0,0 +1,43 @@
+"""
+Adaptive multi-resolution scans, with measurements computed from the point
+"""
+from __future__ import absolute_import, division
+import unittest
+
+import numpy as np
+
+from pyAPT.adaptive import AdaptiveScan, serpentine_order
+
+class AdaptiveScanTest(unittest.TestCase):
+  def test_flat_field_stays_coarse(self):
+    scan = AdaptiveScan((0, 0, 0), (4, 4, 4), 4, 1, 0.5)
+    points, values = scan.run(lambda p: 1.0)
+    self.assertEqual(points.shape, (8, 3))
+    self.assertEqual(scan.level_counts, [8])
+
+  def test_step_is_refined_where_it_is(self):
+    scan = AdaptiveScan((0, 0, 0), (4, 4, 4), 2, 1, 0.5)
+    points, values = scan.run(lambda p: float(p[0] > 2.5))
+    # only the cells across x = 2.5 are refined, down to 1mm
+    refined = points[len(points) - scan.level_counts[-1]:]
+    self.assertTrue((refined[:, 0] >= 2).all())
+    self.assertTrue((refined[:, 0] <= 4).all())
+    self.assertEqual(len(points), len(set(map(tuple, points.tolist()))))
+    np.testing.assert_array_equal(values, points[:, 0] > 2.5)
+
+  def test_exhausted_budget_returns_empty_scan(self):
+    scan = AdaptiveScan((0, 0, 0), (1, 1, 1), 0.5, 0.125, 0.1,
+                        time_budget=0)
+    points, values = scan.run(lambda p: 1.0)
+    self.assertTrue(scan.exhausted)
+    self.assertEqual(points.shape, (0, 3))
+    self.assertEqual(values.shape, (0, ))
+
+  def test_serpentine_order(self):
+    grid = np.array([(x, y, 0) for y in (0, 1) for x in (0, 1, 2)], float)
+    order = serpentine_order(grid[::-1])
+    self.assertEqual(grid[::-1][order][:, :2].tolist(),
+                     [[0, 0], [1, 0], [2, 0], [2, 1], [1, 1], [0, 1]])
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,74 @@
+"""
+Controller cache, with simulated devices
+"""
+from __future__ import absolute_import, division
+import os
+import shutil
+import tempfile
+import unittest
+
+import pyAPT
+from pyAPT import sim
+from pyAPT.cache import ControllerCache
+from pyAPT.group import home_all
+
+class ControllerCacheTest(unittest.TestCase):
+  def setUp(self):
+    self.dir = tempfile.mkdtemp()
+    self.cache = ControllerCache(os.path.join(self.dir, 'pyAPT', 'cache.json'))
+    self.con = sim.open_simulated(pyAPT.MTS50, homed=False)
+    self.con.cache = self.cache
+
+  def tearDown(self):
+    self.con.close()
+    shutil.rmtree(self.dir)
+
+  def test_cached_info_matches_fresh(self):
+    fresh = self.con.info()
+    self.assertEqual(self.cache.info(self.con), fresh)
+    self.assertEqual(self.cache.info(self.con), fresh)
+    self.assertEqual(ControllerCache(self.cache.path).info(self.con), fresh)
+
+  def test_save_leaves_only_the_cache(self):
+    self.cache.set_class('sim', 'PRM1')
+    self.cache.save()
+    self.assertEqual(os.listdir(os.path.dirname(self.cache.path)),
+                     ['cache.json'])
+    self.assertIs(ControllerCache(self.cache.path).controller_class('sim'),
+                  pyAPT.PRM1)
+
+  def test_home_params_cached(self):
+    params = self.con.request_home_params()
+    self.assertEqual(self.cache.home_params('sim'), params)
+    self.assertIsNone(self.cache.home_params('sim', channel=2))
+    self.con._device.home_params = (2, 1, 1, 0)
+    self.assertEqual(self.con.request_home_params(), params)
+    self.assertNotEqual(self.con.request_home_params(refresh=True), params)
+
+  def test_homing_records_state(self):
+    self.assertIsNone(self.cache.last_state('sim'))
+    result, = home_all([self.con])
+    self.assertTrue(result.homed)
+    self.assertTrue(self.cache.last_state('sim')['homed'])
+    # the cached state is confirmed before homing is skipped
+    result, = home_all([self.con])
+    self.assertFalse(result.homed)
+
+  def test_homing_trusts_not_homed(self):
+    self.cache.record_state(self.con)
+    self.assertFalse(self.cache.last_state('sim')['homed'])
+    queries = []
+    status = self.con.status
+    self.con.status = lambda *a, **kw: queries.append(a) or status(*a, **kw)
+    result, = home_all([self.con])
+    self.assertTrue(result.homed)
+    # only the status after homing
+    self.assertEqual(len(queries), 1)
+
+  def test_max_age(self):
+    self.cache.record_state(self.con)
+    self.cache.max_age = -1
+    self.assertIsNone(self.cache.last_state('sim'))
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,68 @@
+"""
+Axis groups, on simulated devices
+"""
+from __future__ import absolute_import, division
+import unittest
+
+from pyAPT.group import AxisGroup, Axis
+
+class MoveLinearTest(unittest.TestCase):
+  def setUp(self):
+    self.group = AxisGroup([Axis('x', 'sim-x'), Axis('y', 'sim-y')],
+                           simulated=True, time_scale=0.01)
+    self.group.open()
+
+  def tearDown(self):
+    self.group.close()
+
+  def sent(self):
+    # (acceleration, max velocity) last sent to each device, in mm
+    return [(acc / con.acceleration_scale, vel / con.velocity_scale)
+            for con in self.group.controllers
+            for acc, vel in [con._device.velocity_params]]
+
+  def test_profiles_scaled_by_share_of_move(self):
+    self.group.move_linear((20, 10), restore=False)
+    (ax, vx), (ay, vy) = self.sent()
+    x = self.group.controllers[0]
+    # x has the larger share, so it moves at the limits
+    self.assertAlmostEqual(vx, x.max_velocity, places=4)
+    self.assertAlmostEqual(ax, x.max_acceleration, places=2)
+    self.assertAlmostEqual(vy / vx, 0.5, places=4)
+    self.assertAlmostEqual(ay / ax, 0.5, places=2)
+    x, y = self.group.position()
+    self.assertAlmostEqual(x, 20, places=3)
+    self.assertAlmostEqual(y, 10, places=3)
+
+  def test_velocity_along_the_line(self):
+    self.group.move_linear((3, 4), velocity=0.1, restore=False)
+    (_, vx), (_, vy) = self.sent()
+    self.assertAlmostEqual(vx, 0.06, places=4)
+    self.assertAlmostEqual(vy, 0.08, places=4)
+
+  def test_limits_restored(self):
+    self.group.move_linear((3, 4), velocity=0.1)
+    for con, (acc, vel) in zip(self.group.controllers, self.sent()):
+      self.assertAlmostEqual(vel, con.max_velocity, places=4)
+      self.assertAlmostEqual(acc, con.max_acceleration, places=2)
+
+  def test_axes_that_dont_move_are_left_alone(self):
+    self.group.move_linear((5, 0))
+    statuses = self.group.move_linear((10, 0))
+    self.assertIsNone(statuses[1])
+    self.assertAlmostEqual(self.group.position()[0], 10, places=3)
+
+  def test_tiny_share_axis_gets_at_least_one_unit(self):
+    # y's share of a 50 x 0.3mm diagonal scales its velocity and
+    # acceleration below one APT unit
+    self.group.move_linear((50, 0.3), restore=False)
+    for con in self.group.controllers:
+      acc_apt, vel_apt = con._device.velocity_params
+      self.assertGreaterEqual(acc_apt, 1)
+      self.assertGreaterEqual(vel_apt, 1)
+    x, y = self.group.position()
+    self.assertAlmostEqual(x, 50, places=3)
+    self.assertAlmostEqual(y, 0.3, places=3)
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,136 @@
+"""
+Plan files, completion maps and running plans on simulated devices
+"""
+from __future__ import absolute_import, division
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+import pyAPT
+from pyAPT import plan, sim
+
+class Interrupted(Exception):
+  pass
+
+class PlanTest(unittest.TestCase):
+  def setUp(self):
+    self.dir = tempfile.mkdtemp()
+    self.path = os.path.join(self.dir, 'scan.plan')
+    self.cons = [sim.open_simulated(pyAPT.MTS50, serial_number='sim-%d'%(i))
+                 for i in range(3)]
+
+  def tearDown(self):
+    for con in self.cons:
+      con.close()
+    shutil.rmtree(self.dir)
+
+  def write(self, lower=(0, 0, 0), upper=(2, 2, 2), step=1.0, **kwargs):
+    chunks = plan.raster_chunks(lower, upper, step, chunk=5)
+    return plan.write_plan(self.path, chunks, **kwargs)
+
+  def test_pack_moves_matches_move_frames(self):
+    con = self.cons[0]
+    positions = np.array([0.0, 0.5, 12.3456, 50.0])
+    frames = plan.pack_moves(con, positions)
+    self.assertEqual(frames.shape, (4, 12))
+    for pos, frame in zip(positions, frames):
+      self.assertEqual(frame.tobytes(), con.move_frames(pos)[0][1])
+
+  def test_raster_chunks_serpentine(self):
+    points = np.concatenate(list(plan.raster_chunks((0, 0, 0), (1, 1, 1), 1,
+                                                    chunk=3)))
+    self.assertEqual(points.tolist(),
+                     [[0, 0, 0], [1, 0, 0], [1, 1, 0], [0, 1, 0],
+                      [0, 1, 1], [1, 1, 1], [1, 0, 1], [0, 0, 1]])
+
+  def test_file_round_trip_and_checksum(self):
+    self.assertEqual(self.write(dwell=0.5, config={'MAX_DIST': 2}), 27)
+    p = plan.PlanFile(self.path)
+    try:
+      self.assertEqual(len(p), 27)
+      self.assertEqual(p.naxes, 3)
+      self.assertEqual(p.config, {'MAX_DIST': 2})
+      self.assertEqual(p.records['target'][1].tolist(), [1, 0, 0])
+      self.assertTrue((p.records['dwell'] == 0.5).all())
+      self.assertRaises(plan.PlanMismatchError, p.check_config,
+                        {'MAX_DIST': 3})
+    finally:
+      p.close()
+
+    # flip a byte of the last record
+    with open(self.path, 'r+b') as f:
+      f.seek(-1, os.SEEK_END)
+      last = f.read(1)
+      f.seek(-1, os.SEEK_END)
+      f.write(bytes(bytearray([ord(last) ^ 0xff])))
+    self.assertRaises(plan.PlanChecksumError, plan.PlanFile, self.path)
+
+  def test_completion_map_resumes(self):
+    self.write()
+    p = plan.PlanFile(self.path)
+    done = plan.CompletionMap(p)
+    self.assertFalse(done.resumed)
+    for i in (0, 3, 9, 26):
+      done.mark(i)
+    done.close()
+
+    done = plan.CompletionMap(p)
+    self.assertTrue(done.resumed)
+    self.assertEqual(done.count(), 4)
+    self.assertTrue(done.is_done(9))
+    self.assertFalse(done.is_done(10))
+    self.assertEqual(np.flatnonzero(done.done_mask(2, 12)).tolist(), [1, 7])
+    done.close()
+
+    # restarting forgets, and so does a map written for another plan
+    done = plan.CompletionMap(p, restart=True)
+    self.assertEqual(done.count(), 0)
+    done.mark(1)
+    done.close()
+    p.close()
+    self.write(upper=(3, 2, 2))
+    p = plan.PlanFile(self.path)
+    done = plan.CompletionMap(p)
+    self.assertFalse(done.resumed)
+    self.assertEqual(done.count(), 0)
+    done.close()
+    p.close()
+
+  def test_interrupted_run_resumes_with_points_not_done(self):
+    self.write()
+    p = plan.PlanFile(self.path)
+    visited = []
+    def visit(index, target):
+      if len(visited) == 10:
+        raise Interrupted()
+      visited.append(index)
+
+    ex = plan.PlanExecutor(p, self.cons, visit=visit, window=4)
+    self.assertRaises(Interrupted, ex.run)
+    self.assertEqual(ex.done.count(), 10)
+    ex.done.close()
+
+    ex = plan.PlanExecutor(p, self.cons, visit=lambda i, t: visited.append(i),
+                           window=4)
+    self.assertTrue(ex.done.resumed)
+    self.assertEqual(ex.run(), 17)
+    self.assertEqual(visited, list(range(27)))
+    np.testing.assert_allclose([con.position() for con in self.cons],
+                               p.records['target'][-1], atol=1e-3)
+    ex.done.remove()
+    p.close()
+
+  def test_out_of_range_plan_is_refused(self):
+    self.write(upper=(60, 2, 2), step=20.0)
+    p = plan.PlanFile(self.path)
+    ex = plan.PlanExecutor(p, self.cons)
+    self.assertRaises(pyAPT.OutOfRangeError, ex.run)
+    self.assertEqual(ex.done.count(), 0)
+    ex.done.remove()
+    p.close()
+
+if __name__ == '__main__':
+  unittest.main()
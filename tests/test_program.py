@@ -0,0 +1,41 @@
+"""
+Motion programs, on simulated devices
+"""
+from __future__ import absolute_import, division
+import unittest
+
+import pyAPT
+from pyAPT import sim
+from pyAPT.program import MotionProgram, ProgramExecutor
+
+class VelocitySegmentTest(unittest.TestCase):
+  def setUp(self):
+    # real time, so that deadlines are checked against the actual moves
+    self.con = sim.open_simulated(pyAPT.MTS50, time_scale=1.0)
+    self.con.deadline_margin = 0.1
+
+  def tearDown(self):
+    self.con.close()
+
+  def test_compiling_keeps_velocity_parameters(self):
+    prog = MotionProgram()
+    prog.velocity(0, max_velocity=0.04)
+    ProgramExecutor(prog, [self.con])
+    self.assertEqual(self.con._velocity_params, {})
+
+  def test_slow_move_before_fast_velocity_meets_deadline(self):
+    # the last velocity segment is fast, but the move before it is slow and
+    # must get a deadline from the slow profile
+    prog = MotionProgram()
+    prog.velocity(0, max_velocity=0.04)
+    prog.absolute(0, 0.1)
+    prog.velocity(0)
+    timings = ProgramExecutor(prog, [self.con]).run()
+
+    self.assertEqual(len(timings), 3)
+    self.assertAlmostEqual(self.con.position(), 0.1, places=3)
+    acc, vel = self.con._velocity_params[1]
+    self.assertAlmostEqual(vel, self.con.max_velocity, places=3)
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,101 @@
+"""
+Sharded scans: chunk assignment and stealing, and whole scans on simulated
+rigs
+"""
+from __future__ import absolute_import, division
+import collections
+import unittest
+
+import numpy as np
+
+from pyAPT.shard import Rig, RigStats, ShardedScan, INTERLEAVE, REGION
+
+def acquire(rig_name, index, point):
+  return (rig_name, index, point.tolist())
+
+def acquire_failing(rig_name, index, point):
+  if rig_name == 'bad' and index % 10 == 3:
+    raise RuntimeError('%s failed at %d'%(rig_name, index))
+  return index
+
+def points(n):
+  return np.stack([np.arange(n) * 0.1, np.zeros(n), np.zeros(n)], axis=1)
+
+class AssignmentTest(unittest.TestCase):
+  def scan(self, partition=REGION, nrigs=2, npoints=10):
+    rigs = [Rig(name, [1, 2, 3], simulated=True)
+            for name in 'abc'[:nrigs]]
+    return ShardedScan(rigs, points(npoints), partition=partition, chunk=2)
+
+  def test_chunks_cover_points_in_order(self):
+    scan = self.scan(npoints=9)
+    self.assertEqual([c.tolist() for c in scan.chunks],
+                     [[0, 1], [2, 3], [4, 5], [6, 7], [8]])
+
+  def test_region(self):
+    queues = self.scan(REGION)._assign()
+    self.assertEqual(list(queues['a']), [0, 1, 2])
+    self.assertEqual(list(queues['b']), [3, 4])
+
+  def test_interleave(self):
+    queues = self.scan(INTERLEAVE, nrigs=3)._assign()
+    self.assertEqual(list(queues['a']), [0, 3])
+    self.assertEqual(list(queues['b']), [1, 4])
+    self.assertEqual(list(queues['c']), [2])
+
+  def test_idle_rig_steals_from_back_of_longest_queue(self):
+    scan = self.scan(REGION)
+    queues = scan._assign()
+    stats = dict((name, RigStats(name)) for name in queues)
+    orphans = collections.deque()
+
+    take = lambda name: scan._next_chunk(name, queues, orphans, stats)
+    self.assertEqual([take('b'), take('b')], [3, 4])
+    # b is out of work, and takes a's last chunk
+    self.assertEqual(take('b'), 2)
+    self.assertEqual(stats['b'].stolen, 1)
+    self.assertEqual([take('a'), take('a')], [0, 1])
+    self.assertEqual(take('a'), None)
+    self.assertEqual(stats['a'].stolen, 0)
+
+  def test_orphans_go_first(self):
+    scan = self.scan(REGION)
+    queues = scan._assign()
+    stats = dict((name, RigStats(name)) for name in queues)
+    orphans = collections.deque([7])
+    self.assertEqual(scan._next_chunk('a', queues, orphans, stats), 7)
+    self.assertEqual(scan._next_chunk('a', queues, orphans, stats), 0)
+
+  def test_invalid(self):
+    rig = Rig('a', [1, 2, 3])
+    self.assertRaises(ValueError, ShardedScan, [], points(4))
+    self.assertRaises(ValueError, ShardedScan, [rig, rig], points(4))
+    self.assertRaises(ValueError, ShardedScan, [rig], points(4),
+                      partition='random')
+
+class ShardedScanTest(unittest.TestCase):
+  def test_every_point_visited_once(self):
+    rigs = [Rig(name, [1, 2, 3], simulated=True) for name in ('a', 'b')]
+    scan = ShardedScan(rigs, points(40), acquire=acquire, chunk=4)
+    result = scan.run(poll_interval=0.1)
+
+    self.assertEqual(len(result.results), 40)
+    for i, (name, index, point) in enumerate(result.results):
+      self.assertEqual(index, i)
+      self.assertEqual(rigs[result.rig_of[i]].name, name)
+      np.testing.assert_allclose(point, scan.points[i])
+    self.assertEqual(sum(s.points for s in result.stats.values()), 40)
+
+  def test_failed_rig_leaves_its_points_to_the_others(self):
+    rigs = [Rig(name, [1, 2, 3], simulated=True) for name in ('good', 'bad')]
+    scan = ShardedScan(rigs, points(40), acquire=acquire_failing, chunk=4)
+    result = scan.run(poll_interval=0.1)
+
+    self.assertEqual(result.results, list(range(40)))
+    self.assertIsNotNone(result.stats['bad'].error)
+    self.assertIsNone(result.stats['good'].error)
+    self.assertEqual(result.stats['bad'].points + result.stats['good'].points,
+                     40)
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,59 @@
+"""
+Controller shared between threads, on a simulated device
+"""
+from __future__ import absolute_import, division
+import threading
+import unittest
+
+import pyAPT
+from pyAPT import sim
+from pyAPT.controller import MoveStoppedError
+
+class StopDuringGotoTest(unittest.TestCase):
+  def setUp(self):
+    # moves take a tenth of real time, so goto(40) lasts a few seconds
+    self.con = sim.open_simulated(pyAPT.MTS50, time_scale=0.1)
+    self.con.deadline_margin = 0.5
+
+  def tearDown(self):
+    self.con.close()
+
+  def test_stop_and_goto_both_see_move_stopped(self):
+    errors = []
+    def move():
+      try:
+        self.con.goto(40)
+      except Exception as e:
+        errors.append(e)
+
+    mover = threading.Thread(target=move)
+    mover.start()
+    # let the move get going
+    self.con.status()
+    self.con.status()
+
+    sts = self.con.stop()
+    mover.join(10)
+    self.assertFalse(mover.is_alive())
+
+    self.assertEqual(len(errors), 1)
+    self.assertIsInstance(errors[0], MoveStoppedError)
+    self.assertLess(sts.position, 40)
+
+  def test_concurrent_stops(self):
+    self.con.goto(40, wait=False)
+    self.con.status()
+
+    results = []
+    def stop():
+      results.append(self.con.stop())
+
+    stoppers = [threading.Thread(target=stop) for _ in range(3)]
+    for t in stoppers:
+      t.start()
+    for t in stoppers:
+      t.join(10)
+    self.assertEqual(len(results), 3)
+
+if __name__ == '__main__':
+  unittest.main()
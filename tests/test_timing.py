@@ -0,0 +1,94 @@
+"""
+DwellScheduler, on a fake clock whose sleeps wake up late by a fixed time
+"""
+from __future__ import absolute_import, division
+import unittest
+
+from pyAPT import timing
+from pyAPT.timing import DwellScheduler
+
+class FakeTime(object):
+  """
+  Stands in for the time module in pyAPT.timing: sleep() advances the clock
+  by the time asked plus late, as an OS scheduler waking up late would
+  """
+  def __init__(self, late=0.001):
+    self.now = 0.0
+    self.late = late
+
+  def clock(self):
+    return self.now
+
+  def sleep(self, seconds):
+    # sleep(0) only yields, but must let the clock move on for the spin
+    self.now += seconds + self.late if seconds > 0 else 1e-6
+
+class DwellSchedulerTest(unittest.TestCase):
+  def setUp(self):
+    self.fake = FakeTime()
+    self.time = timing.time
+    timing.time = self.fake
+
+  def tearDown(self):
+    timing.time = self.time
+
+  def scheduler(self, **kwargs):
+    kwargs.setdefault('spin', 0.0)
+    kwargs.setdefault('adapt', False)
+    return DwellScheduler(clock=self.fake.clock, **kwargs)
+
+  def test_dwell_overshoots_by_the_oversleep(self):
+    t = self.scheduler()
+    for k in range(5):
+      self.assertAlmostEqual(t.dwell(0.01, k), 0.011)
+    self.assertEqual([i for i, _, _ in t.log()], list(range(5)))
+    self.assertAlmostEqual(t.total_actual - t.total_requested, 0.005)
+
+  def test_carry_takes_overshoot_off_the_next_dwell(self):
+    t = self.scheduler(carry=True)
+    for k in range(5):
+      t.dwell(0.01, k)
+    # only the overshoot of the last dwell is left over
+    self.assertAlmostEqual(t.total_actual - t.total_requested, 0.001)
+
+  def test_no_carry_by_default(self):
+    self.assertFalse(DwellScheduler().carry)
+
+  def test_adapt_learns_oversleep(self):
+    t = self.scheduler(adapt=True)
+    for k in range(50):
+      t.dwell(0.01, k)
+    self.assertAlmostEqual(t.oversleep, 0.001, places=4)
+    errors = t.errors()
+    self.assertLess(errors[-1], errors[0] / 2)
+
+  def test_at_does_not_drift(self):
+    t = self.scheduler()
+    t.start()
+    for k in range(1, 11):
+      late = t.at(k * 0.01, k)
+      self.assertLess(late, 0.0011)
+    self.assertAlmostEqual(self.fake.now, 0.101, places=6)
+    self.assertEqual(t.behind, 0)
+
+  def test_at_counts_missed_deadlines(self):
+    t = self.scheduler()
+    t.start()
+    self.fake.now += 0.05
+    t.at(0.01)
+    self.assertEqual(t.behind, 1)
+    self.assertEqual(t.log()[0][1], 0.0)
+
+  def test_log_keeps_last_history_waits(self):
+    t = self.scheduler(history=3)
+    for k in range(5):
+      t.dwell(0.0, k)
+    self.assertEqual([i for i, _, _ in t.log()], [2, 3, 4])
+    self.assertEqual(t.summary()['count'], 5)
+
+    t.reset()
+    self.assertEqual(len(t), 0)
+    self.assertEqual(t.log(), [])
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,57 @@
+"""
+World to stage coordinate transforms
+"""
+from __future__ import absolute_import, division
+import unittest
+
+import numpy as np
+
+from pyAPT.transform import StageTransform
+
+class StageTransformTest(unittest.TestCase):
+  def test_default_config_inverts_x_and_z(self):
+    t = StageTransform.from_config({'MAX_DIST': 50})
+    np.testing.assert_allclose(t.to_stage((10, 20, 30)), (40, 20, 20))
+
+  def test_round_trip_of_many_points(self):
+    t = StageTransform(axis_map=(1, 2, 0), sign=(-1, 1, 1),
+                       offset=(50, 0, 5), scale=(1, 2, 0.5),
+                       matrix=[[1, 0.01, 0, 0.5],
+                               [0, 1, 0, -0.25],
+                               [0, 0, 1, 0]])
+    world = np.random.RandomState(0).uniform(0, 50, (100, 3))
+    stage = t.to_stage(world)
+    self.assertEqual(stage.shape, (100, 3))
+    np.testing.assert_allclose(t.to_world(stage), world)
+    # the same as converting the points one at a time
+    np.testing.assert_allclose(stage[7], t.to_stage(world[7]))
+
+  def test_axis_map_routes_world_axes(self):
+    t = StageTransform(axis_map=(2, 0, 1))
+    np.testing.assert_allclose(t.to_stage((1, 2, 3)), (3, 1, 2))
+    self.assertEqual(t.axis_to_stage(0, 1.5), (1, 1.5))
+    self.assertEqual(t.stage_to_axis(1, 1.5), (0, 1.5))
+
+  def test_counts(self):
+    t = StageTransform(offset=(1, 0, 0))
+    counts = t.to_counts((0.5, 1, 2), 100)
+    self.assertEqual(counts.tolist(), [150, 100, 200])
+    np.testing.assert_allclose(t.from_counts(counts, 100), (0.5, 1, 2))
+
+  def test_coupled_matrix_refuses_single_axes(self):
+    t = StageTransform(matrix=[[1, 0.1, 0], [0, 1, 0], [0, 0, 1]])
+    self.assertTrue(t.coupled)
+    self.assertRaises(ValueError, t.axis_to_stage, 0, 1.0)
+    # a pure translation doesn't couple
+    t.set_matrix([[1, 0, 0, 2], [0, 1, 0, 0], [0, 0, 1, 0]])
+    self.assertFalse(t.coupled)
+    self.assertEqual(t.axis_to_stage(0, 1.0), (0, 3.0))
+
+  def test_invalid_parameters(self):
+    self.assertRaises(ValueError, StageTransform, axis_map=(0, 0, 1))
+    self.assertRaises(ValueError, StageTransform, sign=(1, 0, 1))
+    self.assertRaises(ValueError, StageTransform, offset=(1, 2))
+    self.assertRaises(ValueError, StageTransform, matrix=np.eye(2))
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,49 @@
+"""
+Vectorised unit conversions and range checks, against what Controller does
+one value at a time
+"""
+from __future__ import absolute_import, division
+import struct as st
+import unittest
+
+import numpy as np
+
+import pyAPT
+from pyAPT import sim, units
+
+class UnitsTest(unittest.TestCase):
+  def setUp(self):
+    self.con = sim.open_simulated(pyAPT.MTS50)
+
+  def tearDown(self):
+    self.con.close()
+
+  def test_to_apt_matches_goto(self):
+    positions = [0.0, 0.1, 12.34567, 49.99999]
+    counts = self.con.to_apt(positions)
+    for pos, count in zip(positions, counts):
+      frame = self.con.move_frames(pos)[0][1]
+      self.assertEqual(st.unpack('<i', frame[-4:])[0], count)
+
+  def test_quantize(self):
+    q = self.con.quantize([1.00001, 2.5])
+    np.testing.assert_allclose(q, self.con.from_apt(self.con.to_apt(q)))
+    self.assertLessEqual(q[0], 1.00001)
+    self.assertGreater(q[0], 1.00001 - 1.0 / self.con.position_scale)
+
+  def test_velocity_and_acceleration_scales(self):
+    self.assertEqual(self.con.to_apt([1.0], units.VELOCITY)[0],
+                     int(self.con.velocity_scale))
+    self.assertEqual(self.con.to_apt([1.0], units.ACCELERATION)[0],
+                     int(self.con.acceleration_scale))
+    self.assertRaises(ValueError, units.scale_of, self.con, 'jerk')
+
+  def test_out_of_range(self):
+    low, high = self.con.linear_range
+    positions = [low, high, low - 1, high + 1, (low + high) / 2]
+    self.assertEqual(self.con.out_of_range(positions).tolist(), [2, 3])
+    self.assertEqual(self.con.out_of_range(positions, mask=True).tolist(),
+                     [False, False, True, True, False])
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,48 @@
+#!/usr/bin/env python
+"""
+Usage: python tune_velocity.py <serial> <start_mm> <distance_mm> <max velocity (mm/s)> <max acceleration (mm/s/s)>
+
+Moves the stage back and forth between start and start + distance with
+increasing velocity and acceleration settings, up to the given caps, and
+saves the fastest setting that did not cause a position error as the tuned
+profile of the controller. The profile is loaded whenever the controller is
+opened from then on.
+"""
+from __future__ import absolute_import
+from __future__ import print_function
+import pylibftdi
+import pyAPT
+from pyAPT import tuning
+
+def main(args):
+  if len(args)<6:
+    print(__doc__)
+    return 1
+
+  serial = args[1]
+  start = float(args[2])
+  dist = float(args[3])
+  max_vel = float(args[4])
+  max_acc = float(args[5])
+
+  try:
+    with pyAPT.open_controller(serial, use_tuned_profile=False) as con:
+      print('Found APT controller S/N',serial)
+      print('\tTuning between %.2fmm and %.2fmm'%(start, start+dist))
+      profile = tuning.tune(con, start, dist, max_vel, max_acc,
+                            log=lambda line: print('\t\t'+line))
+      if profile['max_velocity'] is None:
+        print('\tNo setting passed, profile not saved')
+        return 1
+
+      print('\tBest: velocity %.3fmm/s acceleration %.3fmm/s/s'%(
+            profile['max_velocity'], profile['max_acceleration']))
+      print('\tSaved to', tuning.save_profile(profile))
+      return 0
+  except pylibftdi.FtdiError as ex:
+    print('\tCould not find APT controller S/N of',serial)
+    return 1
+
+if __name__ == '__main__':
+  import sys
+  sys.exit(main(sys.argv))